@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""
+TruthVault Network Scanner - micro-benchmarks
+Run from this folder on a dev box:
+
+  python scanner_benchmarks.py          # run everything
+  python scanner_benchmarks.py ping     # run one benchmark
+
+Benchmarks:
+  ping  - /24 sweep, one `ping` process per host vs one ICMP socket (127.0.0.0/24)
+  arp   - neighbor table read: `arp -a` vs `ip -j neigh` vs /proc/net/arp, plus an ARP sweep
+  ports - port scan of 20 fake devices, thread pool per device vs the asyncio engine
+  analyze - scan_network phase 6 on 20 fake devices, one device at a time vs the pipeline
+"""
+
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import truthvault_scanner as scanner
+
+
+def timed(fn, iterations):
+    """Run fn iterations times, return seconds per call"""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations
+
+
+def report(name, seconds, detail=''):
+    print(f"  {name:<44} {seconds * 1000:>10.3f} ms  {detail}")
+
+
+# Stand-in for ping when the real one is missing: answers instantly, so only
+# the cost of forking a process per host is measured.
+STAND_IN_PING = """#!/bin/sh
+exit 0
+"""
+
+
+def install_stand_in_ping(tmp):
+    """Write the stand-in ping into tmp and put it first on PATH"""
+    ping_path = os.path.join(tmp, 'ping')
+    with open(ping_path, 'w') as f:
+        f.write(STAND_IN_PING)
+    os.chmod(ping_path, 0o755)
+    os.environ['PATH'] = tmp + os.pathsep + os.environ['PATH']
+
+
+# ============== PING SWEEP ==============
+
+def bench_ping():
+    """Sweep every address of 127.0.0.0/24 (all answer on loopback)"""
+    print("Ping sweep, 254 hosts")
+    hosts = [f"127.0.0.{i}" for i in range(1, 255)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        label = "ping process per host"
+        if not shutil.which('ping'):
+            install_stand_in_ping(tmp)
+            label += " (stand-in ping)"
+        start = time.perf_counter()
+        alive = scanner.ping_sweep_subprocess(hosts)
+        report(label, time.perf_counter() - start, f"{len(alive)} replied")
+
+    sock = scanner.open_icmp_socket()
+    if sock is None:
+        print("  ICMP socket sweep: not allowed here (see net.ipv4.ping_group_range)")
+        return
+    kind = 'datagram' if sock.type == scanner.socket.SOCK_DGRAM else 'raw'
+    sock.close()
+    start = time.perf_counter()
+    alive = scanner.ping_sweep(hosts)
+    report(f"one ICMP {kind} socket", time.perf_counter() - start, f"{len(alive)} replied")
+
+
+# ============== NEIGHBOR TABLE ==============
+
+def bench_arp(iterations=200):
+    """Per-call cost of each neighbor table source (same {ip: MAC} result)"""
+    print("Neighbor table read")
+    readers = [
+        ("arp -a (regex)", scanner.read_arp_command),
+        ("ip -j -4 neigh", scanner.read_ip_neigh),
+        ("/proc/net/arp", scanner.read_proc_arp),
+    ]
+    for name, reader in readers:
+        table = reader() if reader is not scanner.read_arp_command or shutil.which('arp') else None
+        if table is None:
+            print(f"  {name:<44} (not available)")
+            continue
+        report(name, timed(reader, iterations), f"{len(table)} entries")
+
+    network = scanner.get_network_range()
+    start = time.perf_counter()
+    found = scanner.arp_sweep([f"{network}.{i}" for i in range(1, 255)])
+    if found is None:
+        print("  ARP sweep: raw sockets not available (Linux + root only)")
+    else:
+        report(f"ARP sweep of {network}.0/24", time.perf_counter() - start, f"{len(found)} replied")
+
+
+# ============== PORT SCAN ==============
+
+class FakeDevices:
+    """
+    Loopback stand-ins for LAN devices on 127.0.1.x (Linux routes all of
+    127/8 to lo). Each device accepts on a few ports, "filters" one port (a
+    listener whose accept queue is full, so SYNs are dropped and connects
+    hang), and refuses the rest.
+    """
+
+    def __init__(self, count, ports, open_per_device=3):
+        self.hosts = [f"127.0.1.{n}" for n in range(1, count + 1)]
+        self.sockets = []
+        self.expected = {}
+        port_list = list(ports)
+        for n, ip in enumerate(self.hosts):
+            open_ports = port_list[n % len(port_list):][:open_per_device]
+            for port in open_ports:
+                self.listen(ip, port, 128)
+            filtered = port_list[(n + open_per_device) % len(port_list)]
+            listener = self.listen(ip, filtered, 0)
+            self.sockets.append(socket.create_connection(listener.getsockname()))
+            self.expected[ip] = sorted(open_ports)
+        # Open ports accept and close, like a device that wants a request first
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+
+    def listen(self, ip, port, backlog):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((ip, port))
+        sock.listen(backlog)
+        sock.setblocking(False)
+        self.sockets.append(sock)
+        if backlog:
+            self.accepting = getattr(self, 'accepting', []) + [sock]
+        return sock
+
+    def accept_loop(self):
+        while self.sockets:
+            for sock in list(self.accepting):
+                try:
+                    sock.accept()[0].close()
+                except OSError:
+                    pass
+            time.sleep(0.001)
+
+    def close(self):
+        sockets, self.sockets = self.sockets, []
+        for sock in sockets:
+            sock.close()
+
+
+def legacy_scan_ports_threaded(ip, ports):
+    """scan_ports_threaded before the asyncio engine: a 20-thread pool per device"""
+    open_ports = []
+    with ThreadPoolExecutor(max_workers=20) as executor:
+        futures = {executor.submit(scanner.check_port, ip, port): (port, service)
+                   for port, service in ports.items()}
+        for future in as_completed(futures):
+            port, service = futures[future]
+            if future.result():
+                open_ports.append({"port": port, "service": service})
+    return open_ports
+
+
+def bench_ports(devices=20):
+    """Scan every fake device for 23 ports, as scan_network does"""
+    print(f"Port scan, {devices} devices x {len(scanner.CAMERA_PORTS)} ports (1 filtered port each)")
+    # Same number of ports as CAMERA_PORTS, moved up so no root is needed
+    ports = {20000 + n: service for n, service in enumerate(scanner.CAMERA_PORTS.values())}
+    harness = FakeDevices(devices, ports)
+    try:
+        def check(results):
+            found = {ip: sorted(p["port"] for p in open_ports) for ip, open_ports in results.items()}
+            return "all open ports found" if found == harness.expected else "MISSED PORTS"
+
+        start = time.perf_counter()
+        results = {ip: legacy_scan_ports_threaded(ip, ports) for ip in harness.hosts}
+        report("thread pool per device, one at a time", time.perf_counter() - start, check(results))
+
+        engine = scanner.PortScanner()
+        start = time.perf_counter()
+        results = scanner.asyncio.run(engine.scan(harness.hosts, ports))
+        elapsed = time.perf_counter() - start
+        timeout = engine.timeout_for(harness.hosts[0])
+        report("asyncio engine, all devices", elapsed, f"{check(results)}, adaptive timeout {timeout * 1000:.0f} ms")
+    finally:
+        harness.close()
+
+
+# ============== DEVICE ANALYSIS ==============
+
+def analyze_one_at_a_time(arp, local_ip):
+    """scan_network phase 6 before the pipeline: every step of a device, then the next"""
+    devices = []
+    for ip, mac in arp.items():
+        device = {"ip": ip, "mac": mac, "hostname": None, "vendor": "Unknown", "vendor_icon": "❓",
+                  "open_ports": [], "http_fingerprint": None, "rtsp_credentials": []}
+        scanner.lookup_device(device)
+        device["open_ports"] = legacy_scan_ports_threaded(ip, scanner.CAMERA_PORTS)
+        scanner.fingerprint_device(device)
+        devices.append(scanner.classify_device(device, set(), local_ip))
+    return devices
+
+
+def bench_analyze(devices=20):
+    """Total time, and when the first device became visible to /devices"""
+    print(f"Device analysis, {devices} fake devices")
+    camera_ports = scanner.CAMERA_PORTS
+    scanner.CAMERA_PORTS = {20000 + n: service for n, service in enumerate(camera_ports.values())}
+    harness = FakeDevices(devices, scanner.CAMERA_PORTS)
+    arp = {ip: "00:00:00:00:00:00" for ip in harness.hosts}
+    try:
+        start = time.perf_counter()
+        analyze_one_at_a_time(arp, '127.0.0.1')
+        report("one device at a time", time.perf_counter() - start, "first device visible at the end")
+
+        scanner.discovered_devices = []
+        first = []
+
+        def watch():
+            # What a /devices poll would see
+            while not scanner.discovered_devices:
+                time.sleep(0.001)
+            first.append(time.perf_counter())
+
+        watcher = threading.Thread(target=watch, daemon=True)
+        start = time.perf_counter()
+        watcher.start()
+        found = scanner.analyze_devices(arp, set(), '127.0.0.1')
+        elapsed = time.perf_counter() - start
+        watcher.join(timeout=1)
+        detail = f"{len(found)} devices, first visible after {(first[0] - start) * 1000:.0f} ms" if first else ""
+        report("pipeline", elapsed, detail)
+    finally:
+        scanner.CAMERA_PORTS = camera_ports
+        harness.close()
+
+
+BENCHMARKS = {
+    'ping': bench_ping,
+    'arp': bench_arp,
+    'ports': bench_ports,
+    'analyze': bench_analyze,
+}
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"Unknown benchmark: {name} (choose from {', '.join(BENCHMARKS)})")
+            sys.exit(1)
+        BENCHMARKS[name]()
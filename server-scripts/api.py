@@ -4,194 +4,2670 @@ TrueVault VPN - Server-Side Key Generation API
 Deploy to: /opt/truevault/api.py
 
 Endpoints:
-  GET  /api/health       - Health check
+  GET  /api/health       - Health check (cached interface status)
+  GET  /api/health/deep  - Health plus DB latency, peer count, free IPs, wg error rates
   GET  /api/server-info  - Get server public key
   POST /api/create-peer  - Generate keys, add peer, return config
+  POST /api/create-peers - Bulk create-peer, streams configs as NDJSON
   POST /api/remove-peer  - Remove peer from WireGuard
-  GET  /api/list-peers   - List all connected peers
+  GET  /api/list-peers   - List connected peers (streamed, paginated, filterable)
+  GET  /api/peer-stats   - Peers whose counters changed since a timestamp
+  POST /api/auth/token   - Mint a short-lived signed bearer token
+  GET  /metrics          - Prometheus metrics (latency histograms, stage timings, counters)
+
+Production: python serve.py --workers 4 (pre-forked, see serve.py)
+wg0 is driven through WG_BACKEND=auto|netlink|cli|fake (see WIREGUARD CONTROL)
 """
 
-from flask import Flask, request, jsonify
-import subprocess
-import os
-import sqlite3
-from datetime import datetime
-import base64
-import io
+from flask import Flask, Response, request, jsonify, g
+import subprocess
+import os
+import sqlite3
+from datetime import datetime
+import base64
+import io
+import json
+import hashlib
+import bisect
+import hmac
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict
+import signal
+import socket
+import atexit
+import ipaddress
+import threading
+import time
+import queue
+from contextlib import contextmanager
+from functools import wraps
+from collections import deque
+
+# In-process Curve25519 backends; `wg genkey`/`wg pubkey` is used only if neither imports
+try:
+    from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+    from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+    KEYGEN_BACKEND = 'cryptography'
+except ImportError:
+    try:
+        from nacl.public import PrivateKey as NaClPrivateKey
+        KEYGEN_BACKEND = 'pynacl'
+    except ImportError:
+        KEYGEN_BACKEND = 'wg'
+
+# In-process WireGuard control over generic netlink; `wg` is forked per call without it
+try:
+    from pyroute2 import WireGuard as NetlinkWireGuard
+    from pyroute2.netlink import NLM_F_ACK, NLM_F_REQUEST
+    from pyroute2.netlink.generic.wireguard import WG_CMD_SET_DEVICE, WG_GENL_VERSION, WGPEER_F_REMOVE_ME, wgmsg
+except ImportError:
+    NetlinkWireGuard = None
+
+# Private keys at rest: AES-256-GCM (cryptography) or XSalsa20-Poly1305 (pynacl)
+try:
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:
+    AESGCM = None
+try:
+    from nacl.secret import SecretBox
+except ImportError:
+    SecretBox = None
+
+# QR codes are optional; PNG output additionally needs pillow
+try:
+    import qrcode
+except ImportError:
+    qrcode = None
+
+app = Flask(__name__)
+
+# Configuration from environment variables
+CONFIG = {
+    'server_name': os.environ.get('SERVER_NAME', 'vpn-server'),
+    'server_ip': os.environ.get('SERVER_IP', '0.0.0.0'),
+    'server_port': int(os.environ.get('WG_PORT', '51820')),
+    'api_port': int(os.environ.get('API_PORT', '8443')),
+    'subnet_base': os.environ.get('SUBNET_BASE', '10.8.0'),
+    # Client address pools: IPv4 CIDRs plus at most one IPv6 prefix, e.g. "10.8.0.0/16, fd42:42::/64"
+    'client_networks': os.environ.get('CLIENT_NETWORKS', f"{os.environ.get('SUBNET_BASE', '10.8.0')}.0/24"),
+    'dns_servers': os.environ.get('DNS', '1.1.1.1, 1.0.0.1'),
+    'api_secret': os.environ.get('API_SECRET', 'CHANGE_THIS_SECRET'),
+    # Older secrets still accepted while clients rotate (comma separated)
+    'api_secrets_previous': [s.strip() for s in os.environ.get('API_SECRETS_PREVIOUS', '').split(',') if s.strip()],
+    'auth_token_ttl': int(os.environ.get('AUTH_TOKEN_TTL', '300')),
+    'auth_cache_size': int(os.environ.get('AUTH_CACHE_SIZE', '1024')),
+    'idempotency_ttl': int(os.environ.get('IDEMPOTENCY_TTL', '86400')),
+    'idempotency_cache_size': int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', '1024')),
+    'db_path': os.environ.get('DB_PATH', '/opt/truevault/peers.db'),
+    'server_key_path': os.environ.get('SERVER_KEY_PATH', '/etc/wireguard/server_public.key'),
+    # Encrypts private keys in peers.db; defaults to node.key next to the database
+    'node_key_path': os.environ.get('NODE_KEY_PATH', ''),
+    # Keep peers.db.pre-v1 (plaintext keys) after migrating to encrypted keys
+    'keep_migration_backup': os.environ.get('KEEP_MIGRATION_BACKUP', '') not in ('', '0'),
+    'reservoir_low': int(os.environ.get('RESERVOIR_LOW', '8')),
+    'reservoir_high': int(os.environ.get('RESERVOIR_HIGH', '32')),
+    'max_batch_peers': int(os.environ.get('MAX_BATCH_PEERS', '1000')),
+    'stats_interval': float(os.environ.get('STATS_INTERVAL', '10')),
+    'stats_history': int(os.environ.get('STATS_HISTORY', '360')),
+    'handshake_flush_interval': float(os.environ.get('HANDSHAKE_FLUSH_INTERVAL', '5')),
+    'qr_cache_size': int(os.environ.get('QR_CACHE_SIZE', '256')),
+    'qr_workers': int(os.environ.get('QR_WORKERS', '0')),
+    'wg_backend': os.environ.get('WG_BACKEND', 'auto'),
+    'health_interval': float(os.environ.get('HEALTH_INTERVAL', '2')),
+    # Startup reconcile of wg0 against peers.db: on (keeps orphans), remove-orphans, or off
+    'reconcile': os.environ.get('RECONCILE', 'on'),
+    # Expire peers without a handshake for this many days (0 = never)
+    'peer_max_idle_days': float(os.environ.get('PEER_MAX_IDLE_DAYS', '0')),
+    'gc_interval': float(os.environ.get('GC_INTERVAL', '3600')),
+    'gc_batch': int(os.environ.get('GC_BATCH', '500'))
+}
+
+
+def parse_client_networks(spec):
+    """'10.8.0.0/16, fd42:42::/64' -> ([IPv4Network, ...], IPv6Network or None)"""
+    networks = [ipaddress.ip_network(part.strip()) for part in spec.split(',') if part.strip()]
+    networks6 = [n for n in networks if n.version == 6]
+    if len(networks6) > 1:
+        raise ValueError("CLIENT_NETWORKS takes at most one IPv6 prefix")
+    return [n for n in networks if n.version == 4], networks6[0] if networks6 else None
+
+
+class IPAllocator:
+    """
+    In-memory allocator for client addresses (IPAM).
+
+    The IPv4 pools are numbered as one index space. A bytearray marks which
+    indexes are taken and a deque holds the free ones, so allocate/release
+    are O(1) at any pool size and address <-> index is a bisect over the
+    pools. With an IPv6 prefix every client also gets the IPv6 address at
+    its IPv4 index, so dual-stack needs no extra state or DB column.
+    Loaded once from peers.db by init_db().
+    """
+
+    def __init__(self, networks, network6=None):
+        self.networks = sorted(ipaddress.IPv4Network(n) for n in networks)
+        self.network6 = ipaddress.IPv6Network(network6) if network6 else None
+        if not self.networks:
+            raise ValueError("At least one IPv4 client network is required")
+        for a, b in zip(self.networks, self.networks[1:]):
+            if a.overlaps(b):
+                raise ValueError(f"Client networks {a} and {b} overlap")
+        self._bases = []    # first address of each pool, as an int
+        self._starts = []   # index of each pool's network address
+        self._ranges = []   # (first, last) index handed out in each pool
+        size = 0
+        for network in self.networks:
+            self._bases.append(int(network.network_address))
+            self._starts.append(size)
+            # Network address, .1 (the server) and broadcast are never handed out
+            self._ranges.append((size + 2, size + network.num_addresses - 2))
+            size += network.num_addresses
+        self._size = size
+        if self.network6 is not None and self.network6.num_addresses < size:
+            raise ValueError(f"{self.network6} is smaller than the IPv4 pools")
+        self._lock = threading.Lock()
+        self.load([])
+
+    def load(self, used_ips):
+        """Reset the allocator so that exactly used_ips are taken"""
+        with self._lock:
+            self._used = bytearray(self._size)
+            for ip in used_ips:
+                offset = self._offset(ip)
+                if offset is not None:
+                    self._used[offset] = 1
+            self._free = deque(
+                i for first, last in self._ranges for i in range(first, last + 1) if not self._used[i]
+            )
+            self._free_count = len(self._free)
+
+    def allocate(self):
+        """Take the next free address, or None if every pool is full"""
+        with self._lock:
+            while self._free:
+                offset = self._free.popleft()
+                if not self._used[offset]:
+                    self._used[offset] = 1
+                    self._free_count -= 1
+                    return self._address(offset)
+            return None
+
+    def release(self, ip):
+        """Return an address to the pool"""
+        offset = self._offset(ip)
+        if offset is None:
+            return False
+        with self._lock:
+            if not self._used[offset]:
+                return False
+            self._used[offset] = 0
+            self._free.append(offset)
+            self._free_count += 1
+            return True
+
+    def free_count(self):
+        return self._free_count
+
+    def ipv6_address(self, ip):
+        """The IPv6 address paired with IPv4 address ip, or None"""
+        offset = self._offset(ip)
+        if self.network6 is None or offset is None:
+            return None
+        return str(self.network6[offset])
+
+    def allowed_ips(self, ip):
+        """wg allowed-ips for the client at ip"""
+        ip6 = self.ipv6_address(ip)
+        return f"{ip}/32,{ip6}/128" if ip6 else f"{ip}/32"
+
+    def client_addresses(self, ip):
+        """Value of the client config's Address line"""
+        ip6 = self.ipv6_address(ip)
+        return f"{ip}/32, {ip6}/128" if ip6 else f"{ip}/32"
+
+    def describe(self):
+        return ', '.join(str(n) for n in self.networks + ([self.network6] if self.network6 else []))
+
+    def _address(self, offset):
+        pool = bisect.bisect_right(self._starts, offset) - 1
+        return str(ipaddress.IPv4Address(self._bases[pool] + offset - self._starts[pool]))
+
+    def _offset(self, ip):
+        try:
+            value = int(ipaddress.IPv4Address(ip))
+        except ValueError:
+            return None
+        pool = bisect.bisect_right(self._bases, value) - 1
+        if pool < 0:
+            return None
+        offset = self._starts[pool] + value - self._bases[pool]
+        first, last = self._ranges[pool]
+        if first <= offset <= last:
+            return offset
+        return None
+
+
+ip_allocator = IPAllocator(*parse_client_networks(CONFIG['client_networks']))
+
+
+# ============== METRICS ==============
+#
+# Prometheus text exposition at /metrics, without a client library. Values
+# are per process: under serve.py each scrape is answered by one worker.
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+AUTH_BUCKETS = (0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.001)
+
+def format_labels(names, values, extra=''):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Histogram:
+    """Cumulative histogram family, one series per tuple of label values"""
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}   # label values -> [per-bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def samples(self):
+        with self._lock:
+            snapshot = sorted((values, list(series)) for values, series in self._series.items())
+        for values, series in snapshot:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series[:-1]):
+                cumulative += count
+                le = f'le="{bound}"'
+                yield f'{self.name}_bucket{format_labels(self.labels, values, le)} {cumulative}'
+            yield f'{self.name}_sum{format_labels(self.labels, values)} {series[-1]}'
+            yield f'{self.name}_count{format_labels(self.labels, values)} {cumulative}'
+
+class Counter:
+    """Monotonic counter family"""
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        # Unlabelled counters are exported as 0 before the first inc()
+        self._values = {} if labels else {(): 0}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            snapshot = sorted(self._values.items())
+        for values, value in snapshot:
+            yield f'{self.name}{format_labels(self.labels, values)} {value}'
+
+class Collected:
+    """Gauge or counter read at scrape time from fn() -> [(label values, value)]"""
+
+    def __init__(self, name, help, kind, fn, labels=()):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.fn = fn
+        self.labels = labels
+
+    def samples(self):
+        for values, value in self.fn():
+            yield f'{self.name}{format_labels(self.labels, values)} {value}'
+
+class MetricsRegistry:
+    def __init__(self):
+        self.families = []
+
+    def add(self, family):
+        self.families.append(family)
+        return family
+
+    def render(self):
+        lines = []
+        for family in self.families:
+            try:
+                samples = list(family.samples())
+            except Exception as e:
+                print(f"Error collecting {family.name}: {e}")
+                continue
+            lines.append(f'# HELP {family.name} {family.help}')
+            lines.append(f'# TYPE {family.name} {family.kind}')
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n'
+
+class StageTimer:
+    """Times consecutive stages of one operation; mark() closes the current stage"""
+
+    def __init__(self, operation):
+        self.operation = operation
+        self._last = time.perf_counter()
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        STAGE_LATENCY.observe(now - self._last, self.operation, stage)
+        self._last = now
+
+
+metrics = MetricsRegistry()
+REQUEST_LATENCY = metrics.add(Histogram(
+    'truevault_request_duration_seconds', 'API request latency until the response is returned',
+    ('route', 'method', 'status')))
+STAGE_LATENCY = metrics.add(Histogram(
+    'truevault_stage_duration_seconds', 'Time spent in each stage of an operation', ('operation', 'stage')))
+AUTH_LATENCY = metrics.add(Histogram(
+    'truevault_auth_duration_seconds', 'Bearer token verification time', ('result',), AUTH_BUCKETS))
+SUBPROCESS_FAILURES = metrics.add(Counter(
+    'truevault_subprocess_failures_total', 'wg invocations that failed to start or exited non-zero', ('command',)))
+DB_LOCKED = metrics.add(Counter(
+    'truevault_db_locked_total', 'SQLite "database is locked" errors after the busy timeout'))
+DB_LOCK_WAIT = metrics.add(Histogram(
+    'truevault_db_lock_wait_seconds', 'Time to take the peers.db write lock', ('operation',)))
+GC_RUN_SECONDS = metrics.add(Histogram(
+    'truevault_gc_run_seconds', 'Duration of peer expiry runs'))
+GC_RECLAIMED = metrics.add(Counter(
+    'truevault_gc_reclaimed_peers_total', 'Idle peers expired and their IPs reclaimed'))
+RECONCILED = metrics.add(Counter(
+    'truevault_reconciled_peers_total', 'wg0 peers fixed up by the startup reconcile', ('action',)))
+
+
+# ============== DATABASE ==============
+
+# Statement text is kept constant so each pooled connection's statement
+# cache can reuse the compiled (prepared) statement across requests.
+# Keys are stored as raw 32-byte BLOBs (see key_blob / peer_row) and times
+# as unix seconds.
+SQL_ACTIVE_IPS = 'SELECT assigned_ip FROM peers WHERE is_active = 1'
+SQL_CLEAR_STALE_IP = 'DELETE FROM peers WHERE assigned_ip = ? AND is_active = 0'
+SQL_INSERT_PEER = '''
+    INSERT INTO peers (user_id, device_name, public_key, private_key, assigned_ip)
+    VALUES (?, ?, ?, ?, ?)
+'''
+SQL_ACTIVE_PEERS = 'SELECT public_key, assigned_ip FROM peers WHERE is_active = 1'
+SQL_PEER_IP = 'SELECT assigned_ip FROM peers WHERE public_key = ? AND is_active = 1'
+SQL_DEACTIVATE_PEER = 'UPDATE peers SET is_active = 0 WHERE public_key = ?'
+SQL_PEER_CONFIG = 'SELECT private_key, assigned_ip FROM peers WHERE public_key = ? AND is_active = 1'
+SQL_INSERT_LEASE = "INSERT INTO ip_leases (ip, pid, leased_at) VALUES (?, ?, strftime('%s', 'now'))"
+SQL_DELETE_LEASE = 'DELETE FROM ip_leases WHERE ip = ?'
+SQL_LEASED_IPS = 'SELECT ip FROM ip_leases'
+SQL_ACTIVE_PEER_COUNT = 'SELECT COUNT(*) FROM peers WHERE is_active = 1'
+SQL_CLAIM_IDEMPOTENCY = 'INSERT INTO idempotency_keys (key, fingerprint, created_at) VALUES (?, ?, ?)'
+SQL_GET_IDEMPOTENCY = 'SELECT fingerprint, status, response, created_at FROM idempotency_keys WHERE key = ?'
+SQL_RECLAIM_IDEMPOTENCY = '''
+    UPDATE idempotency_keys SET fingerprint = ?, created_at = ?, status = NULL, response = NULL WHERE key = ?
+'''
+SQL_COMPLETE_IDEMPOTENCY = 'UPDATE idempotency_keys SET status = ?, response = ? WHERE key = ?'
+SQL_ABANDON_IDEMPOTENCY = 'DELETE FROM idempotency_keys WHERE key = ? AND status IS NULL'
+SQL_PRUNE_IDEMPOTENCY = 'DELETE FROM idempotency_keys WHERE created_at < ?'
+SQL_INSERT_STATS_SNAPSHOT = 'INSERT OR REPLACE INTO peer_stats_snapshots (ts, changed, removed) VALUES (?, ?, ?)'
+SQL_PRUNE_STATS_SNAPSHOTS = '''
+    DELETE FROM peer_stats_snapshots WHERE ts < (
+        SELECT ts FROM peer_stats_snapshots ORDER BY ts DESC LIMIT 1 OFFSET ?
+    )
+'''
+SQL_STATS_SNAPSHOTS_SINCE = 'SELECT ts, changed, removed FROM peer_stats_snapshots WHERE ts > ? ORDER BY ts'
+SQL_STATS_SNAPSHOT_SPAN = 'SELECT COUNT(*), MIN(ts) FROM peer_stats_snapshots'
+SQL_SET_LAST_SAMPLE = 'INSERT OR REPLACE INTO peer_stats_state (id, last_sample) VALUES (1, ?)'
+SQL_GET_LAST_SAMPLE = 'SELECT last_sample FROM peer_stats_state WHERE id = 1'
+# Uses idx_peers_active_handshake; peers that never connected age from created_at
+SQL_EXPIRED_PEERS = '''
+    SELECT public_key, assigned_ip FROM peers
+    WHERE is_active = 1 AND (last_handshake < ? OR (last_handshake IS NULL AND created_at < ?))
+    LIMIT ?
+'''
+SQL_SET_HANDSHAKE = 'UPDATE peers SET last_handshake = ? WHERE public_key = ? AND is_active = 1'
+
+# PRAGMA user_version of peers.db; 0 is the original all-TEXT peers table
+SCHEMA_VERSION = 1
+SQL_CREATE_PEERS = '''
+    CREATE TABLE IF NOT EXISTS peers (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        device_name TEXT NOT NULL,
+        public_key BLOB NOT NULL UNIQUE,
+        private_key BLOB NOT NULL,
+        assigned_ip TEXT NOT NULL UNIQUE,
+        created_at INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+        last_handshake INTEGER,
+        is_active INTEGER NOT NULL DEFAULT 1
+    )
+'''
+
+
+class DBPool:
+    """
+    Pool of SQLite connections to peers.db.
+
+    Flask's threaded server starts a thread per request, so connections are
+    checked out for the duration of a request rather than pinned to a thread.
+    Each connection is opened once in WAL mode, which lets readers proceed
+    while a writer commits instead of colliding on the rollback journal.
+    """
+
+    def __init__(self, path, max_idle=32):
+        self.path = path
+        self._idle = queue.LifoQueue(maxsize=max_idle)
+        self._lock = threading.Lock()
+        self.opened = 0
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False, cached_statements=64)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA cache_size=-8000')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        with self._lock:
+            self.opened += 1
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection; use `with conn:` inside for a transaction"""
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._open()
+        try:
+            yield conn
+        except sqlite3.OperationalError as e:
+            if 'locked' in str(e):
+                DB_LOCKED.inc()
+            raise
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            try:
+                self._idle.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+    @contextmanager
+    def write(self, operation):
+        """
+        Check out a connection inside BEGIN IMMEDIATE and commit on success.
+        The wait for the write lock is observed as DB_LOCK_WAIT{operation}.
+        """
+        with self.connection() as conn:
+            start = time.perf_counter()
+            conn.execute('BEGIN IMMEDIATE')
+            DB_LOCK_WAIT.observe(time.perf_counter() - start, operation)
+            yield conn
+            conn.commit()
+
+    def idle_count(self):
+        return self._idle.qsize()
+
+    def close_all(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+db_pool = DBPool(CONFIG['db_path'])
+
+
+class LeasedIPAllocator(IPAllocator):
+    """
+    IPAllocator for multi-process servers (serve.py).
+
+    The ip_leases table is the source of truth: an address is only handed
+    out once this process inserts its lease inside BEGIN IMMEDIATE, which
+    serializes allocation across workers. The inherited bitmap is a local
+    cache of taken addresses; a lease conflict just marks the address taken
+    locally, and the cache is resynced from ip_leases when it runs dry.
+    """
+
+    def allocate(self):
+        with db_pool.connection() as conn:
+            start = time.perf_counter()
+            conn.execute('BEGIN IMMEDIATE')
+            DB_LOCK_WAIT.observe(time.perf_counter() - start, 'lease')
+            try:
+                for attempt in range(2):
+                    while True:
+                        ip = super().allocate()
+                        if ip is None:
+                            break
+                        try:
+                            conn.execute(SQL_INSERT_LEASE, (ip, os.getpid()))
+                        except sqlite3.IntegrityError:
+                            continue  # leased by another worker
+                        conn.commit()
+                        return ip
+                    if attempt == 0:
+                        self.load(row[0] for row in conn.execute(SQL_LEASED_IPS))
+                conn.rollback()
+                return None
+            except Exception:
+                conn.rollback()
+                raise
+
+    def release(self, ip):
+        with db_pool.connection() as conn, conn:
+            conn.execute(SQL_DELETE_LEASE, (ip,))
+        return super().release(ip)
+
+    def resync(self):
+        """Reload the local cache from ip_leases"""
+        with db_pool.connection() as conn:
+            self.load(row[0] for row in conn.execute(SQL_LEASED_IPS))
+
+    @staticmethod
+    def sync_leases(conn, pid=None):
+        """
+        Make sure every active peer holds a lease and drop leases nobody holds:
+        all of them at startup (pid=None), or those of one dead worker.
+        """
+        with conn:
+            conn.execute('''
+                INSERT OR IGNORE INTO ip_leases (ip, pid, leased_at)
+                SELECT assigned_ip, 0, strftime('%s', 'now') FROM peers WHERE is_active = 1
+            ''')
+            orphaned = 'ip NOT IN (SELECT assigned_ip FROM peers WHERE is_active = 1)'
+            if pid is None:
+                conn.execute(f'DELETE FROM ip_leases WHERE {orphaned}')
+            else:
+                conn.execute(f'DELETE FROM ip_leases WHERE pid = ? AND {orphaned}', (pid,))
+
+
+def use_ip_leases():
+    """Switch this process to DB-leased IP allocation (call before init_db)"""
+    global ip_allocator
+    ip_allocator = LeasedIPAllocator(ip_allocator.networks, ip_allocator.network6)
+    peer_reservoir.allocator = ip_allocator
+
+
+# ============== KEYS AT REST ==============
+
+def key_blob(key):
+    """base64 WireGuard key -> the 32 bytes stored in peers.db (None if malformed)"""
+    try:
+        raw = base64.b64decode(key, validate=True)
+    except (ValueError, TypeError):
+        return None
+    return raw if len(raw) == 32 else None
+
+def key_text(blob):
+    return base64.b64encode(blob).decode()
+
+
+class PrivateKeyBox:
+    """
+    Encryption of client private keys in peers.db.
+
+    A random 32-byte node key is created at path (mode 0600) on first use
+    and never stored in the database, so a copy of peers.db alone doesn't
+    reveal client keys. Sealed values start with a scheme byte: 1 = AES-256-GCM
+    (cryptography), 2 = XSalsa20-Poly1305 (pynacl), 0 = not encrypted
+    (neither library installed). Only get-config opens a sealed key.
+    """
+
+    PLAIN, AESGCM_V1, SECRETBOX_V1 = 0, 1, 2
+
+    def __init__(self, path):
+        self.path = path
+        self.scheme = self.AESGCM_V1 if AESGCM else self.SECRETBOX_V1 if SecretBox else self.PLAIN
+        self._ciphers = {}
+        self._lock = threading.Lock()
+
+    def load(self, create=True):
+        """
+        Read or create the node key now, so serve.py workers inherit it.
+        With create=False a missing key is fatal: peers.db already holds
+        values sealed with it, and a new key would make them unreadable.
+        """
+        if not create and not os.path.exists(self.path):
+            raise RuntimeError(f"{self.path} is missing but peers.db holds private keys sealed with it; "
+                               "restore the node key (or point NODE_KEY_PATH at it) before starting")
+        if self.scheme == self.PLAIN:
+            print("WARNING: neither cryptography nor pynacl is installed; private keys are stored unencrypted")
+            return
+        self._cipher(self.scheme)
+
+    def _read_node_key(self):
+        try:
+            fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            with open(self.path, 'rb') as f:
+                key = f.read()
+            if len(key) != 32:
+                raise ValueError(f"{self.path} is not a 32-byte node key")
+            return key
+        key = os.urandom(32)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(key)
+        print(f"Created node key {self.path}")
+        return key
+
+    def _cipher(self, scheme):
+        with self._lock:
+            cipher = self._ciphers.get(scheme)
+            if cipher is None:
+                if scheme == self.AESGCM_V1 and AESGCM:
+                    cipher = AESGCM(self._read_node_key())
+                elif scheme == self.SECRETBOX_V1 and SecretBox:
+                    cipher = SecretBox(self._read_node_key())
+                else:
+                    raise ValueError(f"No backend installed for key scheme {scheme}")
+                self._ciphers[scheme] = cipher
+            return cipher
+
+    def seal(self, data):
+        if self.scheme == self.AESGCM_V1:
+            nonce = os.urandom(12)
+            return bytes((self.scheme,)) + nonce + self._cipher(self.scheme).encrypt(nonce, data, None)
+        if self.scheme == self.SECRETBOX_V1:
+            return bytes((self.scheme,)) + bytes(self._cipher(self.scheme).encrypt(data))
+        return bytes((self.PLAIN,)) + data
+
+    def open(self, sealed):
+        """Unseal a value; ValueError if it can't be (wrong node key, missing backend)"""
+        scheme, body = sealed[0], sealed[1:]
+        if scheme == self.PLAIN:
+            return body
+        try:
+            if scheme == self.AESGCM_V1:
+                return self._cipher(scheme).decrypt(body[:12], body[12:], None)
+            return self._cipher(scheme).decrypt(body)
+        except ValueError:
+            raise
+        except Exception as e:
+            # cryptography raises InvalidTag, pynacl CryptoError
+            raise ValueError(f"Sealed value doesn't open with {self.path} ({type(e).__name__})")
+
+    def seal_private_key(self, private_key):
+        return self.seal(base64.b64decode(private_key))
+
+    def open_private_key(self, sealed):
+        return key_text(self.open(sealed))
+
+
+private_key_box = PrivateKeyBox(
+    CONFIG['node_key_path'] or os.path.join(os.path.dirname(CONFIG['db_path']) or '.', 'node.key')
+)
+
+def peer_row(user_id, device_name, public_key, private_key, assigned_ip):
+    """SQL_INSERT_PEER parameters: keys as BLOBs, the private key sealed"""
+    return (user_id, device_name, key_blob(public_key), private_key_box.seal_private_key(private_key), assigned_ip)
+
+
+def holds_sealed_values(conn):
+    """True if peers.db (schema v1+) has values sealed with the node key"""
+    if conn.execute('PRAGMA user_version').fetchone()[0] < 1:
+        return False
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    queries = []
+    if 'peers' in tables:
+        queries.append("SELECT 1 FROM peers WHERE substr(private_key, 1, 1) != x'00'")
+    if 'idempotency_keys' in tables:
+        queries.append("SELECT 1 FROM idempotency_keys WHERE substr(response, 1, 1) != x'00'")
+    return any(conn.execute(f'{sql} LIMIT 1').fetchone() for sql in queries)
+
+def init_db(sync_leases=True):
+    """
+    Initialize local peer tracking database. sync_leases=False keeps
+    ip_leases as they are, for a serve.py reload whose old workers still
+    hold leases.
+    """
+    with db_pool.connection() as conn:
+        private_key_box.load(create=not holds_sealed_values(conn))
+        init_schema(conn)
+        
+        # Load active addresses into the in-memory allocator
+        if isinstance(ip_allocator, LeasedIPAllocator):
+            if sync_leases:
+                LeasedIPAllocator.sync_leases(conn)
+            ip_allocator.load(row[0] for row in conn.execute(SQL_LEASED_IPS))
+        else:
+            ip_allocator.load(row[0] for row in conn.execute(SQL_ACTIVE_IPS))
+    print(f"Database initialized at {CONFIG['db_path']}")
+
+def init_schema(conn):
+    """Create the peers table and its indexes, migrating an older peers.db first"""
+    migrate_schema(conn)
+    with conn:
+        conn.execute(SQL_CREATE_PEERS)
+        conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        # public_key is UNIQUE (implicitly indexed); the composite index covers
+        # the "WHERE public_key = ? AND is_active = 1" lookups without a row fetch
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_peers_active ON peers (is_active)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_peers_public_key_active ON peers (public_key, is_active)')
+        # Stale-peer queries: WHERE is_active = 1 AND last_handshake < ?
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_peers_active_handshake ON peers (is_active, last_handshake)')
+        # Cross-process IP reservations, used by serve.py workers
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS ip_leases (
+                ip TEXT PRIMARY KEY,
+                pid INTEGER NOT NULL,
+                leased_at INTEGER NOT NULL
+            )
+        ''')
+        # create-peer Idempotency-Key claims and stored responses
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS idempotency_keys (
+                key TEXT PRIMARY KEY,
+                fingerprint TEXT NOT NULL,
+                created_at INTEGER NOT NULL,
+                status INTEGER,
+                response BLOB
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_idempotency_created ON idempotency_keys (created_at)')
+        # Latest /api/peer-stats snapshots, handed from the sampling serve.py worker to the others
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS peer_stats_snapshots (
+                ts REAL PRIMARY KEY,
+                changed TEXT NOT NULL,
+                removed TEXT NOT NULL
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS peer_stats_state (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                last_sample REAL
+            )
+        ''')
+
+def migrate_schema(conn):
+    """
+    Rewrite a version 0 peers.db (base64 TEXT keys, private keys in the
+    clear, DATETIME strings) to SCHEMA_VERSION in place. The rewrite is one
+    transaction, so a failure leaves the database as it was. The old file
+    is also copied to <db_path>.pre-v1 (mode 0600); that copy holds every
+    private key in the clear, so it is deleted afterwards unless
+    KEEP_MIGRATION_BACKUP is set.
+    """
+    if conn.execute('PRAGMA user_version').fetchone()[0] >= SCHEMA_VERSION:
+        return
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    if 'peers' not in tables:
+        return
+    
+    start = time.perf_counter()
+    backup_path = f"{db_pool.path}.pre-v1"
+    # Created 0600 before SQLite opens it; SQLite keeps an existing file's mode
+    os.close(os.open(backup_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600))
+    os.chmod(backup_path, 0o600)
+    backup = sqlite3.connect(backup_path)
+    try:
+        conn.backup(backup)
+    finally:
+        backup.close()
+    try:
+        _migrate_to_v1(conn, tables, start)
+    finally:
+        if CONFIG['keep_migration_backup']:
+            print(f"WARNING: {backup_path} holds every private key unencrypted; delete it once the migration is verified")
+        else:
+            os.remove(backup_path)
+
+def _migrate_to_v1(conn, tables, start):
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute('ALTER TABLE peers RENAME TO peers_v0')
+        conn.execute(SQL_CREATE_PEERS)
+        rows = []
+        for row in conn.execute('''
+            SELECT id, user_id, device_name, public_key, private_key, assigned_ip,
+                   CAST(strftime('%s', created_at) AS INTEGER),
+                   CAST(strftime('%s', last_handshake) AS INTEGER), is_active
+            FROM peers_v0
+        '''):
+            peer_id, user_id, device_name, public_key, private_key, assigned_ip, created_at, last_handshake, is_active = row
+            public_blob, private_blob = key_blob(public_key), key_blob(private_key)
+            if public_blob is None or private_blob is None:
+                raise ValueError(f"peer {peer_id} has a malformed key")
+            rows.append((
+                peer_id, user_id, device_name, public_blob, private_key_box.seal(private_blob), assigned_ip,
+                created_at or int(time.time()), last_handshake, 1 if is_active else 0
+            ))
+        conn.executemany('''
+            INSERT INTO peers (id, user_id, device_name, public_key, private_key, assigned_ip,
+                               created_at, last_handshake, is_active)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+        # The old indexes go with it and are recreated on the new table
+        conn.execute('DROP TABLE peers_v0')
+        
+        # Stored create-peer responses contain private keys too
+        if 'idempotency_keys' in tables:
+            stored = conn.execute('SELECT key, response FROM idempotency_keys WHERE response IS NOT NULL').fetchall()
+            conn.executemany(
+                'UPDATE idempotency_keys SET response = ? WHERE key = ?',
+                [(private_key_box.seal(response.encode()), key) for key, response in stored]
+            )
+        conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        print(f"Migrating peers.db failed, left unchanged: {e}")
+        raise
+    # Don't leave the plaintext pages behind in free pages or the WAL
+    conn.execute('VACUUM')
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    print(f"Migrated {len(rows)} peers to schema version {SCHEMA_VERSION} in {time.perf_counter() - start:.2f}s")
+
+def verify_auth(req, static_only=False):
+    """Verify API authentication via Bearer token (API secret or signed token)"""
+    return authenticator.verify(req.headers.get('Authorization', ''), static_only)
+
+def get_next_ip():
+    """Get next available IP address in subnet"""
+    return ip_allocator.allocate()
+
+def clamp_private_key(raw):
+    """Clamp 32 random bytes into a Curve25519 scalar, as `wg genkey` does"""
+    key = bytearray(raw)
+    key[0] &= 248
+    key[31] = (key[31] & 127) | 64
+    return bytes(key)
+
+def derive_public_key(private_raw):
+    """Derive the raw 32-byte X25519 public key for a raw private key"""
+    if KEYGEN_BACKEND == 'cryptography':
+        return X25519PrivateKey.from_private_bytes(private_raw).public_key().public_bytes(
+            Encoding.Raw, PublicFormat.Raw)
+    return bytes(NaClPrivateKey(private_raw).public_key)
+
+def generate_keypair():
+    """Generate WireGuard keypair (base64 private, base64 public)"""
+    if KEYGEN_BACKEND != 'wg':
+        try:
+            private_raw = clamp_private_key(os.urandom(32))
+            public_raw = derive_public_key(private_raw)
+            return base64.b64encode(private_raw).decode(), base64.b64encode(public_raw).decode()
+        except Exception as e:
+            print(f"Error generating keypair with {KEYGEN_BACKEND}: {e}")
+            return None, None
+    return generate_keypair_wg()
+
+def generate_keypair_wg():
+    """Generate WireGuard keypair using wg commands"""
+    try:
+        # Generate private key
+        result = subprocess.run(['wg', 'genkey'], capture_output=True, text=True, check=True)
+        private_key = result.stdout.strip()
+        
+        # Derive public key from private key
+        result = subprocess.run(['wg', 'pubkey'], input=private_key, capture_output=True, text=True, check=True)
+        public_key = result.stdout.strip()
+        
+        return private_key, public_key
+    except subprocess.CalledProcessError as e:
+        SUBPROCESS_FAILURES.inc(e.cmd[1])
+        print(f"Error generating keypair: {e}")
+        return None, None
+
+def read_server_public_key():
+    """Read this server's WireGuard public key from wg0 (or the key file)"""
+    public_key = wg_control.public_key()
+    if public_key:
+        return public_key
+    # Try reading from file
+    try:
+        with open(CONFIG['server_key_path'], 'r') as f:
+            return f.read().strip()
+    except:
+        return None
+
+class ServerIdentity:
+    """
+    Cached server public key.
+
+    Loaded once, then re-read only when the key file's mtime changes or
+    invalidate() is called (SIGHUP). A missing key is retried on next use.
+    """
+
+    def __init__(self, key_path):
+        self.key_path = key_path
+        self._lock = threading.Lock()
+        self._public_key = None
+        self._mtime = None
+
+    def _key_mtime(self):
+        try:
+            return os.stat(self.key_path).st_mtime_ns
+        except OSError:
+            return None
+
+    def public_key(self):
+        mtime = self._key_mtime()
+        if self._public_key is None or mtime != self._mtime:
+            with self._lock:
+                if self._public_key is None or mtime != self._mtime:
+                    self._public_key = read_server_public_key()
+                    self._mtime = mtime
+        return self._public_key
+
+    def invalidate(self):
+        with self._lock:
+            self._public_key = None
+
+
+server_identity = ServerIdentity(CONFIG['server_key_path'])
+
+def get_server_public_key():
+    """Get this server's WireGuard public key"""
+    return server_identity.public_key()
+
+PEER_FIELDS = ('public_key', 'preshared_key', 'endpoint', 'allowed_ips',
+               'last_handshake', 'transfer_rx', 'transfer_tx')
+
+def parse_dump_line(line):
+    """Parse one peer line of `wg show wg0 dump` into a dict, or None"""
+    parts = line.rstrip('\n').split('\t')
+    if len(parts) < 4:
+        return None
+    return {
+        'public_key': parts[0],
+        'preshared_key': parts[1] if parts[1] != '(none)' else None,
+        'endpoint': parts[2] if parts[2] != '(none)' else None,
+        'allowed_ips': parts[3],
+        'last_handshake': int(parts[4]) if len(parts) > 4 and parts[4] != '0' else None,
+        'transfer_rx': int(parts[5]) if len(parts) > 5 else 0,
+        'transfer_tx': int(parts[6]) if len(parts) > 6 else 0
+    }
+
+
+# ============== WIREGUARD CONTROL ==============
+#
+# Every wg0 operation goes through `wg_control`, picked by WG_BACKEND:
+#   cli     - fork/exec the `wg` tool per call (original behaviour)
+#   netlink - talk to the kernel over generic netlink in-process (pyroute2)
+#   fake    - in-memory wg0, for running the API without the kernel module
+#   auto    - netlink if pyroute2 is installed, else cli (default)
+#
+# Backends share one interface: add_peers, remove_peers, is_up, public_key
+# and open_dump. Peers are added as (public_key, allowed_ips), allowed_ips in
+# wg's comma-separated form (IPAllocator.allowed_ips). open_dump() returns
+# an iterable of peer dicts (PEER_FIELDS) whose close() returns True if the
+# whole dump was read successfully.
+
+class PeerDump:
+    """A dump that was read in full up front"""
+
+    def __init__(self, peers):
+        self.peers = peers
+
+    def __iter__(self):
+        return iter(self.peers)
+
+    def close(self):
+        return True
+
+
+class CliPeerDump:
+    """Peers streamed line by line from a running `wg show <iface> dump`"""
+
+    def __init__(self, interface):
+        self.proc = subprocess.Popen(['wg', 'show', interface, 'dump'], stdout=subprocess.PIPE,
+                                     stderr=subprocess.DEVNULL, text=True, bufsize=65536)
+
+    def __iter__(self):
+        # First line is server info, rest are peers
+        self.proc.stdout.readline()
+        for line in self.proc.stdout:
+            peer = parse_dump_line(line)
+            if peer:
+                yield peer
+
+    def close(self):
+        """
+        Reap the dump process, killing it if the reader stopped early (a full
+        page). Only a non-zero exit of its own counts as a failed dump.
+        """
+        killed = self.proc.poll() is None
+        if killed:
+            self.proc.kill()
+        self.proc.stdout.close()
+        returncode = self.proc.wait()
+        if killed:
+            return True
+        if returncode != 0:
+            SUBPROCESS_FAILURES.inc('show')
+        return returncode == 0
+
+
+class WgCliBackend:
+    """wg0 through the `wg` command line tool - one fork/exec per call"""
+    name = 'cli'
+
+    def __init__(self, interface='wg0'):
+        self.interface = interface
+
+    def _run(self, args, input=None):
+        try:
+            result = subprocess.run(['wg', *args], input=input, capture_output=True, text=True)
+        except OSError:
+            SUBPROCESS_FAILURES.inc(args[0])
+            raise
+        if result.returncode != 0:
+            SUBPROCESS_FAILURES.inc(args[0])
+        return result
+
+    def add_peers(self, peers):
+        """Add (public_key, allowed_ips) peers in one `wg addconf`"""
+        conf = ''.join(
+            f"[Peer]\nPublicKey = {public_key}\nAllowedIPs = {allowed_ips}\n\n"
+            for public_key, allowed_ips in peers
+        )
+        try:
+            result = self._run(['addconf', self.interface, '/dev/stdin'], input=conf)
+            if result.returncode != 0:
+                print(f"Error adding peers: {result.stderr}")
+            return result.returncode == 0
+        except Exception as e:
+            print(f"Exception adding peers: {e}")
+            return False
+
+    def add_peer(self, public_key, allowed_ips):
+        try:
+            result = self._run(['set', self.interface, 'peer', public_key, 'allowed-ips', allowed_ips])
+            if result.returncode != 0:
+                print(f"Error adding peer: {result.stderr}")
+            return result.returncode == 0
+        except Exception as e:
+            print(f"Exception adding peer: {e}")
+            return False
+
+    def remove_peers(self, public_keys):
+        """Remove peers in one `wg set`"""
+        args = ['set', self.interface]
+        for public_key in public_keys:
+            args += ['peer', public_key, 'remove']
+        try:
+            return self._run(args).returncode == 0
+        except Exception as e:
+            print(f"Exception removing peers: {e}")
+            return False
+
+    def is_up(self):
+        try:
+            return self._run(['show', self.interface]).returncode == 0
+        except OSError:
+            return False
+
+    def public_key(self):
+        try:
+            result = self._run(['show', self.interface, 'public-key'])
+        except OSError:
+            return None
+        if result.returncode != 0:
+            return None
+        return result.stdout.strip() or None
+
+    def open_dump(self):
+        return CliPeerDump(self.interface)
+
+
+def wg_key(value):
+    """pyroute2 hands keys back as base64 (bytes or str) or raw 32 bytes"""
+    if isinstance(value, (bytes, bytearray)):
+        if len(value) == 32:
+            return base64.b64encode(value).decode()
+        return value.decode()
+    return value
+
+
+class WgNetlinkBackend:
+    """
+    wg0 over the WireGuard generic-netlink family, in-process (pyroute2).
+
+    One netlink socket per process, opened lazily so it is never shared
+    across serve.py's fork; calls are serialized because the socket isn't
+    thread-safe. Each call is a request/response on that socket - no fork.
+    Bulk adds and removes go out as one WG_CMD_SET_DEVICE per chunk of
+    peers, like `wg addconf`, rather than pyroute2's one-peer set().
+    """
+    name = 'netlink'
+    # ~120 bytes per peer with a v4 + v6 allowed-ip: keeps each message
+    # under the 8 KiB that `wg` itself sends
+    PEERS_PER_MESSAGE = 64
+
+    def __init__(self, interface='wg0'):
+        self.interface = interface
+        self._lock = threading.Lock()
+        self._sock = None
+        self._pid = None
+
+    def _socket(self):
+        if self._sock is None or self._pid != os.getpid():
+            self._sock = NetlinkWireGuard()
+            self._pid = os.getpid()
+        return self._sock
+
+    def _reset(self):
+        try:
+            self._sock.close()
+        except Exception:
+            pass
+        self._sock = None
+
+    @staticmethod
+    def _peer_attrs(public_key, allowed_ips=None):
+        """WGDEVICE_A_PEERS entry adding public_key, or removing it if allowed_ips is None"""
+        if allowed_ips is None:
+            return {'attrs': [['WGPEER_A_PUBLIC_KEY', public_key], ['WGPEER_A_FLAGS', WGPEER_F_REMOVE_ME]]}
+        entries = []
+        for spec in allowed_ips.split(','):
+            network = ipaddress.ip_network(spec.strip(), strict=False)
+            entries.append({'attrs': [
+                ['WGALLOWEDIP_A_FAMILY', socket.AF_INET if network.version == 4 else socket.AF_INET6],
+                ['WGALLOWEDIP_A_IPADDR', network.network_address.packed],
+                ['WGALLOWEDIP_A_CIDR_MASK', network.prefixlen],
+            ]})
+        return {'attrs': [['WGPEER_A_PUBLIC_KEY', public_key], ['WGPEER_A_ALLOWEDIPS', entries]]}
+
+    def _set_message(self, peers):
+        msg = wgmsg()
+        msg['cmd'] = WG_CMD_SET_DEVICE
+        msg['version'] = WG_GENL_VERSION
+        msg['attrs'] = [['WGDEVICE_A_IFNAME', self.interface], ['WGDEVICE_A_PEERS', peers]]
+        return msg
+
+    def _set(self, peers, action):
+        with self._lock:
+            try:
+                sock = self._socket()
+                for i in range(0, len(peers), self.PEERS_PER_MESSAGE):
+                    msg = self._set_message(peers[i:i + self.PEERS_PER_MESSAGE])
+                    sock.nlm_request(msg, msg_type=sock.prid, msg_flags=NLM_F_REQUEST | NLM_F_ACK)
+                return True
+            except Exception as e:
+                print(f"Exception {action}: {e}")
+                self._reset()
+                return False
+
+    def _info(self):
+        with self._lock:
+            try:
+                # Large peer lists come back split over several messages
+                return list(self._socket().info(self.interface))
+            except Exception:
+                self._reset()
+                raise
+
+    def add_peers(self, peers):
+        return self._set([self._peer_attrs(public_key, allowed_ips) for public_key, allowed_ips in peers], 'adding peers')
+
+    def add_peer(self, public_key, allowed_ips):
+        return self.add_peers([(public_key, allowed_ips)])
+
+    def remove_peers(self, public_keys):
+        return self._set([self._peer_attrs(public_key) for public_key in public_keys], 'removing peers')
+
+    def is_up(self):
+        try:
+            self._info()
+            return True
+        except Exception:
+            return False
+
+    def public_key(self):
+        try:
+            for msg in self._info():
+                key = msg.get_attr('WGDEVICE_A_PUBLIC_KEY')
+                if key:
+                    return wg_key(key)
+        except Exception as e:
+            print(f"Error reading public key over netlink: {e}")
+        return None
+
+    @staticmethod
+    def _allowed_ips(peer):
+        ips = []
+        for entry in peer.get_attr('WGPEER_A_ALLOWEDIPS') or []:
+            # Decoded entries carry 'addr' ('10.8.0.2/32'); the raw IPADDR
+            # attribute is pyroute2's 'hex' string ('0a:08:00:02')
+            if entry.get('addr'):
+                ips.append(entry['addr'])
+                continue
+            addr = entry.get_attr('WGALLOWEDIP_A_IPADDR')
+            if isinstance(addr, str):
+                addr = bytes.fromhex(addr.replace(':', ''))
+            ips.append(f"{ipaddress.ip_address(bytes(addr))}/{entry.get_attr('WGALLOWEDIP_A_CIDR_MASK')}")
+        return ','.join(ips) or '(none)'
+
+    @classmethod
+    def _peer_dict(cls, peer):
+        endpoint = peer.get_attr('WGPEER_A_ENDPOINT')
+        if isinstance(endpoint, dict) and endpoint.get('addr'):
+            endpoint = f"{endpoint['addr']}:{endpoint['port']}"
+        handshake = peer.get_attr('WGPEER_A_LAST_HANDSHAKE_TIME')
+        if isinstance(handshake, dict):
+            handshake = handshake.get('tv_sec')
+        preshared_key = wg_key(peer.get_attr('WGPEER_A_PRESHARED_KEY'))
+        return {
+            'public_key': wg_key(peer.get_attr('WGPEER_A_PUBLIC_KEY')),
+            'preshared_key': preshared_key if preshared_key and preshared_key != 'A' * 43 + '=' else None,
+            'endpoint': endpoint or None,
+            'allowed_ips': cls._allowed_ips(peer),
+            'last_handshake': handshake or None,
+            'transfer_rx': peer.get_attr('WGPEER_A_RX_BYTES') or 0,
+            'transfer_tx': peer.get_attr('WGPEER_A_TX_BYTES') or 0
+        }
+
+    def open_dump(self):
+        return PeerDump([
+            self._peer_dict(peer)
+            for msg in self._info()
+            for peer in msg.get_attr('WGDEVICE_A_PEERS') or []
+        ])
+
+
+class FakeWireGuard:
+    """
+    In-memory wg0 for running the API and benchmarks without the kernel
+    module. State is per process. Rejects malformed keys like `wg` does;
+    simulate_traffic() moves a peer's counters for /api/peer-stats.
+    """
+    name = 'fake'
+
+    def __init__(self, interface='wg0'):
+        self.interface = interface
+        self._lock = threading.Lock()
+        self._peers = OrderedDict()
+        self._public_key = None
+
+    @staticmethod
+    def _valid_key(public_key):
+        try:
+            return len(base64.b64decode(public_key, validate=True)) == 32
+        except (ValueError, TypeError):
+            return False
+
+    def add_peers(self, peers):
+        peers = list(peers)
+        bad = [public_key for public_key, _ in peers if not self._valid_key(public_key)]
+        if bad:
+            print(f"Error adding peers: invalid key {bad[0]!r}")
+            return False
+        with self._lock:
+            for public_key, allowed_ips in peers:
+                peer = self._peers.get(public_key)
+                if peer is None:
+                    self._peers[public_key] = {
+                        'public_key': public_key, 'preshared_key': None, 'endpoint': None,
+                        'allowed_ips': allowed_ips, 'last_handshake': None,
+                        'transfer_rx': 0, 'transfer_tx': 0
+                    }
+                else:
+                    peer['allowed_ips'] = allowed_ips
+        return True
+
+    def add_peer(self, public_key, allowed_ips):
+        return self.add_peers([(public_key, allowed_ips)])
+
+    def remove_peers(self, public_keys):
+        public_keys = list(public_keys)
+        if not all(self._valid_key(public_key) for public_key in public_keys):
+            return False
+        with self._lock:
+            for public_key in public_keys:
+                self._peers.pop(public_key, None)
+        return True
+
+    def simulate_traffic(self, public_key, rx=0, tx=0, handshake=None):
+        with self._lock:
+            peer = self._peers[public_key]
+            peer['transfer_rx'] += rx
+            peer['transfer_tx'] += tx
+            peer['last_handshake'] = handshake or int(time.time())
+
+    def is_up(self):
+        return True
+
+    def public_key(self):
+        with self._lock:
+            if self._public_key is None:
+                self._public_key = generate_keypair()[1]
+            return self._public_key
+
+    def open_dump(self):
+        with self._lock:
+            return PeerDump([dict(peer) for peer in self._peers.values()])
+
+
+WG_BACKENDS = {'cli': WgCliBackend, 'netlink': WgNetlinkBackend, 'fake': FakeWireGuard}
+
+def make_wg_backend(name):
+    """Build the WireGuard control backend named by WG_BACKEND"""
+    if name == 'auto':
+        name = 'netlink' if NetlinkWireGuard is not None else 'cli'
+    if name not in WG_BACKENDS:
+        raise ValueError(f"Unknown WG_BACKEND {name!r} (expected auto, {', '.join(WG_BACKENDS)})")
+    if name == 'netlink' and NetlinkWireGuard is None:
+        raise RuntimeError("WG_BACKEND=netlink needs pyroute2 (pip install pyroute2)")
+    return WG_BACKENDS[name]()
+
+
+wg_control = make_wg_backend(CONFIG['wg_backend'])
+
+def add_peer_to_wireguard(public_key, assigned_ip):
+    """Add peer to WireGuard interface"""
+    allowed_ips = ip_allocator.allowed_ips(assigned_ip)
+    return health_monitor.record('add_peer', wg_control.add_peer(public_key, allowed_ips))
+
+def add_peers_to_wireguard(peers):
+    """Add many (public_key, assigned_ip) peers to WireGuard in one call"""
+    peers = [(public_key, ip_allocator.allowed_ips(assigned_ip)) for public_key, assigned_ip in peers]
+    return health_monitor.record('add_peers', wg_control.add_peers(peers))
+
+def remove_peer_from_wireguard(public_key):
+    """Remove peer from WireGuard interface"""
+    return health_monitor.record('remove_peers', wg_control.remove_peers([public_key]))
+
+def remove_peers_from_wireguard(public_keys):
+    """Remove many peers from WireGuard in one call"""
+    return health_monitor.record('remove_peers', wg_control.remove_peers(public_keys))
+
+PAGE_FULL = object()
+
+class PeerListQuery:
+    """
+    Parsed /api/list-peers query string: filters, field projection and
+    cursor pagination, applied to peers one at a time in dump order.
+    Raises ValueError with a client-facing message on bad input.
+    """
+
+    def __init__(self, args):
+        try:
+            self.limit = int(args['limit']) if args.get('limit') else None
+            self.active_since = int(args['active_since']) if args.get('active_since') else None
+            self.min_rx = int(args.get('min_rx', 0))
+            self.min_tx = int(args.get('min_tx', 0))
+        except ValueError:
+            raise ValueError('limit, active_since, min_rx and min_tx must be integers')
+        if self.limit is not None and self.limit < 1:
+            raise ValueError('limit must be positive')
+        self.cursor = args.get('cursor')
+        self.allowed_ip = None
+        if args.get('allowed_ip'):
+            try:
+                self.allowed_ip = ipaddress.ip_network(args['allowed_ip'], strict=False)
+            except ValueError:
+                raise ValueError('allowed_ip must be an address or network, e.g. 10.8.0.0/24')
+        self.fields = [f for f in args.get('fields', '').split(',') if f]
+        if any(f not in PEER_FIELDS for f in self.fields):
+            raise ValueError(f"fields must be from {', '.join(PEER_FIELDS)}")
+        
+        self.count = 0
+        self.next_cursor = None
+        self._last_key = None
+
+    def allowed_ip_matches(self, allowed_ips):
+        for part in split_allowed_ips(allowed_ips):
+            try:
+                network = ipaddress.ip_network(part, strict=False)
+            except ValueError:
+                continue
+            if network.version == self.allowed_ip.version and network.subnet_of(self.allowed_ip):
+                return True
+        return False
+
+    def matches(self, peer):
+        if self.active_since is not None and (peer['last_handshake'] or 0) < self.active_since:
+            return False
+        if peer['transfer_rx'] < self.min_rx or peer['transfer_tx'] < self.min_tx:
+            return False
+        if self.allowed_ip and not self.allowed_ip_matches(peer['allowed_ips']):
+            return False
+        return True
+
+    def skip_to_cursor(self, peers):
+        """
+        Advance the peers iterator past the cursor peer. False if the dump
+        ended first (the peer was removed since the previous page).
+        """
+        if self.cursor is None:
+            return True
+        for peer in peers:
+            if peer['public_key'] == self.cursor:
+                return True
+        return False
+
+    def feed(self, peer):
+        """Next peer in dump order -> projected dict to emit, None to skip, or PAGE_FULL"""
+        if not self.matches(peer):
+            return None
+        if self.limit is not None and self.count == self.limit:
+            self.next_cursor = self._last_key
+            return PAGE_FULL
+        self._last_key = peer['public_key']
+        if self.fields:
+            return {f: peer[f] for f in self.fields}
+        return peer
+
+    def header(self):
+        return '{"peers": ['
+
+    def encode(self, peer):
+        chunk = (',' if self.count else '') + json.dumps(peer)
+        self.count += 1
+        return chunk
+
+    def footer(self, dump_ok):
+        success = self.next_cursor is not None or dump_ok
+        return '], ' + json.dumps({'peer_count': self.count, 'next_cursor': self.next_cursor, 'success': success})[1:]
+
+def compile_config_template():
+    """Bake the static (CONFIG-derived) parts of the client config into a format string"""
+    def static(value):
+        return str(value).replace('{', '{{').replace('}', '}}')
+    
+    return (
+        "[Interface]\n"
+        "PrivateKey = {private_key}\n"
+        "Address = {address}\n"
+        f"DNS = {static(CONFIG['dns_servers'])}\n"
+        "\n"
+        "[Peer]\n"
+        "PublicKey = {server_public_key}\n"
+        f"Endpoint = {static(CONFIG['server_ip'])}:{static(CONFIG['server_port'])}\n"
+        "AllowedIPs = 0.0.0.0/0, ::/0\n"
+        "PersistentKeepalive = 25\n"
+    )
+
+CONFIG_TEMPLATE = compile_config_template()
+
+def generate_config(private_key, assigned_ip, server_public_key):
+    """Generate WireGuard client configuration file"""
+    return CONFIG_TEMPLATE.format(
+        private_key=private_key,
+        address=ip_allocator.client_addresses(assigned_ip),
+        server_public_key=server_public_key
+    )
+
+QR_FORMATS = ('png', 'svg', 'matrix')
+
+def render_qr_code(config_text, fmt='png'):
+    """
+    Render a config as a QR code, uncached. Also runs in QR worker processes.
+      png    - data:image/png;base64 URI (needs pillow)
+      svg    - data:image/svg+xml;base64 URI, built from the module matrix
+      matrix - list of '0'/'1' row strings, border included
+    """
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=10,
+        border=4,
+    )
+    qr.add_data(config_text)
+    qr.make(fit=True)
+    
+    if fmt == 'png':
+        img = qr.make_image(fill_color="black", back_color="white")
+        buffer = io.BytesIO()
+        img.save(buffer, format='PNG')
+        return 'data:image/png;base64,' + base64.b64encode(buffer.getvalue()).decode()
+    
+    matrix = qr.get_matrix()
+    if fmt == 'matrix':
+        return [''.join('1' if cell else '0' for cell in row) for row in matrix]
+    
+    # One horizontal run per path segment keeps the SVG small
+    size = len(matrix)
+    path = []
+    for y, row in enumerate(matrix):
+        x = 0
+        while x < size:
+            if row[x]:
+                start = x
+                while x < size and row[x]:
+                    x += 1
+                path.append(f"M{start},{y}h{x - start}v1h{start - x}z")
+            else:
+                x += 1
+    svg = (f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {size} {size}" '
+           f'width="{size * 10}" height="{size * 10}" shape-rendering="crispEdges">'
+           f'<rect width="100%" height="100%" fill="#fff"/>'
+           f'<path d="{"".join(path)}" fill="#000"/></svg>')
+    return 'data:image/svg+xml;base64,' + base64.b64encode(svg.encode()).decode()
+
+
+class QRCache:
+    """Content-addressed LRU of rendered QR codes, keyed by sha256(format + config)"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(config_text, fmt):
+        return hashlib.sha256(f"{fmt}\0{config_text}".encode()).digest()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+
+qr_cache = QRCache(CONFIG['qr_cache_size'])
+_qr_pool = None
+_qr_pool_lock = threading.Lock()
+
+def get_qr_pool():
+    """Process pool for QR rendering (QR_WORKERS > 0), so it doesn't hold the GIL"""
+    global _qr_pool
+    if CONFIG['qr_workers'] <= 0:
+        return None
+    with _qr_pool_lock:
+        if _qr_pool is None:
+            # forkserver: don't fork the threaded API process itself
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _qr_pool = ProcessPoolExecutor(max_workers=CONFIG['qr_workers'],
+                                           mp_context=multiprocessing.get_context(method))
+        return _qr_pool
+
+def generate_qr_code(config_text, fmt='png'):
+    """Generate QR code for a config (see render_qr_code for formats), cached"""
+    if qrcode is None:
+        print("qrcode not installed - QR generation disabled")
+        return None
+    
+    key = QRCache.key(config_text, fmt)
+    cached = qr_cache.get(key)
+    if cached is not None:
+        return cached
+    
+    try:
+        pool = get_qr_pool()
+        if pool:
+            result = pool.submit(render_qr_code, config_text, fmt).result()
+        else:
+            result = render_qr_code(config_text, fmt)
+    except ImportError:
+        print("pillow not installed - PNG QR generation disabled")
+        return None
+    except Exception as e:
+        print(f"Error generating QR code: {e}")
+        return None
+    
+    qr_cache.put(key, result)
+    return result
+
+def parse_qr_format(data, default='png'):
+    """Read "qr_format" from a request body: png, svg, matrix or none"""
+    fmt = data.get('qr_format', default) if isinstance(data, dict) else default
+    if fmt in QR_FORMATS or fmt == 'none':
+        return fmt, None
+    return None, f"qr_format must be one of {', '.join(QR_FORMATS)}, none"
+
+
+# ============== PEER RESERVOIR ==============
+
+class PeerReservoir:
+    """
+    Background-filled stock of ready (private_key, public_key, assigned_ip)
+    tuples so create_peer can skip keygen and IP allocation during a spike.
+
+    The refill thread tops the stock up to high_watermark whenever it drops
+    below low_watermark. Reserved addresses are held in the allocator, so they
+    are never handed out twice; they are not persisted, and init_db() starts
+    the allocator from peers.db on the next restart.
+
+    With several serve.py workers each has its own reservoir, so the
+    watermarks are split between them and all reservoirs together never
+    hold more than an eighth of the free addresses.
+    """
+
+    def __init__(self, allocator, low_watermark, high_watermark, workers=1):
+        self.allocator = allocator
+        self.low_watermark = low_watermark
+        self.high_watermark = high_watermark
+        self.workers = workers
+        self._items = deque()
+        self._wake = threading.Event()
+        self._thread = None
+        self.served = 0
+        self.misses = 0
+        self.refilled = 0
+        self.last_refill_rate = 0.0
+
+    def start(self):
+        if self.high_watermark <= 0 or self._thread:
+            return
+        self._thread = threading.Thread(target=self._run, name='peer-reservoir', daemon=True)
+        self._thread.start()
+        self._wake.set()
+        atexit.register(self.drain)
+
+    def drain(self):
+        """Return every reserved address to the allocator"""
+        while True:
+            try:
+                _, _, assigned_ip = self._items.popleft()
+            except IndexError:
+                return
+            self.allocator.release(assigned_ip)
+
+    def limits(self):
+        """(low, high) watermarks for this process"""
+        share = (self.allocator.free_count() + len(self._items)) // (8 * self.workers)
+        high = min(max(1, self.high_watermark // self.workers), share)
+        return min(max(1, self.low_watermark // self.workers), high), high
+
+    def take(self):
+        """Pop a ready peer, or None if the reservoir is empty"""
+        try:
+            item = self._items.popleft()
+            self.served += 1
+        except IndexError:
+            item = None
+            self.misses += 1
+        if len(self._items) < self.limits()[0]:
+            self._wake.set()
+        return item
+
+    def depth(self):
+        return len(self._items)
+
+    def stats(self):
+        low, high = self.limits()
+        return {
+            'depth': len(self._items),
+            'low_watermark': low,
+            'high_watermark': high,
+            'served': self.served,
+            'misses': self.misses,
+            'refilled': self.refilled,
+            'refill_rate': round(self.last_refill_rate, 1)
+        }
+
+    def _run(self):
+        while True:
+            self._wake.wait(timeout=30)
+            self._wake.clear()
+            low, high = self.limits()
+            if len(self._items) < low:
+                self._fill(high)
+            # Free addresses ran low: hand back what this reservoir holds beyond its share
+            while len(self._items) > high:
+                try:
+                    _, _, assigned_ip = self._items.pop()
+                except IndexError:
+                    break
+                self.allocator.release(assigned_ip)
+
+    def _fill(self, high):
+        started = time.monotonic()
+        added = 0
+        while len(self._items) < high:
+            assigned_ip = self.allocator.allocate()
+            if not assigned_ip:
+                break
+            private_key, public_key = generate_keypair()
+            if not private_key or not public_key:
+                self.allocator.release(assigned_ip)
+                break
+            self._items.append((private_key, public_key, assigned_ip))
+            added += 1
+        elapsed = time.monotonic() - started
+        if added:
+            self.refilled += added
+            self.last_refill_rate = added / elapsed if elapsed > 0 else float(added)
+
+
+peer_reservoir = PeerReservoir(ip_allocator, CONFIG['reservoir_low'], CONFIG['reservoir_high'])
+
+def next_peer_slot(stages=None):
+    """
+    Get (private_key, public_key, assigned_ip) for a new peer, from the
+    reservoir if possible. Returns (slot, None) or (None, (error, status)).
+    """
+    reserved = peer_reservoir.take()
+    if reserved:
+        if stages:
+            stages.mark('reservoir')
+        return reserved, None
+    
+    assigned_ip = get_next_ip()
+    if stages:
+        stages.mark('allocate_ip')
+    if not assigned_ip:
+        return None, ('No IPs available on this server', 503)
+    
+    private_key, public_key = generate_keypair()
+    if stages:
+        stages.mark('keygen')
+    if not private_key or not public_key:
+        ip_allocator.release(assigned_ip)
+        return None, ('Failed to generate keypair', 500)
+    
+    return (private_key, public_key, assigned_ip), None
+
+
+# ============== PEER STATS ==============
+
+# Snapshots kept in peers.db for following workers to pick up
+PUBLISHED_SNAPSHOTS = 3
+
+class PeerStatsSampler:
+    """
+    Background sampler of `wg show wg0 dump`.
+
+    Every interval seconds the dump is compared with the previous sample and
+    only peers whose rx/tx/handshake changed are recorded, as one snapshot in
+    a ring buffer of the last `history` samples. changed_since() walks only
+    the snapshots newer than the caller's timestamp, so a dashboard poll
+    costs O(changed peers) instead of O(all peers).
+
+    Under serve.py only the first worker samples (start(publish=True)) and
+    also writes each snapshot to peers.db, keeping the last few there. The
+    other workers follow(): they copy new snapshots into their own ring
+    buffer every interval, so wg0 is dumped once per interval and peers.db
+    doesn't grow with the history.
+    """
+
+    def __init__(self, interval, history):
+        self.interval = interval
+        self._snapshots = deque(maxlen=history)
+        self._counters = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self.publish = False
+        # Snapshots at or before this time may be missing (a follower joined or fell behind)
+        self._horizon = float('-inf')
+        self.last_sample = None
+        self.errors = 0
+        # Called as listener(changed, removed) after every sample
+        self.listeners = []
+
+    def start(self, publish=False):
+        if self.interval <= 0 or self._thread:
+            return
+        self.publish = publish
+        if publish:
+            # A previous sampler's history has a different baseline
+            with db_pool.connection() as conn, conn:
+                conn.execute('DELETE FROM peer_stats_snapshots')
+                conn.execute('DELETE FROM peer_stats_state')
+        self._thread = threading.Thread(target=self._run, name='peer-stats', daemon=True)
+        self._thread.start()
+
+    def follow(self):
+        """Copy the snapshots another worker publishes instead of sampling"""
+        if self.interval <= 0 or self._thread:
+            return
+        self._thread = threading.Thread(target=self._run_follower, name='peer-stats', daemon=True)
+        self._thread.start()
+
+    def running(self):
+        return self._thread is not None
+
+    def _run(self):
+        while True:
+            try:
+                self.sample()
+            except Exception as e:
+                self.errors += 1
+                print(f"Error sampling peer stats: {e}")
+            time.sleep(self.interval)
+
+    def sample(self):
+        """Read the dump once and record the peers that changed"""
+        now = time.time()
+        dump = wg_control.open_dump()
+        try:
+            current = {
+                peer['public_key']: (peer['transfer_rx'], peer['transfer_tx'], peer['last_handshake'])
+                for peer in dump
+            }
+        finally:
+            dump_ok = dump.close()
+        health_monitor.record('dump', dump_ok)
+        if not dump_ok:
+            raise RuntimeError("Reading the wg0 peer dump failed")
+        
+        previous = self._counters
+        changed = {}
+        for key, counters in current.items():
+            old = previous.get(key)
+            if counters != old:
+                rx, tx, _ = counters
+                old_rx, old_tx = (old[0], old[1]) if old else (0, 0)
+                # Counters reset when a peer is re-added; count from zero then
+                changed[key] = counters + (rx - old_rx if rx >= old_rx else rx,
+                                           tx - old_tx if tx >= old_tx else tx)
+        removed = [key for key in previous if key not in current]
+        
+        with self._lock:
+            self._counters = current
+            if changed or removed:
+                self._snapshots.append((now, changed, removed))
+            self.last_sample = now
+        if self.publish:
+            self._publish(now, changed, removed)
+        for listener in self.listeners:
+            listener(changed, removed)
+        return changed, removed
+
+    def _publish(self, now, changed, removed):
+        try:
+            with db_pool.connection() as conn, conn:
+                if changed or removed:
+                    conn.execute(SQL_INSERT_STATS_SNAPSHOT, (now, json.dumps(changed), json.dumps(removed)))
+                    conn.execute(SQL_PRUNE_STATS_SNAPSHOTS, (PUBLISHED_SNAPSHOTS - 1,))
+                conn.execute(SQL_SET_LAST_SAMPLE, (now,))
+        except sqlite3.Error as e:
+            print(f"Error publishing peer stats: {e}")
+
+    def _run_follower(self):
+        seen = None
+        while True:
+            try:
+                seen = self.mirror(seen)
+            except Exception as e:
+                self.errors += 1
+                print(f"Error following peer stats: {e}")
+            time.sleep(self.interval)
+
+    def mirror(self, seen):
+        """
+        Append the snapshots published after `seen` (None on the first call)
+        to the ring buffer; returns the newest snapshot time seen.
+        """
+        with db_pool.connection() as conn:
+            count, oldest = conn.execute(SQL_STATS_SNAPSHOT_SPAN).fetchone()
+            rows = conn.execute(SQL_STATS_SNAPSHOTS_SINCE, (seen if seen is not None else float('-inf'),)).fetchall()
+            row = conn.execute(SQL_GET_LAST_SAMPLE).fetchone()
+        with self._lock:
+            # Anything published before the oldest row we got may have been pruned unseen
+            if rows and (seen is None or (count >= PUBLISHED_SNAPSHOTS and oldest > seen)):
+                self._horizon = rows[0][0]
+            for ts, changed, removed in rows:
+                self._snapshots.append((ts, json.loads(changed), json.loads(removed)))
+            self.last_sample = row[0] if row else None
+        if rows:
+            return rows[-1][0]
+        # Nothing published yet: everything from here on will be seen
+        return seen if seen is not None else float('-inf')
+
+    def changed_since(self, since):
+        """
+        Peers whose counters changed after `since` (unix time).
+        Returns (peers, removed, complete); complete is False when `since`
+        predates the ring buffer and the caller should do a full list.
+        """
+        with self._lock:
+            snapshots = list(self._snapshots)
+            horizon = self._horizon
+        complete = since >= horizon and (
+            not snapshots or len(snapshots) < self._snapshots.maxlen or snapshots[0][0] <= since)
+        
+        peers = {}
+        removed = set()
+        for ts, changed, gone in reversed(snapshots):
+            if ts <= since:
+                break
+            for key, (rx, tx, handshake, rx_delta, tx_delta) in changed.items():
+                entry = peers.get(key)
+                if entry is None:
+                    if key in removed:
+                        continue
+                    peers[key] = {
+                        'public_key': key,
+                        'transfer_rx': rx,
+                        'transfer_tx': tx,
+                        'last_handshake': handshake,
+                        'rx_delta': rx_delta,
+                        'tx_delta': tx_delta
+                    }
+                else:
+                    entry['rx_delta'] += rx_delta
+                    entry['tx_delta'] += tx_delta
+            for key in gone:
+                if key not in peers:
+                    removed.add(key)
+        return list(peers.values()), sorted(removed), complete
+
+
+peer_stats = PeerStatsSampler(CONFIG['stats_interval'], CONFIG['stats_history'])
+
+
+class HandshakeWriter:
+    """
+    Write-behind persistence of peer handshake times into peers.last_handshake.
+
+    Fed by the stats sampler; new handshakes are coalesced in memory (latest
+    per peer wins) and flushed every interval seconds as one executemany
+    transaction, so the dump never causes a write per peer per sample.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._pending = {}
+        self._written = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self.flushed = 0
+
+    def record(self, changed, removed):
+        with self._lock:
+            for key, (_, _, handshake, _, _) in changed.items():
+                if handshake and self._written.get(key) != handshake:
+                    self._pending[key] = handshake
+            for key in removed:
+                self._written.pop(key, None)
+
+    def flush(self):
+        """Write pending handshakes in one transaction, return rows queued"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        try:
+            with db_pool.write('handshakes') as conn:
+                conn.executemany(SQL_SET_HANDSHAKE, [(ts, key_blob(key)) for key, ts in pending.items()])
+        except sqlite3.Error as e:
+            # Keep them for the next flush unless a newer handshake arrived
+            with self._lock:
+                for key, ts in pending.items():
+                    self._pending.setdefault(key, ts)
+            print(f"Error flushing handshakes: {e}")
+            return 0
+        with self._lock:
+            self._written.update(pending)
+        self.flushed += len(pending)
+        return len(pending)
+
+    def start(self, sampler):
+        if self._thread:
+            return
+        sampler.listeners.append(self.record)
+        self._thread = threading.Thread(target=self._run, name='handshake-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+
+handshake_writer = HandshakeWriter(CONFIG['handshake_flush_interval'])
+
+
+# ============== PEER EXPIRY ==============
+
+class PeerExpiry:
+    """
+    Scheduled garbage collection of abandoned peers.
+
+    Every interval seconds, active peers whose last handshake (or creation,
+    if they never connected) is older than max_idle seconds are removed from
+    wg0 and soft-deleted (is_active = 0) in batches, and their IPs go back
+    to the allocator. The live dump is read once per run so a peer that
+    handshook since the last handshake flush is kept, and its handshake is
+    written through instead. One process per node runs it.
+    """
+
+    def __init__(self, max_idle, interval, batch_size):
+        self.max_idle = max_idle
+        self.interval = interval
+        self.batch_size = batch_size
+        self._thread = None
+        self.last_run = None
+        self.last_reclaimed = 0
+        self.reclaimed = 0
+
+    def start(self):
+        if self.max_idle <= 0 or self.interval <= 0 or self._thread:
+            return
+        self._thread = threading.Thread(target=self._run, name='peer-expiry', daemon=True)
+        self._thread.start()
+
+    def running(self):
+        return self._thread is not None
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"Error expiring peers: {e}")
+
+    def _live_handshakes(self):
+        dump = wg_control.open_dump()
+        try:
+            handshakes = {peer['public_key']: peer['last_handshake'] for peer in dump if peer['last_handshake']}
+        finally:
+            dump_ok = dump.close()
+        health_monitor.record('dump', dump_ok)
+        if not dump_ok:
+            raise RuntimeError("Reading the wg0 peer dump failed")
+        return handshakes
+
+    def run_once(self):
+        """Expire every idle peer now, batch by batch; returns the number reclaimed"""
+        start = time.perf_counter()
+        cutoff = int(time.time() - self.max_idle)
+        live = self._live_handshakes()
+        reclaimed = 0
+        while True:
+            with db_pool.connection() as conn:
+                candidates = [
+                    (key_text(key), ip)
+                    for key, ip in conn.execute(SQL_EXPIRED_PEERS, (cutoff, cutoff, self.batch_size))
+                ]
+            if not candidates:
+                break
+            
+            fresh = [(live[key], key_blob(key)) for key, _ in candidates if live.get(key, 0) >= cutoff]
+            expired = [(key, ip) for key, ip in candidates if live.get(key, 0) < cutoff]
+            if expired and not remove_peers_from_wireguard([key for key, _ in expired]):
+                print(f"Peer expiry stopped: removing {len(expired)} peers from wg0 failed")
+                break
+            with db_pool.write('expiry') as conn:
+                conn.executemany(SQL_SET_HANDSHAKE, fresh)
+                conn.executemany(SQL_DEACTIVATE_PEER, [(key_blob(key),) for key, _ in expired])
+            for _, ip in expired:
+                ip_allocator.release(ip)
+            reclaimed += len(expired)
+            if len(candidates) < self.batch_size:
+                break
+        
+        elapsed = time.perf_counter() - start
+        GC_RUN_SECONDS.observe(elapsed)
+        GC_RECLAIMED.inc(amount=reclaimed)
+        self.last_run = time.time()
+        self.last_reclaimed = reclaimed
+        self.reclaimed += reclaimed
+        if reclaimed:
+            print(f"Expired {reclaimed} peers idle for more than {self.max_idle / 86400:g} days in {elapsed:.3f}s")
+        return reclaimed
+
+
+peer_expiry = PeerExpiry(CONFIG['peer_max_idle_days'] * 86400, CONFIG['gc_interval'], CONFIG['gc_batch'])
+
 
-app = Flask(__name__)
+# ============== HEALTH ==============
 
-# Configuration from environment variables
-CONFIG = {
-    'server_name': os.environ.get('SERVER_NAME', 'vpn-server'),
-    'server_ip': os.environ.get('SERVER_IP', '0.0.0.0'),
-    'server_port': int(os.environ.get('WG_PORT', '51820')),
-    'api_port': int(os.environ.get('API_PORT', '8443')),
-    'subnet_base': os.environ.get('SUBNET_BASE', '10.8.0'),
-    'dns_servers': os.environ.get('DNS', '1.1.1.1, 1.0.0.1'),
-    'api_secret': os.environ.get('API_SECRET', 'CHANGE_THIS_SECRET'),
-    'db_path': os.environ.get('DB_PATH', '/opt/truevault/peers.db')
-}
+class HealthMonitor:
+    """
+    Background probe of wg0 so /api/health is answered from memory.
 
-def init_db():
-    """Initialize local peer tracking database"""
-    conn = sqlite3.connect(CONFIG['db_path'])
-    c = conn.cursor()
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS peers (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            device_name TEXT NOT NULL,
-            public_key TEXT NOT NULL UNIQUE,
-            private_key TEXT NOT NULL,
-            assigned_ip TEXT NOT NULL UNIQUE,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            last_handshake DATETIME,
-            is_active BOOLEAN DEFAULT 1
-        )
-    ''')
-    conn.commit()
-    conn.close()
-    print(f"Database initialized at {CONFIG['db_path']}")
+    Probes every interval seconds once started; until then (or with
+    HEALTH_INTERVAL=0) each request probes, as before. Also counts wg0
+    control calls and failures per operation for /api/health/deep.
+    """
 
-def verify_auth(req):
-    """Verify API authentication via Bearer token"""
-    auth_header = req.headers.get('Authorization', '')
-    if auth_header.startswith('Bearer '):
-        token = auth_header[7:]
-        if token == CONFIG['api_secret']:
-            return True
-    return False
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._thread = None
+        self.online = None
+        self.checked_at = None
+        self.calls = {}   # operation -> [calls, failures]
 
-def get_next_ip():
-    """Get next available IP address in subnet"""
-    conn = sqlite3.connect(CONFIG['db_path'])
-    c = conn.cursor()
-    c.execute('SELECT assigned_ip FROM peers WHERE is_active = 1')
-    used_ips = [row[0] for row in c.fetchall()]
-    conn.close()
-    
-    base = CONFIG['subnet_base']
-    for i in range(2, 255):  # .1 is server, .2-254 for clients
-        ip = f"{base}.{i}"
-        if ip not in used_ips:
-            return ip
-    return None
+    def start(self):
+        if self._thread or self.interval <= 0:
+            return
+        self.probe()
+        self._thread = threading.Thread(target=self._run, name='health-monitor', daemon=True)
+        self._thread.start()
 
-def generate_keypair():
-    """Generate WireGuard keypair using wg commands"""
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.probe()
+
+    def probe(self):
+        """Check wg0 now and cache the result"""
+        try:
+            online = wg_control.is_up()
+        except Exception as e:
+            print(f"Error probing wg0: {e}")
+            online = False
+        self.online = online
+        self.checked_at = time.time()
+        return self.record('probe', online)
+
+    def running(self):
+        return self._thread is not None
+
+    def is_online(self):
+        if self._thread is None:
+            return self.probe()
+        return self.online
+
+    def record(self, operation, ok):
+        """Count one wg0 call; returns ok so callers can wrap their result"""
+        with self._lock:
+            counts = self.calls.setdefault(operation, [0, 0])
+            counts[0] += 1
+            if not ok:
+                counts[1] += 1
+        return ok
+
+    def error_rates(self):
+        with self._lock:
+            return {
+                operation: {'calls': calls, 'failures': failures, 'error_rate': round(failures / calls, 4)}
+                for operation, (calls, failures) in self.calls.items()
+            }
+
+
+health_monitor = HealthMonitor(CONFIG['health_interval'])
+
+def check_database():
+    """Time one indexed query against peers.db; returns (latency_ms, active_peers, error)"""
+    start = time.perf_counter()
     try:
-        # Generate private key
-        result = subprocess.run(['wg', 'genkey'], capture_output=True, text=True, check=True)
-        private_key = result.stdout.strip()
-        
-        # Derive public key from private key
-        result = subprocess.run(['wg', 'pubkey'], input=private_key, capture_output=True, text=True, check=True)
-        public_key = result.stdout.strip()
-        
-        return private_key, public_key
-    except subprocess.CalledProcessError as e:
-        print(f"Error generating keypair: {e}")
-        return None, None
+        with db_pool.connection() as conn:
+            active_peers = conn.execute(SQL_ACTIVE_PEER_COUNT).fetchone()[0]
+    except sqlite3.Error as e:
+        return None, None, str(e)
+    return round((time.perf_counter() - start) * 1000, 3), active_peers, None
 
-def get_server_public_key():
-    """Get this server's WireGuard public key"""
+def health_summary():
+    """Body of /api/health; no I/O once the monitor is running"""
+    is_online = health_monitor.is_online()
+    return {
+        'status': 'online' if is_online else 'degraded',
+        'server': CONFIG['server_name'],
+        'ip': CONFIG['server_ip'],
+        'port': CONFIG['server_port'],
+        'reservoir': peer_reservoir.stats(),
+        'checked_at': health_monitor.checked_at,
+        'timestamp': datetime.utcnow().isoformat() + 'Z'
+    }
+
+def deep_health_summary():
+    """Body of /api/health/deep; queries peers.db"""
+    summary = health_summary()
+    latency_ms, active_peers, db_error = check_database()
+    if db_error:
+        summary['status'] = 'degraded'
+    summary.update({
+        'database': {'ok': db_error is None, 'latency_ms': latency_ms, 'error': db_error},
+        'active_peers': active_peers,
+        'free_ips': ip_allocator.free_count(),
+        'wg_backend': wg_control.name,
+        'wg_operations': health_monitor.error_rates(),
+        'stats_sampler_errors': peer_stats.errors,
+        'auth': authenticator.stats(),
+        'peer_expiry': {
+            'enabled': peer_expiry.running(),
+            'last_run': peer_expiry.last_run,
+            'last_reclaimed': peer_expiry.last_reclaimed,
+            'reclaimed': peer_expiry.reclaimed
+        }
+    })
+    return summary
+
+
+# ============== RECONCILE ==============
+
+RECONCILE_CHUNK = 1000
+
+def split_allowed_ips(value):
+    return frozenset(part.strip() for part in (value or '').split(',') if part.strip() and part.strip() != '(none)')
+
+def reconcile_wireguard(remove_orphans=False):
+    """
+    Make wg0 match the active rows in peers.db (run once at startup).
+
+    The DB and the dump are diffed as sets: active peers missing from wg0
+    are re-added and peers whose allowed-ips drifted are replaced, in
+    batched calls. Peers on wg0 with no active row (orphans) are only
+    removed with remove_orphans, and never when peers.db has no active
+    rows: peers added outside the API (create-client-config.sh runs
+    `wg set wg0 peer` directly) are orphans too. Returns the diff counts,
+    or None if the dump couldn't be read.
+    """
+    start = time.perf_counter()
+    with db_pool.connection() as conn:
+        wanted = {
+            key_text(public_key): ip_allocator.allowed_ips(assigned_ip)
+            for public_key, assigned_ip in conn.execute(SQL_ACTIVE_PEERS)
+        }
+    
+    dump = wg_control.open_dump()
     try:
-        result = subprocess.run(['wg', 'show', 'wg0', 'public-key'], capture_output=True, text=True, check=True)
-        return result.stdout.strip()
-    except subprocess.CalledProcessError:
-        # Try reading from file
+        live = {peer['public_key']: peer['allowed_ips'] for peer in dump}
+    finally:
+        dump_ok = dump.close()
+    health_monitor.record('dump', dump_ok)
+    if not dump_ok:
+        print("Reconcile skipped: could not read the wg0 dump")
+        return None
+    
+    missing = wanted.keys() - live.keys()
+    unknown = live.keys() - wanted.keys()
+    if remove_orphans and unknown and not wanted:
+        print(f"Reconcile keeping {len(unknown)} orphans: peers.db has no active peers")
+    orphans = unknown if remove_orphans and wanted else set()
+    drifted = {
+        public_key for public_key in wanted.keys() & live.keys()
+        if split_allowed_ips(live[public_key]) != split_allowed_ips(wanted[public_key])
+    }
+    
+    # Drifted peers are removed and re-added: `wg addconf` only appends allowed-ips
+    remove = list(orphans | drifted)
+    add = [(public_key, wanted[public_key]) for public_key in missing | drifted]
+    failures = 0
+    for i in range(0, len(remove), RECONCILE_CHUNK):
+        if not health_monitor.record('remove_peers', wg_control.remove_peers(remove[i:i + RECONCILE_CHUNK])):
+            failures += 1
+    for i in range(0, len(add), RECONCILE_CHUNK):
+        if not health_monitor.record('add_peers', wg_control.add_peers(add[i:i + RECONCILE_CHUNK])):
+            failures += 1
+    
+    result = {
+        'active': len(wanted),
+        'live': len(live),
+        'readded': len(missing),
+        'replaced': len(drifted),
+        'orphans_kept': len(unknown - orphans),
+        'orphans_removed': len(orphans),
+        'failed_batches': failures,
+        'seconds': round(time.perf_counter() - start, 3)
+    }
+    for action in ('readded', 'replaced', 'orphans_removed'):
+        RECONCILED.inc(action, amount=result[action])
+    print("Reconciled wg0 with peers.db: " + ', '.join(f"{k}={v}" for k, v in result.items()))
+    for label, keys in (('re-added', missing), ('replaced', drifted), ('removed orphan', orphans)):
+        for public_key in sorted(keys)[:10]:
+            print(f"  {label}: {public_key}")
+        if len(keys) > 10:
+            print(f"  ... and {len(keys) - 10} more {label}")
+    return result
+
+
+# ============== AUTH ==============
+
+TOKEN_PREFIX = 'tv1'
+
+def secret_key_id(secret):
+    """Short public identifier of a secret, carried in signed tokens"""
+    return hashlib.sha256(secret.encode()).hexdigest()[:8]
+
+class Authenticator:
+    """
+    Bearer-token verification for the peer API.
+
+    Accepts any active secret (API_SECRET plus API_SECRETS_PREVIOUS during a
+    rotation) or a short-lived signed token "tv1.<key id>.<expires>.<hmac>"
+    minted from one of them, checked without touching peers.db. Every
+    comparison goes through hmac.compare_digest. Signed tokens that verified
+    are remembered in a small LRU until they expire, so repeat requests skip
+    the HMAC; static secrets are never cached (a lookup keyed on the secret
+    isn't constant-time), nor are failures.
+    """
+
+    def __init__(self, secrets, token_ttl, cache_size):
+        self.secrets = {secret_key_id(s): s.encode() for s in secrets}
+        self.signing_secret = secrets[0]
+        self.token_ttl = token_ttl
+        self.cache_size = cache_size
+        self._cache = OrderedDict()   # signed token -> expires
+        self._lock = threading.Lock()
+        self.verified = 0
+        self.rejected = 0
+        self.cache_hits = 0
+        self.seconds = 0.0
+
+    @staticmethod
+    def _sign(secret, payload):
+        digest = hmac.new(secret, payload.encode(), hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest).rstrip(b'=').decode()
+
+    def mint(self, ttl=None):
+        """Signed token valid for ttl seconds (capped at token_ttl); returns (token, expires)"""
+        ttl = self.token_ttl if ttl is None else min(ttl, self.token_ttl)
+        expires = int(time.time() + ttl)
+        payload = f"{TOKEN_PREFIX}.{secret_key_id(self.signing_secret)}.{expires}"
+        return f"{payload}.{self._sign(self.signing_secret.encode(), payload)}", expires
+
+    def _check_secret(self, token):
+        token = token.encode()
+        matched = False
+        # No early exit: time doesn't depend on which secret matched
+        for secret in self.secrets.values():
+            matched |= hmac.compare_digest(token, secret)
+        return matched
+
+    def _check_signed(self, token, now):
+        """Expiry of a valid, unexpired signed token, else None"""
         try:
-            with open('/etc/wireguard/server_public.key', 'r') as f:
-                return f.read().strip()
-        except:
+            prefix, key_id, expires, signature = token.split('.')
+            expires = int(expires)
+        except ValueError:
             return None
+        secret = self.secrets.get(key_id)
+        if prefix != TOKEN_PREFIX or secret is None or expires <= now:
+            return None
+        expected = self._sign(secret, f"{prefix}.{key_id}.{expires}")
+        return expires if hmac.compare_digest(signature.encode(), expected.encode()) else None
 
-def add_peer_to_wireguard(public_key, allowed_ip):
-    """Add peer to WireGuard interface"""
-    try:
-        cmd = ['wg', 'set', 'wg0', 'peer', public_key, 'allowed-ips', f'{allowed_ip}/32']
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        if result.returncode != 0:
-            print(f"Error adding peer: {result.stderr}")
-        return result.returncode == 0
-    except Exception as e:
-        print(f"Exception adding peer: {e}")
-        return False
+    def _check(self, auth_header, now):
+        """Expiry of the credential in auth_header, or None if it's not valid"""
+        if not auth_header.startswith('Bearer '):
+            return None
+        token = auth_header[7:]
+        if not token.startswith(TOKEN_PREFIX + '.'):
+            return float('inf') if self._check_secret(token) else None
+        with self._lock:
+            expires = self._cache.get(token)
+            if expires is not None:
+                if expires > now:
+                    self._cache.move_to_end(token)
+                    self.cache_hits += 1
+                    return expires
+                del self._cache[token]
+                return None
+        expires = self._check_signed(token, now)
+        if expires is not None:
+            with self._lock:
+                self._cache[token] = expires
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return expires
 
-def remove_peer_from_wireguard(public_key):
-    """Remove peer from WireGuard interface"""
-    try:
-        cmd = ['wg', 'set', 'wg0', 'peer', public_key, 'remove']
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        return result.returncode == 0
-    except Exception as e:
-        print(f"Exception removing peer: {e}")
-        return False
+    def verify(self, auth_header, static_only=False):
+        """True if auth_header carries a valid credential"""
+        start = time.perf_counter()
+        expires = self._check(auth_header, time.time())
+        ok = expires is not None and (not static_only or expires == float('inf'))
+        elapsed = time.perf_counter() - start
+        AUTH_LATENCY.observe(elapsed, 'ok' if ok else 'rejected')
+        with self._lock:
+            self.seconds += elapsed
+            if ok:
+                self.verified += 1
+            else:
+                self.rejected += 1
+        return ok
 
-def generate_config(private_key, assigned_ip, server_public_key):
-    """Generate WireGuard client configuration file"""
-    config = f"""[Interface]
-PrivateKey = {private_key}
-Address = {assigned_ip}/32
-DNS = {CONFIG['dns_servers']}
-
-[Peer]
-PublicKey = {server_public_key}
-Endpoint = {CONFIG['server_ip']}:{CONFIG['server_port']}
-AllowedIPs = 0.0.0.0/0, ::/0
-PersistentKeepalive = 25
-"""
-    return config
+    def stats(self):
+        with self._lock:
+            checks = self.verified + self.rejected
+            return {
+                'verified': self.verified,
+                'rejected': self.rejected,
+                'cache_hits': self.cache_hits,
+                'cached_tokens': len(self._cache),
+                'avg_us': round(self.seconds / checks * 1_000_000, 2) if checks else 0.0
+            }
 
-def generate_qr_code(config_text):
-    """Generate QR code as base64 PNG image"""
-    try:
-        import qrcode
-        from PIL import Image
-        
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=10,
-            border=4,
-        )
-        qr.add_data(config_text)
-        qr.make(fit=True)
+
+authenticator = Authenticator(
+    [CONFIG['api_secret']] + CONFIG['api_secrets_previous'],
+    CONFIG['auth_token_ttl'],
+    CONFIG['auth_cache_size']
+)
+
+
+# ============== IDEMPOTENCY ==============
+
+IDEMPOTENCY_KEY_MAX = 255
+
+class IdempotencyStore:
+    """
+    Idempotency-Key support for create-peer.
+
+    The idempotency_keys table in peers.db is the source of truth, so all
+    serve.py workers see the same keys. A key is claimed by inserting a
+    pending row; the 2xx response is stored on completion and replayed for
+    any retry with the same key and body within ttl seconds. Failed
+    requests release the key so the retry does the work. Stored responses
+    hold a private key, so they are sealed with private_key_box; completed
+    responses are also held in an in-memory TTL cache.
+    """
+
+    def __init__(self, ttl, cache_size, pending_timeout=60):
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.pending_timeout = pending_timeout
+        self._cache = OrderedDict()   # key -> (expires, fingerprint, body, status)
+        self._lock = threading.Lock()
+        self._pruned_at = 0
+        self.replayed = 0
+
+    @staticmethod
+    def fingerprint(body):
+        return hashlib.sha256(body).hexdigest()
+
+    @staticmethod
+    def _error(message, status):
+        return json.dumps({'success': False, 'error': message}), status
+
+    def _cached(self, key, now):
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= now:
+                del self._cache[key]
+                return None
+            self._cache.move_to_end(key)
+            return entry
+
+    def _remember(self, key, expires, fingerprint, body, status):
+        with self._lock:
+            self._cache[key] = (expires, fingerprint, body, status)
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _replay(self, key, expires, fingerprint, stored_fingerprint, body, status):
+        if fingerprint != stored_fingerprint:
+            return self._error('Idempotency-Key was already used with a different request body', 422)
+        self._remember(key, expires, stored_fingerprint, body, status)
+        self.replayed += 1
+        return body, status
+
+    def begin(self, key, fingerprint):
+        """
+        Claim key for a new request. Returns None if the caller should do the
+        work (then call complete or abandon), else (json body, status) to send.
+        """
+        now = time.time()
+        entry = self._cached(key, now)
+        if entry:
+            expires, stored_fingerprint, body, status = entry
+            return self._replay(key, expires, fingerprint, stored_fingerprint, body, status)
         
-        img = qr.make_image(fill_color="black", back_color="white")
+        self._prune(now)
+        with db_pool.connection() as conn, conn:
+            try:
+                conn.execute(SQL_CLAIM_IDEMPOTENCY, (key, fingerprint, int(now)))
+                return None
+            except sqlite3.IntegrityError:
+                pass
+            stored_fingerprint, status, body, created_at = conn.execute(SQL_GET_IDEMPOTENCY, (key,)).fetchone()
+            expired = created_at <= now - self.ttl
+            abandoned = status is None and created_at <= now - self.pending_timeout
+            if expired or abandoned:
+                conn.execute(SQL_RECLAIM_IDEMPOTENCY, (fingerprint, int(now), key))
+                return None
+        if status is None:
+            return self._error('A request with this Idempotency-Key is still in progress', 409)
+        try:
+            body = private_key_box.open(body).decode()
+        except ValueError as e:
+            print(f"Error opening stored Idempotency-Key response: {e}")
+            return self._error('Stored response for this Idempotency-Key cannot be decrypted', 500)
+        return self._replay(key, created_at + self.ttl, fingerprint, stored_fingerprint, body, status)
+
+    def complete(self, key, fingerprint, body, status):
+        """Store the response for replay"""
+        with db_pool.connection() as conn, conn:
+            conn.execute(SQL_COMPLETE_IDEMPOTENCY, (status, private_key_box.seal(body.encode()), key))
+        self._remember(key, time.time() + self.ttl, fingerprint, body, status)
+
+    def abandon(self, key):
+        """Release a claimed key whose request failed"""
+        with db_pool.connection() as conn, conn:
+            conn.execute(SQL_ABANDON_IDEMPOTENCY, (key,))
+
+    def _prune(self, now):
+        # Expired keys are deleted at most once a minute, off the hot path of replays
+        if now - self._pruned_at < 60:
+            return
+        self._pruned_at = now
+        with db_pool.connection() as conn, conn:
+            conn.execute(SQL_PRUNE_IDEMPOTENCY, (int(now - self.ttl),))
+
+
+idempotency = IdempotencyStore(CONFIG['idempotency_ttl'], CONFIG['idempotency_cache_size'])
+
+def parse_idempotency_key(req):
+    """(key or None, error or None) from the Idempotency-Key header"""
+    key = req.headers.get('Idempotency-Key')
+    if key is None:
+        return None, None
+    if not key or len(key) > IDEMPOTENCY_KEY_MAX or not key.isprintable():
+        return None, f'Idempotency-Key must be 1-{IDEMPOTENCY_KEY_MAX} printable characters'
+    return key, None
+
+def idempotent(view):
+    """
+    Replay the stored response when a request repeats its Idempotency-Key.
+    Auth is checked first so a key can't be used to read someone's response;
+    g.authorized tells the view not to check (and count) it again.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key, error = parse_idempotency_key(request)
+        if error:
+            return jsonify({'success': False, 'error': error}), 400
+        if key is None:
+            return view(*args, **kwargs)
+        if not verify_auth(request):
+            return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+        g.authorized = True
         
-        buffer = io.BytesIO()
-        img.save(buffer, format='PNG')
-        buffer.seek(0)
+        fingerprint = idempotency.fingerprint(request.get_data())
+        try:
+            replay = idempotency.begin(key, fingerprint)
+        except sqlite3.Error as e:
+            return jsonify({'success': False, 'error': f'Database error: {e}'}), 500
+        if replay:
+            body, status = replay
+            response = Response(body, status=status, mimetype='application/json')
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
         
-        return 'data:image/png;base64,' + base64.b64encode(buffer.read()).decode()
-    except ImportError:
-        print("qrcode or pillow not installed - QR generation disabled")
-        return None
-    except Exception as e:
-        print(f"Error generating QR code: {e}")
-        return None
+        response = None
+        try:
+            response = app.make_response(view(*args, **kwargs))
+            return response
+        finally:
+            try:
+                if response is not None and 200 <= response.status_code < 300:
+                    idempotency.complete(key, fingerprint, response.get_data(as_text=True), response.status_code)
+                else:
+                    idempotency.abandon(key)
+            except sqlite3.Error as e:
+                print(f"Error recording Idempotency-Key: {e}")
+    return wrapper
 
 
 # ============== API ENDPOINTS ==============
 
+# Scrape-time views of state the API already keeps
+metrics.add(Collected(
+    'truevault_wg_operations_total', 'wg0 control calls by operation and result', 'counter',
+    lambda: [((op, result), n) for op, s in health_monitor.error_rates().items()
+             for result, n in (('ok', s['calls'] - s['failures']), ('error', s['failures']))],
+    ('operation', 'result')))
+metrics.add(Collected(
+    'truevault_db_pool_idle', 'Idle pooled peers.db connections', 'gauge',
+    lambda: [((), db_pool.idle_count())]))
+metrics.add(Collected(
+    'truevault_db_connections_opened_total', 'peers.db connections opened', 'counter',
+    lambda: [((), db_pool.opened)]))
+metrics.add(Collected(
+    'truevault_reservoir_depth', 'Pre-generated peer slots ready', 'gauge',
+    lambda: [((), peer_reservoir.depth())]))
+metrics.add(Collected(
+    'truevault_free_ips', 'Unallocated client addresses', 'gauge',
+    lambda: [((), ip_allocator.free_count())]))
+metrics.add(Collected(
+    'truevault_qr_cache_requests_total', 'QR cache lookups by result', 'counter',
+    lambda: [(('hit',), qr_cache.hits), (('miss',), qr_cache.misses)], ('result',)))
+metrics.add(Collected(
+    'truevault_auth_cache_hits_total', 'Bearer tokens answered from the verified-token LRU', 'counter',
+    lambda: [((), authenticator.cache_hits)]))
+metrics.add(Collected(
+    'truevault_wg_up', '1 if the last wg0 probe succeeded', 'gauge',
+    lambda: [((), int(bool(health_monitor.online)))] if health_monitor.checked_at else []))
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_latency(response):
+    started = g.get('request_started')
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_LATENCY.observe(time.perf_counter() - started, route, request.method, str(response.status_code))
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus text format - requires auth (bearer_token in the scrape config)"""
+    if not verify_auth(request):
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
-    """Health check endpoint - no auth required"""
-    try:
-        wg_status = subprocess.run(['wg', 'show', 'wg0'], capture_output=True)
-        is_online = wg_status.returncode == 0
-    except:
-        is_online = False
+    """Health check endpoint - no auth required, served from the cached wg0 probe"""
+    return jsonify(health_summary())
+
+@app.route('/api/health/deep', methods=['GET'])
+def health_deep():
+    """
+    Health check plus live DB latency, peer count, free IPs and wg0 call
+    error rates - requires auth (it queries peers.db on every call)
+    """
+    if not verify_auth(request):
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
     
-    return jsonify({
-        'status': 'online' if is_online else 'degraded',
-        'server': CONFIG['server_name'],
-        'ip': CONFIG['server_ip'],
-        'port': CONFIG['server_port'],
-        'timestamp': datetime.utcnow().isoformat() + 'Z'
-    })
+    return jsonify(deep_health_summary())
 
 @app.route('/api/server-info', methods=['GET'])
 def server_info():
@@ -204,18 +2680,24 @@ def server_info():
         'port': CONFIG['server_port'],
         'public_key': public_key,
         'dns': CONFIG['dns_servers'],
-        'subnet': CONFIG['subnet_base'] + '.0/24'
+        'subnet': ip_allocator.describe()
     })
 
 @app.route('/api/create-peer', methods=['POST'])
+@idempotent
 def create_peer():
     """
     Create new peer - generates keys, adds to WireGuard, returns config
     
+    Optional header: Idempotency-Key: <unique per logical request>. A retry
+    with the same key and body gets the original response back (with
+    Idempotent-Replayed: true) instead of a second peer.
+    
     Request Body:
     {
         "user_id": 123,
-        "device_name": "laptop"
+        "device_name": "laptop",
+        "qr_format": "png"          (optional: png, svg, matrix or none)
     }
     
     Response:
@@ -228,7 +2710,7 @@ def create_peer():
     }
     """
     # Verify authentication
-    if not verify_auth(request):
+    if not g.get('authorized') and not verify_auth(request):
         return jsonify({'success': False, 'error': 'Unauthorized'}), 401
     
     # Parse request
@@ -243,43 +2725,49 @@ def create_peer():
     if not user_id:
         return jsonify({'success': False, 'error': 'user_id required'}), 400
     
-    # Get next available IP
-    assigned_ip = get_next_ip()
-    if not assigned_ip:
-        return jsonify({'success': False, 'error': 'No IPs available on this server'}), 503
+    qr_format, error = parse_qr_format(data)
+    if error:
+        return jsonify({'success': False, 'error': error}), 400
     
-    # Generate keypair
-    private_key, public_key = generate_keypair()
-    if not private_key or not public_key:
-        return jsonify({'success': False, 'error': 'Failed to generate keypair'}), 500
+    # Take a pre-generated keypair and reserved IP, or make them now
+    stages = StageTimer('create_peer')
+    slot, error = next_peer_slot(stages)
+    if error:
+        return jsonify({'success': False, 'error': error[0]}), error[1]
+    private_key, public_key, assigned_ip = slot
     
     # Add peer to WireGuard
-    if not add_peer_to_wireguard(public_key, assigned_ip):
+    added = add_peer_to_wireguard(public_key, assigned_ip)
+    stages.mark('wg_set')
+    if not added:
+        ip_allocator.release(assigned_ip)
         return jsonify({'success': False, 'error': 'Failed to add peer to WireGuard'}), 500
     
     # Store in local database
     try:
-        conn = sqlite3.connect(CONFIG['db_path'])
-        c = conn.cursor()
-        c.execute('''
-            INSERT INTO peers (user_id, device_name, public_key, private_key, assigned_ip)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (user_id, device_name, public_key, private_key, assigned_ip))
-        conn.commit()
-        peer_id = c.lastrowid
-        conn.close()
+        with db_pool.write('create_peer') as conn:
+            # assigned_ip is UNIQUE, so drop any removed peer still holding it
+            conn.execute(SQL_CLEAR_STALE_IP, (assigned_ip,))
+            cursor = conn.execute(SQL_INSERT_PEER, peer_row(user_id, device_name, public_key, private_key, assigned_ip))
+            peer_id = cursor.lastrowid
     except sqlite3.IntegrityError as e:
+        remove_peer_from_wireguard(public_key)
+        ip_allocator.release(assigned_ip)
         return jsonify({'success': False, 'error': f'Database error: {e}'}), 500
+    stages.mark('db_insert')
     
     # Generate config file
     server_public_key = get_server_public_key()
+    stages.mark('server_key')
     if not server_public_key:
         return jsonify({'success': False, 'error': 'Server public key not found'}), 500
     
     config = generate_config(private_key, assigned_ip, server_public_key)
+    stages.mark('config')
     
     # Generate QR code
-    qr_code = generate_qr_code(config)
+    qr_code = generate_qr_code(config, qr_format) if qr_format != 'none' else None
+    stages.mark('qr')
     
     return jsonify({
         'success': True,
@@ -292,6 +2780,97 @@ def create_peer():
         'server_ip': CONFIG['server_ip']
     })
 
+@app.route('/api/create-peers', methods=['POST'])
+def create_peers():
+    """
+    Bulk create-peer - one `wg addconf` and one DB transaction for N peers
+    
+    Request Body:
+    {
+        "peers": [
+            {"user_id": 123, "device_name": "laptop"},
+            {"user_id": 124, "device_name": "phone"}
+        ],
+        "qr_code": false,
+        "qr_format": "png"          (used when qr_code is true: png, svg or matrix)
+    }
+    
+    Response (application/x-ndjson, one line per peer, in request order):
+    {"success": true, "peer_id": 1, "user_id": 123, "device_name": "laptop",
+     "config": "[Interface]\n...", "assigned_ip": "10.8.0.15", "public_key": "abc123..."}
+    """
+    if not verify_auth(request):
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+    
+    try:
+        data = request.get_json()
+    except:
+        return jsonify({'success': False, 'error': 'Invalid JSON'}), 400
+    
+    requested = data.get('peers') if isinstance(data, dict) else None
+    if not requested or not isinstance(requested, list):
+        return jsonify({'success': False, 'error': 'peers list required'}), 400
+    if len(requested) > CONFIG['max_batch_peers']:
+        return jsonify({'success': False, 'error': f"At most {CONFIG['max_batch_peers']} peers per request"}), 400
+    if not all(isinstance(p, dict) and p.get('user_id') for p in requested):
+        return jsonify({'success': False, 'error': 'user_id required for every peer'}), 400
+    include_qr = bool(data.get('qr_code', False))
+    qr_format, error = parse_qr_format(data)
+    if error:
+        return jsonify({'success': False, 'error': error}), 400
+    include_qr = include_qr and qr_format != 'none'
+    
+    server_public_key = get_server_public_key()
+    if not server_public_key:
+        return jsonify({'success': False, 'error': 'Server public key not found'}), 500
+    
+    # Allocate everything up front so a shortage fails the whole batch
+    slots = []
+    for _ in requested:
+        slot, error = next_peer_slot()
+        if error:
+            for _, _, assigned_ip in slots:
+                ip_allocator.release(assigned_ip)
+            return jsonify({'success': False, 'error': error[0]}), error[1]
+        slots.append(slot)
+    
+    if not add_peers_to_wireguard([(public_key, assigned_ip) for _, public_key, assigned_ip in slots]):
+        for _, _, assigned_ip in slots:
+            ip_allocator.release(assigned_ip)
+        return jsonify({'success': False, 'error': 'Failed to add peers to WireGuard'}), 500
+    
+    rows = [
+        (p['user_id'], p.get('device_name', 'device'), public_key, private_key, assigned_ip)
+        for p, (private_key, public_key, assigned_ip) in zip(requested, slots)
+    ]
+    try:
+        with db_pool.write('create_peers') as conn:
+            conn.executemany(SQL_CLEAR_STALE_IP, [(row[4],) for row in rows])
+            peer_ids = [conn.execute(SQL_INSERT_PEER, peer_row(*row)).lastrowid for row in rows]
+    except sqlite3.IntegrityError as e:
+        remove_peers_from_wireguard([row[2] for row in rows])
+        for row in rows:
+            ip_allocator.release(row[4])
+        return jsonify({'success': False, 'error': f'Database error: {e}'}), 500
+    
+    def stream():
+        for peer_id, (user_id, device_name, public_key, private_key, assigned_ip) in zip(peer_ids, rows):
+            config = generate_config(private_key, assigned_ip, server_public_key)
+            line = {
+                'success': True,
+                'peer_id': peer_id,
+                'user_id': user_id,
+                'device_name': device_name,
+                'config': config,
+                'assigned_ip': assigned_ip,
+                'public_key': public_key
+            }
+            if include_qr:
+                line['qr_code'] = generate_qr_code(config, qr_format)
+            yield json.dumps(line) + '\n'
+    
+    return Response(stream(), mimetype='application/x-ndjson')
+
 @app.route('/api/remove-peer', methods=['POST'])
 def remove_peer():
     """
@@ -319,14 +2898,15 @@ def remove_peer():
     if not remove_peer_from_wireguard(public_key):
         return jsonify({'success': False, 'error': 'Failed to remove peer from WireGuard'}), 500
     
-    # Mark inactive in database
+    # Mark inactive in database and return the address to the allocator
+    affected = 0
     try:
-        conn = sqlite3.connect(CONFIG['db_path'])
-        c = conn.cursor()
-        c.execute('UPDATE peers SET is_active = 0 WHERE public_key = ?', (public_key,))
-        affected = c.rowcount
-        conn.commit()
-        conn.close()
+        with db_pool.write('remove_peer') as conn:
+            public_blob = key_blob(public_key)
+            freed_ips = [row[0] for row in conn.execute(SQL_PEER_IP, (public_blob,))]
+            affected = conn.execute(SQL_DEACTIVATE_PEER, (public_blob,)).rowcount
+        for ip in freed_ips:
+            ip_allocator.release(ip)
     except Exception as e:
         print(f"Database error: {e}")
     
@@ -338,38 +2918,126 @@ def remove_peer():
 
 @app.route('/api/list-peers', methods=['GET'])
 def list_peers():
-    """List all peers currently on this server"""
+    """
+    List peers currently on this server
+    
+    The dump is parsed line by line from the `wg` pipe and written out as a
+    chunked JSON response, so memory stays flat regardless of peer count.
+    
+    Query parameters (all optional):
+      limit=100            - page size (default: all peers)
+      cursor=<public_key>  - start after this peer (next_cursor of the previous page)
+      active_since=<ts>    - only peers with a handshake at or after this unix time
+      min_rx=<bytes>       - only peers with transfer_rx >= bytes
+      min_tx=<bytes>       - only peers with transfer_tx >= bytes
+      allowed_ip=10.8.0.0/24 - only peers with an allowed-ip inside this address or network
+      fields=public_key,transfer_rx - only include these fields
+    
+    A cursor whose peer was removed between pages gets 410; start over
+    from the first page.
+    """
     if not verify_auth(request):
         return jsonify({'success': False, 'error': 'Unauthorized'}), 401
     
+    try:
+        query = PeerListQuery(request.args)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
     # Get from WireGuard
     try:
-        result = subprocess.run(['wg', 'show', 'wg0', 'dump'], capture_output=True, text=True)
-        
-        peers = []
-        lines = result.stdout.strip().split('\n')
-        
-        # First line is server info, rest are peers
-        for line in lines[1:]:
-            parts = line.split('\t')
-            if len(parts) >= 4:
-                peers.append({
-                    'public_key': parts[0],
-                    'preshared_key': parts[1] if parts[1] != '(none)' else None,
-                    'endpoint': parts[2] if parts[2] != '(none)' else None,
-                    'allowed_ips': parts[3],
-                    'last_handshake': int(parts[4]) if len(parts) > 4 and parts[4] != '0' else None,
-                    'transfer_rx': int(parts[5]) if len(parts) > 5 else 0,
-                    'transfer_tx': int(parts[6]) if len(parts) > 6 else 0
-                })
-        
-        return jsonify({
-            'success': True,
-            'peer_count': len(peers),
-            'peers': peers
-        })
+        dump = wg_control.open_dump()
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
+    
+    # Skip to the cursor before answering, so a stale cursor can still get an error status
+    peers = iter(dump)
+    if not query.skip_to_cursor(peers):
+        dump_ok = dump.close()
+        health_monitor.record('dump', dump_ok)
+        if not dump_ok:
+            return jsonify({'success': False, 'error': 'Failed to read the wg0 dump'}), 500
+        return jsonify({'success': False, 'error': 'cursor not found; restart from the first page'}), 410
+    
+    def stream():
+        try:
+            yield query.header()
+            for peer in peers:
+                item = query.feed(peer)
+                if item is PAGE_FULL:
+                    break
+                if item is not None:
+                    yield query.encode(item)
+        finally:
+            dump_ok = dump.close()
+            health_monitor.record('dump', dump_ok)
+        yield query.footer(dump_ok)
+    
+    return Response(stream(), mimetype='application/json')
+
+@app.route('/api/peer-stats', methods=['GET'])
+def peer_stats_since():
+    """
+    Peers whose rx/tx/handshake changed since a timestamp
+    
+    Query: ?since=<unix ts> (default 0). Pass the returned `sampled_at` as
+    `since` on the next poll. `complete` is false if `since` is older than the
+    sampler's history, in which case fall back to /api/list-peers.
+    
+    Response:
+    {
+        "success": true,
+        "sampled_at": 1700000000.0,
+        "complete": true,
+        "peers": [{"public_key": "...", "transfer_rx": 1, "transfer_tx": 2,
+                   "last_handshake": 1700000000, "rx_delta": 1, "tx_delta": 2}],
+        "removed": ["..."]
+    }
+    """
+    if not verify_auth(request):
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+    
+    try:
+        since = float(request.args.get('since', 0))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'since must be a unix timestamp'}), 400
+    
+    if not peer_stats.running():
+        return jsonify({'success': False, 'error': 'Peer stats sampler not running'}), 503
+    
+    peers, removed, complete = peer_stats.changed_since(since)
+    return jsonify({
+        'success': True,
+        'sampled_at': peer_stats.last_sample,
+        'complete': complete,
+        'peer_count': len(peers),
+        'peers': peers,
+        'removed': removed
+    })
+
+@app.route('/api/auth/token', methods=['POST'])
+def auth_token():
+    """
+    Mint a short-lived signed token - requires an API secret, not a token
+    
+    Request Body (optional): {"ttl": 300}  (seconds, capped at AUTH_TOKEN_TTL)
+    Response: {"success": true, "token": "tv1.…", "expires_at": 1700000300}
+    """
+    if not verify_auth(request, static_only=True):
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+    
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        data = {}
+    try:
+        ttl = int(data['ttl']) if data.get('ttl') is not None else None
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'ttl must be an integer'}), 400
+    if ttl is not None and ttl <= 0:
+        return jsonify({'success': False, 'error': 'ttl must be positive'}), 400
+    
+    token, expires = authenticator.mint(ttl)
+    return jsonify({'success': True, 'token': token, 'expires_at': expires})
 
 @app.route('/api/get-config', methods=['POST'])
 def get_config():
@@ -378,7 +3046,8 @@ def get_config():
     
     Request Body:
     {
-        "public_key": "abc123..."
+        "public_key": "abc123...",
+        "qr_format": "png"          (optional: png, svg, matrix or none)
     }
     """
     if not verify_auth(request):
@@ -394,21 +3063,28 @@ def get_config():
     if not public_key:
         return jsonify({'success': False, 'error': 'public_key required'}), 400
     
+    qr_format, error = parse_qr_format(data)
+    if error:
+        return jsonify({'success': False, 'error': error}), 400
+    
     # Get peer from database
-    conn = sqlite3.connect(CONFIG['db_path'])
-    c = conn.cursor()
-    c.execute('SELECT private_key, assigned_ip FROM peers WHERE public_key = ? AND is_active = 1', (public_key,))
-    row = c.fetchone()
-    conn.close()
+    with db_pool.connection() as conn:
+        row = conn.execute(SQL_PEER_CONFIG, (key_blob(public_key),)).fetchone()
     
     if not row:
         return jsonify({'success': False, 'error': 'Peer not found'}), 404
     
-    private_key, assigned_ip = row
+    sealed_key, assigned_ip = row
     server_public_key = get_server_public_key()
     
+    try:
+        private_key = private_key_box.open_private_key(sealed_key)
+    except ValueError as e:
+        print(f"Error opening private key: {e}")
+        return jsonify({'success': False, 'error': 'Stored private key cannot be decrypted'}), 500
+    
     config = generate_config(private_key, assigned_ip, server_public_key)
-    qr_code = generate_qr_code(config)
+    qr_code = generate_qr_code(config, qr_format) if qr_format != 'none' else None
     
     return jsonify({
         'success': True,
@@ -419,6 +3095,51 @@ def get_config():
 
 # ============== MAIN ==============
 
+def handle_sighup(signum, frame):
+    """Reload cached server identity and config template"""
+    global CONFIG_TEMPLATE
+    server_identity.invalidate()
+    CONFIG_TEMPLATE = compile_config_template()
+    print("SIGHUP received - server identity will be reloaded")
+
+def reconcile_on_startup():
+    """Run the reconcile as configured by RECONCILE; never fatal"""
+    if CONFIG['reconcile'] == 'off':
+        return
+    try:
+        reconcile_wireguard(remove_orphans=CONFIG['reconcile'] == 'remove-orphans')
+    except Exception as e:
+        print(f"Error reconciling wg0 with peers.db: {e}")
+
+def start_services(init=True, write_handshakes=True, workers=1):
+    """
+    Initialize the database, reconcile wg0 with it and start background
+    workers (shared by all servers).
+    Pre-forked workers pass init=False (the master ran init_db) and the
+    worker count; only one of them writes handshakes and samples wg0.
+    """
+    if init:
+        init_db()
+        reconcile_on_startup()
+    
+    # Pre-generate keypairs/IPs for create-peer bursts
+    peer_reservoir.workers = workers
+    peer_reservoir.start()
+    
+    # Probe wg0 in the background so /api/health never forks
+    health_monitor.start()
+    
+    # Sample wg0 counters for /api/peer-stats and persist handshakes
+    if write_handshakes:
+        handshake_writer.start(peer_stats)
+        peer_stats.start(publish=workers > 1)
+    else:
+        peer_stats.follow()
+    
+    # Expire idle peers; the handshake writer is the one process that does it
+    if write_handshakes:
+        peer_expiry.start()
+
 if __name__ == '__main__':
     print("=" * 50)
     print("TrueVault VPN - Key Generation API")
@@ -427,11 +3148,15 @@ if __name__ == '__main__':
     print(f"Server IP: {CONFIG['server_ip']}")
     print(f"WireGuard Port: {CONFIG['server_port']}")
     print(f"API Port: {CONFIG['api_port']}")
-    print(f"Subnet: {CONFIG['subnet_base']}.0/24")
+    print(f"Client Networks: {ip_allocator.describe()}")
+    print(f"Key Generation: {KEYGEN_BACKEND}")
+    print(f"WireGuard Control: {wg_control.name}")
     print("=" * 50)
     
-    # Initialize database
-    init_db()
+    # Initialize database and background workers
+    start_services()
+    
+    signal.signal(signal.SIGHUP, handle_sighup)
     
     # Get and display server public key
     pub_key = get_server_public_key()
@@ -0,0 +1,646 @@
+#!/usr/bin/env python3
+"""
+TrueVault VPN - Server-Side Key Generation API (asyncio variant)
+Deploy next to api.py: /opt/truevault/api_async.py
+
+Same routes and responses as api.py, served by Quart on an ASGI server.
+With the cli WireGuard backend `wg` is run with asyncio.create_subprocess_exec
+behind a bounded semaphore; netlink/fake backend calls and SQLite calls run
+on worker threads, so a slow kernel call or DB write
+never ties up a request thread. All state (allocator, reservoir, caches,
+stats sampler) is shared with api.py.
+
+INSTALL:
+  pip install quart uvicorn
+
+RUN:
+  uvicorn api_async:app --host 0.0.0.0 --port 8443
+  (or: python api_async.py)
+"""
+
+from quart import Quart, Response, request, jsonify, g
+import asyncio
+import json
+import os
+import signal
+import sqlite3
+import time
+from functools import wraps
+
+import api
+from api import CONFIG
+
+app = Quart(__name__)
+
+# Upper bound on concurrent `wg` processes
+WG_CONCURRENCY = int(os.environ.get('WG_CONCURRENCY', '16'))
+wg_semaphore = asyncio.BoundedSemaphore(WG_CONCURRENCY)
+
+# Only the cli backend forks `wg`; netlink/fake are called in-process
+WG_FORKS = api.wg_control.name == 'cli'
+
+
+# ============== ASYNC HELPERS ==============
+
+async def run_wg(*args, input=None):
+    """Run `wg args...`, return (returncode, stdout, stderr)"""
+    async with wg_semaphore:
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                'wg', *args,
+                stdin=asyncio.subprocess.PIPE if input is not None else asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+        except OSError as e:
+            api.SUBPROCESS_FAILURES.inc(args[0])
+            return -1, '', str(e)
+        stdout, stderr = await proc.communicate(input.encode() if input is not None else None)
+        if proc.returncode != 0:
+            api.SUBPROCESS_FAILURES.inc(args[0])
+        return proc.returncode, stdout.decode(), stderr.decode()
+
+
+class AsyncDB:
+    """asyncio front end to api.db_pool; each call runs on a worker thread"""
+
+    @staticmethod
+    def _transaction(fn, operation):
+        if operation:
+            with api.db_pool.write(operation) as conn:
+                return fn(conn)
+        with api.db_pool.connection() as conn, conn:
+            return fn(conn)
+
+    async def transaction(self, fn, operation=None):
+        """
+        Run fn(conn) inside one transaction, return its result. Writes name
+        their operation to take the lock up front (see api.DBPool.write).
+        """
+        return await asyncio.to_thread(self._transaction, fn, operation)
+
+    async def fetchone(self, sql, params=()):
+        return await self.transaction(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql, params=()):
+        return await self.transaction(lambda conn: conn.execute(sql, params).fetchall())
+
+
+db = AsyncDB()
+
+
+async def add_peer_to_wireguard(public_key, assigned_ip):
+    if not WG_FORKS:
+        return await asyncio.to_thread(api.add_peer_to_wireguard, public_key, assigned_ip)
+    allowed_ips = api.ip_allocator.allowed_ips(assigned_ip)
+    returncode, _, stderr = await run_wg('set', 'wg0', 'peer', public_key, 'allowed-ips', allowed_ips)
+    if returncode != 0:
+        print(f"Error adding peer: {stderr}")
+    return api.health_monitor.record('add_peer', returncode == 0)
+
+
+async def add_peers_to_wireguard(peers):
+    if not WG_FORKS:
+        return await asyncio.to_thread(api.add_peers_to_wireguard, peers)
+    conf = ''.join(
+        f"[Peer]\nPublicKey = {public_key}\nAllowedIPs = {api.ip_allocator.allowed_ips(assigned_ip)}\n\n"
+        for public_key, assigned_ip in peers
+    )
+    returncode, _, stderr = await run_wg('addconf', 'wg0', '/dev/stdin', input=conf)
+    if returncode != 0:
+        print(f"Error adding peers: {stderr}")
+    return api.health_monitor.record('add_peers', returncode == 0)
+
+
+async def remove_peers_from_wireguard(public_keys):
+    if not WG_FORKS:
+        return await asyncio.to_thread(api.remove_peers_from_wireguard, public_keys)
+    args = ['set', 'wg0']
+    for public_key in public_keys:
+        args += ['peer', public_key, 'remove']
+    returncode, _, _ = await run_wg(*args)
+    return api.health_monitor.record('remove_peers', returncode == 0)
+
+
+async def next_peer_slot(stages=None):
+    """api.next_peer_slot(), off the event loop when keygen has to fork `wg`"""
+    if api.KEYGEN_BACKEND == 'wg':
+        return await asyncio.to_thread(api.next_peer_slot, stages)
+    return api.next_peer_slot(stages)
+
+
+async def get_server_public_key():
+    return await asyncio.to_thread(api.get_server_public_key)
+
+
+async def generate_qr_code(config, qr_format):
+    if qr_format == 'none':
+        return None
+    return await asyncio.to_thread(api.generate_qr_code, config, qr_format)
+
+
+async def read_json():
+    """Request body as a dict, or None if it isn't valid JSON"""
+    try:
+        data = await request.get_json(force=True)
+    except Exception:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def idempotent(view):
+    """Idempotency-Key replay for an async view - see api.idempotent"""
+    @wraps(view)
+    async def wrapper(*args, **kwargs):
+        key, error = api.parse_idempotency_key(request)
+        if error:
+            return jsonify({'success': False, 'error': error}), 400
+        if key is None:
+            return await view(*args, **kwargs)
+        if not api.verify_auth(request):
+            return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+        g.authorized = True
+
+        fingerprint = api.idempotency.fingerprint(await request.get_data())
+        try:
+            replay = await asyncio.to_thread(api.idempotency.begin, key, fingerprint)
+        except sqlite3.Error as e:
+            return jsonify({'success': False, 'error': f'Database error: {e}'}), 500
+        if replay:
+            body, status = replay
+            return Response(body, status=status, mimetype='application/json',
+                            headers={'Idempotent-Replayed': 'true'})
+
+        response = None
+        try:
+            response = await app.make_response(await view(*args, **kwargs))
+            return response
+        finally:
+            try:
+                if response is not None and 200 <= response.status_code < 300:
+                    body = await response.get_data(as_text=True)
+                    await asyncio.to_thread(api.idempotency.complete, key, fingerprint, body, response.status_code)
+                else:
+                    await asyncio.to_thread(api.idempotency.abandon, key)
+            except sqlite3.Error as e:
+                print(f"Error recording Idempotency-Key: {e}")
+    return wrapper
+
+
+# ============== API ENDPOINTS ==============
+
+@app.before_request
+async def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+async def record_request_latency(response):
+    started = g.get('request_started')
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        api.REQUEST_LATENCY.observe(time.perf_counter() - started, route, request.method, str(response.status_code))
+    return response
+
+@app.route('/metrics', methods=['GET'])
+async def prometheus_metrics():
+    """Prometheus text format - see api.prometheus_metrics"""
+    if not api.verify_auth(request):
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+    return Response(api.metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/health', methods=['GET'])
+async def health_check():
+    """Health check endpoint - no auth required, served from the cached wg0 probe"""
+    if api.health_monitor.running():
+        return jsonify(api.health_summary())
+    # No background probe: checking wg0 may fork, keep it off the loop
+    return jsonify(await asyncio.to_thread(api.health_summary))
+
+@app.route('/api/health/deep', methods=['GET'])
+async def health_deep():
+    """Health plus DB latency, peer count, free IPs, wg error rates - see api.health_deep"""
+    if not api.verify_auth(request):
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+
+    return jsonify(await asyncio.to_thread(api.deep_health_summary))
+
+@app.route('/api/server-info', methods=['GET'])
+async def server_info():
+    """Get server information including public key - no auth required"""
+    return jsonify({
+        'name': CONFIG['server_name'],
+        'ip': CONFIG['server_ip'],
+        'port': CONFIG['server_port'],
+        'public_key': await get_server_public_key(),
+        'dns': CONFIG['dns_servers'],
+        'subnet': api.ip_allocator.describe()
+    })
+
+@app.route('/api/create-peer', methods=['POST'])
+@idempotent
+async def create_peer():
+    """Create new peer - see api.create_peer"""
+    if not g.get('authorized') and not api.verify_auth(request):
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+
+    data = await read_json()
+    if data is None:
+        return jsonify({'success': False, 'error': 'Invalid JSON'}), 400
+
+    user_id = data.get('user_id')
+    device_name = data.get('device_name', 'device')
+
+    if not user_id:
+        return jsonify({'success': False, 'error': 'user_id required'}), 400
+
+    qr_format, error = api.parse_qr_format(data)
+    if error:
+        return jsonify({'success': False, 'error': error}), 400
+
+    stages = api.StageTimer('create_peer')
+    slot, error = await next_peer_slot(stages)
+    if error:
+        return jsonify({'success': False, 'error': error[0]}), error[1]
+    private_key, public_key, assigned_ip = slot
+
+    added = await add_peer_to_wireguard(public_key, assigned_ip)
+    stages.mark('wg_set')
+    if not added:
+        api.ip_allocator.release(assigned_ip)
+        return jsonify({'success': False, 'error': 'Failed to add peer to WireGuard'}), 500
+
+    def insert(conn):
+        conn.execute(api.SQL_CLEAR_STALE_IP, (assigned_ip,))
+        return conn.execute(api.SQL_INSERT_PEER, api.peer_row(user_id, device_name, public_key, private_key, assigned_ip)).lastrowid
+
+    try:
+        peer_id = await db.transaction(insert, 'create_peer')
+    except sqlite3.IntegrityError as e:
+        await remove_peers_from_wireguard([public_key])
+        api.ip_allocator.release(assigned_ip)
+        return jsonify({'success': False, 'error': f'Database error: {e}'}), 500
+    stages.mark('db_insert')
+
+    server_public_key = await get_server_public_key()
+    stages.mark('server_key')
+    if not server_public_key:
+        return jsonify({'success': False, 'error': 'Server public key not found'}), 500
+
+    config = api.generate_config(private_key, assigned_ip, server_public_key)
+    stages.mark('config')
+    qr_code = await generate_qr_code(config, qr_format)
+    stages.mark('qr')
+
+    return jsonify({
+        'success': True,
+        'peer_id': peer_id,
+        'config': config,
+        'assigned_ip': assigned_ip,
+        'public_key': public_key,
+        'qr_code': qr_code,
+        'server_name': CONFIG['server_name'],
+        'server_ip': CONFIG['server_ip']
+    })
+
+@app.route('/api/create-peers', methods=['POST'])
+async def create_peers():
+    """Bulk create-peer, streamed as NDJSON - see api.create_peers"""
+    if not api.verify_auth(request):
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+
+    data = await read_json()
+    if data is None:
+        return jsonify({'success': False, 'error': 'Invalid JSON'}), 400
+
+    requested = data.get('peers')
+    if not requested or not isinstance(requested, list):
+        return jsonify({'success': False, 'error': 'peers list required'}), 400
+    if len(requested) > CONFIG['max_batch_peers']:
+        return jsonify({'success': False, 'error': f"At most {CONFIG['max_batch_peers']} peers per request"}), 400
+    if not all(isinstance(p, dict) and p.get('user_id') for p in requested):
+        return jsonify({'success': False, 'error': 'user_id required for every peer'}), 400
+    qr_format, error = api.parse_qr_format(data)
+    if error:
+        return jsonify({'success': False, 'error': error}), 400
+    if not data.get('qr_code', False):
+        qr_format = 'none'
+
+    server_public_key = await get_server_public_key()
+    if not server_public_key:
+        return jsonify({'success': False, 'error': 'Server public key not found'}), 500
+
+    slots = []
+    for _ in requested:
+        slot, error = await next_peer_slot()
+        if error:
+            for _, _, assigned_ip in slots:
+                api.ip_allocator.release(assigned_ip)
+            return jsonify({'success': False, 'error': error[0]}), error[1]
+        slots.append(slot)
+
+    if not await add_peers_to_wireguard([(public_key, assigned_ip) for _, public_key, assigned_ip in slots]):
+        for _, _, assigned_ip in slots:
+            api.ip_allocator.release(assigned_ip)
+        return jsonify({'success': False, 'error': 'Failed to add peers to WireGuard'}), 500
+
+    rows = [
+        (p['user_id'], p.get('device_name', 'device'), public_key, private_key, assigned_ip)
+        for p, (private_key, public_key, assigned_ip) in zip(requested, slots)
+    ]
+
+    def insert(conn):
+        conn.executemany(api.SQL_CLEAR_STALE_IP, [(row[4],) for row in rows])
+        return [conn.execute(api.SQL_INSERT_PEER, api.peer_row(*row)).lastrowid for row in rows]
+
+    try:
+        peer_ids = await db.transaction(insert, 'create_peers')
+    except sqlite3.IntegrityError as e:
+        await remove_peers_from_wireguard([row[2] for row in rows])
+        for row in rows:
+            api.ip_allocator.release(row[4])
+        return jsonify({'success': False, 'error': f'Database error: {e}'}), 500
+
+    async def stream():
+        for peer_id, (user_id, device_name, public_key, private_key, assigned_ip) in zip(peer_ids, rows):
+            config = api.generate_config(private_key, assigned_ip, server_public_key)
+            line = {
+                'success': True,
+                'peer_id': peer_id,
+                'user_id': user_id,
+                'device_name': device_name,
+                'config': config,
+                'assigned_ip': assigned_ip,
+                'public_key': public_key
+            }
+            if qr_format != 'none':
+                line['qr_code'] = await generate_qr_code(config, qr_format)
+            yield json.dumps(line) + '\n'
+
+    return Response(stream(), mimetype='application/x-ndjson')
+
+@app.route('/api/remove-peer', methods=['POST'])
+async def remove_peer():
+    """Remove a peer from WireGuard - see api.remove_peer"""
+    if not api.verify_auth(request):
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+
+    data = await read_json()
+    if data is None:
+        return jsonify({'success': False, 'error': 'Invalid JSON'}), 400
+
+    public_key = data.get('public_key')
+
+    if not public_key:
+        return jsonify({'success': False, 'error': 'public_key required'}), 400
+
+    if not await remove_peers_from_wireguard([public_key]):
+        return jsonify({'success': False, 'error': 'Failed to remove peer from WireGuard'}), 500
+
+    def deactivate(conn):
+        public_blob = api.key_blob(public_key)
+        freed_ips = [row[0] for row in conn.execute(api.SQL_PEER_IP, (public_blob,))]
+        return freed_ips, conn.execute(api.SQL_DEACTIVATE_PEER, (public_blob,)).rowcount
+
+    affected = 0
+    try:
+        freed_ips, affected = await db.transaction(deactivate, 'remove_peer')
+        for ip in freed_ips:
+            api.ip_allocator.release(ip)
+    except Exception as e:
+        print(f"Database error: {e}")
+
+    return jsonify({
+        'success': True,
+        'message': 'Peer removed',
+        'rows_affected': affected
+    })
+
+@app.route('/api/list-peers', methods=['GET'])
+async def list_peers():
+    """List peers, streamed from the `wg` pipe - see api.list_peers for query parameters"""
+    if not api.verify_auth(request):
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+
+    try:
+        query = api.PeerListQuery(request.args)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+    if not WG_FORKS:
+        return await list_peers_in_process(query)
+
+    await wg_semaphore.acquire()
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            'wg', 'show', 'wg0', 'dump',
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+        )
+    except OSError as e:
+        wg_semaphore.release()
+        return jsonify({'success': False, 'error': str(e)}), 500
+    except BaseException:
+        wg_semaphore.release()
+        raise
+
+    finished = []
+
+    async def finish():
+        """Reap the dump and free its slot, once; True unless wg itself failed"""
+        if finished:
+            return finished[0]
+        # Killing the dump after a full page is not a failed dump
+        killed = proc.returncode is None
+        if killed:
+            try:
+                proc.kill()
+            except ProcessLookupError:
+                pass
+        returncode = None
+        try:
+            returncode = await proc.wait()
+        finally:
+            wg_semaphore.release()
+            finished.append(killed or returncode == 0)
+        api.health_monitor.record('dump', finished[0])
+        return finished[0]
+
+    async def stream():
+        try:
+            # First line is server info, rest are peers. The first item says
+            # whether the cursor was found, so a stale one still gets a status.
+            await proc.stdout.readline()
+            found = query.cursor is None
+            if not found:
+                async for line in proc.stdout:
+                    peer = api.parse_dump_line(line.decode())
+                    if peer and peer['public_key'] == query.cursor:
+                        found = True
+                        break
+            yield found
+            yield query.header()
+            async for line in proc.stdout:
+                peer = api.parse_dump_line(line.decode())
+                if not peer:
+                    continue
+                item = query.feed(peer)
+                if item is api.PAGE_FULL:
+                    break
+                if item is not None:
+                    yield query.encode(item)
+        finally:
+            dump_ok = await finish()
+        yield query.footer(dump_ok)
+
+    # Run the stream up to its first item here. Once started, its finally
+    # reaps the dump even if the response is never sent (asyncio closes
+    # abandoned generators); before that, a cancelled request reaps it below.
+    body = stream()
+    try:
+        found = await body.__anext__()
+    except BaseException:
+        await finish()
+        raise
+    if not found:
+        await body.aclose()
+        if not await finish():
+            return jsonify({'success': False, 'error': 'Failed to read the wg0 dump'}), 500
+        return jsonify({'success': False, 'error': 'cursor not found; restart from the first page'}), 410
+    return Response(body, mimetype='application/json')
+
+async def list_peers_in_process(query):
+    """list-peers for the netlink/fake backends, whose dump is read in one call"""
+    try:
+        dump = await asyncio.to_thread(api.wg_control.open_dump)
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+    peers = iter(dump)
+    if not query.skip_to_cursor(peers):
+        dump_ok = dump.close()
+        api.health_monitor.record('dump', dump_ok)
+        if not dump_ok:
+            return jsonify({'success': False, 'error': 'Failed to read the wg0 dump'}), 500
+        return jsonify({'success': False, 'error': 'cursor not found; restart from the first page'}), 410
+
+    async def stream():
+        try:
+            yield query.header()
+            for peer in peers:
+                item = query.feed(peer)
+                if item is api.PAGE_FULL:
+                    break
+                if item is not None:
+                    yield query.encode(item)
+        finally:
+            dump_ok = dump.close()
+            api.health_monitor.record('dump', dump_ok)
+        yield query.footer(dump_ok)
+
+    return Response(stream(), mimetype='application/json')
+
+@app.route('/api/peer-stats', methods=['GET'])
+async def peer_stats_since():
+    """Peers whose counters changed since a timestamp - see api.peer_stats_since"""
+    if not api.verify_auth(request):
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+
+    try:
+        since = float(request.args.get('since', 0))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'since must be a unix timestamp'}), 400
+
+    if not api.peer_stats.running():
+        return jsonify({'success': False, 'error': 'Peer stats sampler not running'}), 503
+
+    peers, removed, complete = api.peer_stats.changed_since(since)
+    return jsonify({
+        'success': True,
+        'sampled_at': api.peer_stats.last_sample,
+        'complete': complete,
+        'peer_count': len(peers),
+        'peers': peers,
+        'removed': removed
+    })
+
+@app.route('/api/auth/token', methods=['POST'])
+async def auth_token():
+    """Mint a short-lived signed token - see api.auth_token"""
+    if not api.verify_auth(request, static_only=True):
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+
+    data = await read_json() or {}
+    try:
+        ttl = int(data['ttl']) if data.get('ttl') is not None else None
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'ttl must be an integer'}), 400
+    if ttl is not None and ttl <= 0:
+        return jsonify({'success': False, 'error': 'ttl must be positive'}), 400
+
+    token, expires = api.authenticator.mint(ttl)
+    return jsonify({'success': True, 'token': token, 'expires_at': expires})
+
+@app.route('/api/get-config', methods=['POST'])
+async def get_config():
+    """Regenerate config for existing peer - see api.get_config"""
+    if not api.verify_auth(request):
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+
+    data = await read_json()
+    if data is None:
+        return jsonify({'success': False, 'error': 'Invalid JSON'}), 400
+
+    public_key = data.get('public_key')
+
+    if not public_key:
+        return jsonify({'success': False, 'error': 'public_key required'}), 400
+
+    qr_format, error = api.parse_qr_format(data)
+    if error:
+        return jsonify({'success': False, 'error': error}), 400
+
+    row = await db.fetchone(api.SQL_PEER_CONFIG, (api.key_blob(public_key),))
+    if not row:
+        return jsonify({'success': False, 'error': 'Peer not found'}), 404
+
+    sealed_key, assigned_ip = row
+    server_public_key = await get_server_public_key()
+
+    try:
+        private_key = api.private_key_box.open_private_key(sealed_key)
+    except ValueError as e:
+        print(f"Error opening private key: {e}")
+        return jsonify({'success': False, 'error': 'Stored private key cannot be decrypted'}), 500
+
+    config = api.generate_config(private_key, assigned_ip, server_public_key)
+    qr_code = await generate_qr_code(config, qr_format)
+
+    return jsonify({
+        'success': True,
+        'config': config,
+        'qr_code': qr_code
+    })
+
+
+# ============== MAIN ==============
+
+@app.before_serving
+async def startup():
+    api.start_services()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, api.handle_sighup, signal.SIGHUP, None)
+
+if __name__ == '__main__':
+    print("=" * 50)
+    print("TrueVault VPN - Key Generation API (asyncio)")
+    print("=" * 50)
+    print(f"Server Name: {CONFIG['server_name']}")
+    print(f"API Port: {CONFIG['api_port']}")
+    print(f"Key Generation: {api.KEYGEN_BACKEND}")
+    print(f"wg Concurrency: {WG_CONCURRENCY}")
+    print("=" * 50)
+
+    try:
+        import uvicorn
+        uvicorn.run(app, host='0.0.0.0', port=CONFIG['api_port'], log_level='warning')
+    except ImportError:
+        print("uvicorn not installed - falling back to Quart's built-in server")
+        app.run(host='0.0.0.0', port=CONFIG['api_port'])
@@ -0,0 +1,632 @@
+#!/usr/bin/env python3
+"""
+TrueVault VPN - Peer API micro-benchmarks
+Run from this folder on a dev box (not on a live VPN node):
+
+  python benchmarks.py              # run everything
+  python benchmarks.py allocator    # run one benchmark
+
+Benchmarks:
+  allocator  - IP allocation latency, old list scan vs IPAllocator (incl. dual-stack)
+  db         - peers.db requests/sec under 32 concurrent clients
+  keygen     - keypair parity with `wg` and keys/sec per backend
+  bulk       - /api/create-peers vs N x /api/create-peer (stand-in wg)
+  qr         - QR latency for PNG, SVG, raw matrix and cache hits
+  async      - p50/p99 latency, Flask api.py vs asyncio api_async.py (stand-in wg)
+  workers    - serve.py requests/sec per worker count (stand-in wg)
+  wgcontrol  - wg0 operations/sec per WireGuard control backend
+  health     - /api/health latency, probe per request vs cached probe (stand-in wg)
+  auth       - bearer verification cost: secret, signed token, cached token
+  reconcile  - startup reconcile of 10k peers.db rows against wg0 (fake and stand-in wg)
+  storage    - peers.db size and migration time, TEXT keys vs BLOB/sealed keys
+"""
+
+import base64
+import contextlib
+import http.client
+import importlib.util
+import io
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import sqlite3
+import tempfile
+import threading
+import time
+
+import api
+
+
+def timed(fn, iterations):
+    """Run fn iterations times, return microseconds per call"""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1_000_000
+
+
+def report(name, usec):
+    print(f"  {name:<40} {usec:>10.2f} us/op")
+
+
+# Stand-in for the wg CLI so request-path benchmarks run without a kernel
+# module: every command succeeds and `show wg0 public-key` prints a fixed key.
+STAND_IN_WG = """#!/bin/sh
+case "$1 $3" in
+  "genkey ") head -c 32 /dev/urandom | base64 ;;
+  "pubkey ") cat >/dev/null; head -c 32 /dev/urandom | base64 ;;
+  "show public-key") echo "c3RhbmQtaW4tc2VydmVyLWtleS1mb3ItYmVuY2htYXJrcz0=" ;;
+  "show dump") printf 'priv\\tpub\\t51820\\toff\\n' ;;
+  "addconf "*) cat >/dev/null ;;
+esac
+exit 0
+"""
+
+
+def install_stand_in_wg(tmp):
+    """Write the stand-in wg into tmp and put it first on PATH"""
+    wg_path = os.path.join(tmp, 'wg')
+    with open(wg_path, 'w') as f:
+        f.write(STAND_IN_WG)
+    os.chmod(wg_path, 0o755)
+    # Servers started from here must fork the stand-in, not talk netlink
+    os.environ['WG_BACKEND'] = 'cli'
+    if not os.environ['PATH'].startswith(tmp + os.pathsep):
+        os.environ['PATH'] = tmp + os.pathsep + os.environ['PATH']
+
+
+def use_stand_in_api(tmp):
+    """Point the api module at a temp peers.db and a stand-in wg on PATH"""
+    install_stand_in_wg(tmp)
+
+    api.CONFIG['db_path'] = os.path.join(tmp, 'peers.db')
+    api.CONFIG['server_key_path'] = os.path.join(tmp, 'server_public.key')
+    api.db_pool = api.DBPool(api.CONFIG['db_path'])
+    api.server_identity = api.ServerIdentity(api.CONFIG['server_key_path'])
+    api.private_key_box = api.PrivateKeyBox(os.path.join(tmp, 'node.key'))
+    api.wg_control = api.WgCliBackend()
+    api.init_db()
+    return api.app.test_client(), {'Authorization': f"Bearer {api.CONFIG['api_secret']}"}
+
+
+# ============== ALLOCATOR ==============
+
+def bench_allocator():
+    """Allocate + release one address with the subnet nearly full"""
+    print("IP allocation latency")
+    for network, peers in (('10.8.0.0/24', 250), ('10.8.0.0/16', 65000)):
+        allocator = api.IPAllocator([network])
+        used = [allocator.allocate() for _ in range(peers)]
+
+        def cycle():
+            ip = allocator.allocate()
+            allocator.release(ip)
+
+        report(f"IPAllocator {network} @ {peers} peers", timed(cycle, 10000))
+
+        # Previous get_next_ip(): linear walk with a list membership check
+        base = str(allocator.networks[0].network_address).rsplit('.', 1)[0]
+
+        def legacy_scan():
+            for i in range(2, 255):
+                ip = f"{base}.{i}"
+                if ip not in used:
+                    return ip
+            return None
+
+        iterations = 200 if peers < 1000 else 5
+        report(f"list scan  {network} @ {peers} peers", timed(legacy_scan, iterations))
+
+    # Dual-stack, several pools: index lookups are a bisect over the pools
+    allocator = api.IPAllocator(['10.8.0.0/16', '10.9.0.0/16', '10.10.0.0/24'], 'fd42:42::/64')
+    for _ in range(130000):
+        allocator.allocate()
+    ip = allocator.allocate()
+    report("IPAllocator 2x/16 + /24 + /64 @ 130k peers",
+           timed(lambda: allocator.release(allocator.allocate()), 10000))
+    report("  IPv6 pair + allowed-ips for one peer", timed(lambda: allocator.allowed_ips(ip), 10000))
+
+
+# ============== DATABASE ==============
+
+def run_clients(clients, requests_per_client, handler):
+    """Run handler(client, n) from concurrent threads, return (req/sec, errors)"""
+    errors = []
+
+    def worker(client):
+        for n in range(requests_per_client):
+            try:
+                handler(client, n)
+            except sqlite3.Error as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    return clients * requests_per_client / elapsed, len(errors)
+
+
+def bench_db(clients=32, requests_per_client=100):
+    """create-peer style insert followed by a get-config style lookup"""
+    print(f"peers.db throughput, {clients} concurrent clients")
+    with tempfile.TemporaryDirectory() as tmp:
+        # Before: a fresh connection per request, default rollback journal
+        legacy_path = os.path.join(tmp, 'legacy.db')
+        conn = sqlite3.connect(legacy_path)
+        api.init_schema(conn)
+        conn.close()
+
+        def legacy(client, n):
+            key = f"legacy-{client}-{n}"
+            conn = sqlite3.connect(legacy_path)
+            conn.execute(api.SQL_INSERT_PEER, (client, 'bench', key, 'priv', key))
+            conn.commit()
+            conn.close()
+            conn = sqlite3.connect(legacy_path)
+            conn.execute(api.SQL_PEER_CONFIG, (key,)).fetchone()
+            conn.close()
+
+        rate, errors = run_clients(clients, requests_per_client, legacy)
+        print(f"  {'connect per request':<40} {rate:>10.0f} req/s  ({errors} errors)")
+
+        # After: pooled WAL connections
+        pool = api.DBPool(os.path.join(tmp, 'pooled.db'))
+        with pool.connection() as conn:
+            api.init_schema(conn)
+
+        def pooled(client, n):
+            key = f"pooled-{client}-{n}"
+            with pool.connection() as conn, conn:
+                conn.execute(api.SQL_INSERT_PEER, (client, 'bench', key, 'priv', key))
+            with pool.connection() as conn:
+                conn.execute(api.SQL_PEER_CONFIG, (key,)).fetchone()
+
+        rate, errors = run_clients(clients, requests_per_client, pooled)
+        print(f"  {'DBPool (WAL)':<40} {rate:>10.0f} req/s  ({errors} errors)")
+        pool.close_all()
+
+
+# ============== KEY GENERATION ==============
+
+# RFC 7748 section 6.1 X25519 vectors; `wg pubkey` gives the same output for
+# these private keys because it clamps before the scalar multiplication.
+KEYGEN_VECTORS = [
+    ('dwdtCnMYpX08FsFyUbJmRd9ML4frwJkqsXf7pR25LCo=', 'hSDwCYkwp1R0i33ctD73Wg2/Og0mOBr066SpjqqbTmo='),
+    ('XasIfmJKikt54X+Lg4AO5m87sSkmGLb9HC+LJ/+I4Os=', '3p7bfXt9wbTTW2HC7OQ1Nz+DQ8hbeGdNrfx+FG+IK08='),
+]
+
+
+def check_keygen_parity():
+    """Compare the in-process backend against known vectors and the wg binary"""
+    for private_b64, public_b64 in KEYGEN_VECTORS:
+        derived = base64.b64encode(api.derive_public_key(base64.b64decode(private_b64))).decode()
+        assert derived == public_b64, f"{api.KEYGEN_BACKEND} derived {derived}, expected {public_b64}"
+
+    clamped = api.clamp_private_key(b'\xff' * 32)
+    assert clamped[0] == 0xf8 and clamped[31] == 0x7f and clamped[1:31] == b'\xff' * 30
+
+    if shutil.which('wg'):
+        private_key, public_key = api.generate_keypair()
+        result = subprocess.run(['wg', 'pubkey'], input=private_key, capture_output=True, text=True)
+        assert result.stdout.strip() == public_key, "wg pubkey disagrees with generate_keypair()"
+        print("  parity: RFC 7748 vectors + wg pubkey OK")
+    else:
+        print("  parity: RFC 7748 vectors OK (wg not installed, binary check skipped)")
+
+
+def bench_keygen():
+    """Keypairs per second, in-process backend vs forking wg"""
+    print(f"Keypair generation (backend: {api.KEYGEN_BACKEND})")
+    if api.KEYGEN_BACKEND == 'wg':
+        print("  no crypto backend importable - install cryptography or pynacl")
+    else:
+        check_keygen_parity()
+        usec = timed(api.generate_keypair, 5000)
+        print(f"  {api.KEYGEN_BACKEND:<40} {1_000_000 / usec:>10.0f} keys/s")
+    if shutil.which('wg'):
+        usec = timed(api.generate_keypair_wg, 50)
+        print(f"  {'wg genkey | wg pubkey':<40} {1_000_000 / usec:>10.0f} keys/s")
+
+
+# ============== BULK PROVISIONING ==============
+
+def bench_bulk(peers=100):
+    """Provision the same number of peers one request at a time and in batches"""
+    print(f"Peer provisioning, {peers} peers per run (stand-in wg)")
+    with tempfile.TemporaryDirectory() as tmp:
+        client, headers = use_stand_in_api(tmp)
+
+        def reset():
+            with api.db_pool.connection() as conn, conn:
+                conn.execute('DELETE FROM peers')
+            api.ip_allocator.load([])
+
+        start = time.perf_counter()
+        for n in range(peers):
+            client.post('/api/create-peer', json={'user_id': 1, 'device_name': f'single-{n}'}, headers=headers)
+        single = peers / (time.perf_counter() - start)
+        print(f"  {'N x /api/create-peer':<40} {single:>10.0f} peers/s")
+
+        for qr_code in (False, True):
+            reset()
+            start = time.perf_counter()
+            response = client.post('/api/create-peers', headers=headers, json={
+                'peers': [{'user_id': 2, 'device_name': f'bulk-{n}'} for n in range(peers)],
+                'qr_code': qr_code
+            })
+            lines = response.get_data(as_text=True).splitlines()
+            bulk = peers / (time.perf_counter() - start)
+            assert len(lines) == peers, f"expected {peers} NDJSON lines, got {lines[:1]}"
+            name = '/api/create-peers' + (' (with QR)' if qr_code else '')
+            print(f"  {name:<40} {bulk:>10.0f} peers/s  ({bulk / single:.1f}x)")
+        api.db_pool.close_all()
+
+
+# ============== QR CODES ==============
+
+def bench_qr(iterations=50):
+    """Uncached render per format vs a cache hit"""
+    print("QR code rendering")
+    if api.qrcode is None:
+        print("  qrcode not installed")
+        return
+    private_key, _ = api.generate_keypair()
+    config = api.generate_config(private_key, '10.8.0.2', 'c3RhbmQtaW4tc2VydmVyLWtleS1mb3ItYmVuY2htYXJrcz0=')
+    for fmt in api.QR_FORMATS:
+        report(f"render {fmt}", timed(lambda: api.render_qr_code(config, fmt), iterations))
+    api.generate_qr_code(config, 'png')
+    report("cached png (generate_qr_code hit)", timed(lambda: api.generate_qr_code(config, 'png'), 10000))
+
+
+# ============== SERVER LOAD TESTS ==============
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(args, tmp, name, extra_env=None):
+    """Start an API server process on a free port with its own peers.db; return (proc, port)"""
+    port = free_port()
+    env = dict(os.environ, API_PORT=str(port), DB_PATH=os.path.join(tmp, f'{name}.db'),
+               STATS_INTERVAL='0', **(extra_env or {}))
+    proc = subprocess.Popen([sys.executable] + args, cwd=os.path.dirname(os.path.abspath(__file__)),
+                            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 15
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return proc, port
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError(f"{name} server did not start")
+
+
+def stop_server(proc):
+    proc.terminate()
+    try:
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+def load_test(port, requests, clients=32, requests_per_client=50):
+    """
+    requests: list of (method, path, body) cycled by each client.
+    Returns (req/sec, p50 ms, p99 ms, errors).
+    """
+    latencies = []
+    errors = []
+    headers = {'Authorization': f"Bearer {api.CONFIG['api_secret']}", 'Content-Type': 'application/json'}
+
+    def worker(client):
+        for n in range(requests_per_client):
+            method, path, body = requests[(client + n) % len(requests)]
+            start = time.perf_counter()
+            try:
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                response.read()
+                conn.close()
+                if response.status >= 500:
+                    errors.append(response.status)
+            except OSError as e:
+                errors.append(e)
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    cuts = statistics.quantiles(latencies, n=100)
+    return len(latencies) / elapsed, cuts[49], cuts[98], len(errors)
+
+
+SERVER_MIX = [
+    ('GET', '/api/health', None),
+    ('GET', '/api/server-info', None),
+    ('GET', '/api/list-peers?limit=50', None),
+]
+
+
+def report_load(name, result):
+    rate, p50, p99, errors = result
+    print(f"  {name:<28} {rate:>8.0f} req/s  p50 {p50:>7.1f} ms  p99 {p99:>7.1f} ms  ({errors} errors)")
+
+
+def bench_async(clients=32):
+    """Same request mix against the threaded Flask server and the asyncio app"""
+    print(f"Server latency, {clients} concurrent clients, health/server-info/list-peers mix (stand-in wg)")
+    with tempfile.TemporaryDirectory() as tmp:
+        install_stand_in_wg(tmp)
+        servers = [('Flask threaded (api.py)', ['api.py'])]
+        if (importlib.util.find_spec('quart')
+                and importlib.util.find_spec('uvicorn')):
+            servers.append(('asyncio (api_async.py)', ['api_async.py']))
+        else:
+            print("  quart/uvicorn not installed - skipping api_async.py")
+        for name, args in servers:
+            proc, port = start_server(args, tmp, args[0].split('.')[0])
+            try:
+                report_load(name, load_test(port, SERVER_MIX, clients=clients))
+            finally:
+                stop_server(proc)
+
+
+def bench_workers(counts=(1, 2, 4), clients=32):
+    """Same request mix against serve.py with increasing worker counts"""
+    print(f"serve.py throughput, {clients} concurrent clients (stand-in wg)")
+    with tempfile.TemporaryDirectory() as tmp:
+        install_stand_in_wg(tmp)
+        for workers in counts:
+            proc, port = start_server(['serve.py', '--workers', str(workers)], tmp, f'workers{workers}')
+            try:
+                report_load(f"{workers} worker(s)", load_test(port, SERVER_MIX, clients=clients))
+            finally:
+                stop_server(proc)
+
+
+# ============== WIREGUARD CONTROL ==============
+
+def check_netlink_parsing():
+    """Round-trip a peer through pyroute2's encoder/decoder and parse it like a wg0 dump"""
+    from socket import AF_INET, AF_INET6, inet_pton
+    from pyroute2.netlink.generic.wireguard import wgmsg, WG_CMD_GET_DEVICE
+
+    def allowed_ip(family, addr, mask):
+        return {'attrs': [['WGALLOWEDIP_A_FAMILY', family], ['WGALLOWEDIP_A_IPADDR', inet_pton(family, addr)],
+                          ['WGALLOWEDIP_A_CIDR_MASK', mask]]}
+
+    public_key = api.generate_keypair()[1]
+    msg = wgmsg()
+    msg['cmd'] = WG_CMD_GET_DEVICE
+    msg['attrs'] = [['WGDEVICE_A_IFNAME', 'wg0'], ['WGDEVICE_A_PEERS', [{'attrs': [
+        ['WGPEER_A_PUBLIC_KEY', public_key],
+        ['WGPEER_A_RX_BYTES', 1234],
+        ['WGPEER_A_ALLOWEDIPS', [allowed_ip(AF_INET, '10.8.0.2', 32), allowed_ip(AF_INET6, 'fd42:42::2', 128)]],
+    ]}]]]
+    msg.encode()
+    decoded = wgmsg(msg.data)
+    decoded.decode()
+    peer = api.WgNetlinkBackend._peer_dict(decoded.get_attr('WGDEVICE_A_PEERS')[0])
+    assert peer['public_key'] == public_key, peer
+    assert peer['allowed_ips'] == '10.8.0.2/32,fd42:42::2/128', peer
+    assert peer['transfer_rx'] == 1234, peer
+
+    # A full batched WG_CMD_SET_DEVICE: fits in 8 KiB and decodes to the same peers
+    backend = api.WgNetlinkBackend()
+    added = [(api.generate_keypair()[1], f'10.8.0.{n + 2}/32,fd42:42::{n + 2:x}/128')
+             for n in range(backend.PEERS_PER_MESSAGE)]
+    msg = backend._set_message([backend._peer_attrs(*peer) for peer in added])
+    msg.encode()
+    assert len(msg.data) <= 8192, len(msg.data)
+    decoded = wgmsg(msg.data)
+    decoded.decode()
+    parsed = [api.WgNetlinkBackend._peer_dict(p) for p in decoded.get_attr('WGDEVICE_A_PEERS')]
+    assert [(p['public_key'], p['allowed_ips']) for p in parsed] == added, parsed[:1]
+    print(f"  parity: netlink dump parsing OK, {len(added)}-peer set message {len(msg.data)} bytes")
+
+
+def bench_wg_control(operations=200):
+    """Add, dump, health and remove through each backend, one peer per call"""
+    print("WireGuard control operations/sec")
+    with tempfile.TemporaryDirectory() as tmp:
+        install_stand_in_wg(tmp)
+        backends = [('fake', api.FakeWireGuard()), ('cli (stand-in wg)', api.WgCliBackend())]
+        if api.NetlinkWireGuard is None:
+            print("  pyroute2 not installed - skipping netlink")
+        else:
+            check_netlink_parsing()
+            if not os.path.exists('/sys/class/net/wg0'):
+                print("  no wg0 interface - skipping netlink")
+            else:
+                backends.append(('netlink (wg0)', api.WgNetlinkBackend()))
+
+        # Benchmarking range (RFC 2544) so test peers can't shadow real clients
+        peers = [(api.generate_keypair()[1], f'198.18.{n // 256}.{n % 256}/32') for n in range(operations)]
+
+        def dump(backend):
+            listing = backend.open_dump()
+            for _ in listing:
+                pass
+            listing.close()
+
+        for name, backend in backends:
+            rates = []
+            for label, fn in (
+                ('add', lambda peer: backend.add_peer(*peer)),
+                ('dump', lambda peer: dump(backend)),
+                ('health', lambda peer: backend.is_up()),
+                ('remove', lambda peer: backend.remove_peers([peer[0]])),
+            ):
+                start = time.perf_counter()
+                for peer in peers:
+                    fn(peer)
+                rates.append(f"{label} {operations / (time.perf_counter() - start):>8.0f}/s")
+            print(f"  {name:<20} " + '  '.join(rates))
+
+
+# ============== HEALTH ==============
+
+def bench_health(iterations=200):
+    """/api/health through the test client, before and after the monitor starts"""
+    print("/api/health latency (stand-in wg)")
+    with tempfile.TemporaryDirectory() as tmp:
+        client, _ = use_stand_in_api(tmp)
+        api.health_monitor = api.HealthMonitor(60)
+        report("probe per request (wg show wg0)", timed(lambda: client.get('/api/health'), iterations))
+        api.health_monitor.start()
+        report("cached probe (HealthMonitor)", timed(lambda: client.get('/api/health'), iterations * 10))
+        report("health_summary() only", timed(api.health_summary, iterations * 100))
+        api.db_pool.close_all()
+
+
+# ============== AUTH ==============
+
+def bench_auth(iterations=20000):
+    """Authenticator.verify per credential kind, with and without the LRU"""
+    print("Bearer token verification")
+    secrets = ['current-secret'] + [f'previous-secret-{n}' for n in range(3)]
+    auth = api.Authenticator(secrets, 300, 1024)
+    token, _ = auth.mint()
+    header = f"Bearer {token}"
+    report("API secret (4 active secrets)", timed(lambda: auth.verify('Bearer previous-secret-2'), iterations))
+    report("signed token, cached", timed(lambda: auth.verify(header), iterations))
+    uncached = api.Authenticator(secrets, 300, 0)
+    report("signed token, LRU disabled", timed(lambda: uncached.verify(header), iterations))
+    report("rejected token", timed(lambda: auth.verify('Bearer wrong'), iterations))
+
+
+# ============== RECONCILE ==============
+
+def bench_reconcile(peers=10000):
+    """Reconcile after a reboot (empty wg0) and after drift (some missing, orphans removed)"""
+    print(f"Startup reconcile, {peers} active peers")
+    with tempfile.TemporaryDirectory() as tmp:
+        use_stand_in_api(tmp)
+        api.ip_allocator = api.IPAllocator(['10.8.0.0/16'], 'fd42:42::/64')
+        rows = []
+        for n in range(peers):
+            ip = api.ip_allocator.allocate()
+            rows.append((1, f'dev-{n}', base64.b64encode(os.urandom(32)).decode(), api.generate_keypair()[0], ip))
+        with api.db_pool.connection() as conn, conn:
+            conn.executemany(api.SQL_INSERT_PEER, [api.peer_row(*row) for row in rows])
+
+        def run(name):
+            # Keep the reconcile's diff log out of the report
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                result = api.reconcile_wireguard(remove_orphans=True)
+                elapsed = time.perf_counter() - start
+            print(f"  {name:<40} {elapsed:>10.3f} s")
+            return result
+
+        fake = api.FakeWireGuard()
+        api.wg_control = fake
+        run("fake, empty wg0 (after reboot)")
+        fake.remove_peers([row[2] for row in rows[:peers // 10]])
+        fake.add_peers([(base64.b64encode(os.urandom(32)).decode(), '10.8.255.1/32') for _ in range(100)])
+        result = run("fake, 10% missing + 100 orphans")
+        assert result['readded'] == peers // 10 and result['orphans_removed'] == 100, result
+        run("fake, already in sync")
+
+        api.wg_control = api.WgCliBackend()
+        run("cli (stand-in wg), empty wg0")
+        api.db_pool.close_all()
+
+
+# ============== STORAGE ==============
+
+# The peers table as it was before SCHEMA_VERSION 1
+LEGACY_PEERS_TABLE = '''
+    CREATE TABLE peers (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        device_name TEXT NOT NULL,
+        public_key TEXT NOT NULL UNIQUE,
+        private_key TEXT NOT NULL,
+        assigned_ip TEXT NOT NULL UNIQUE,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        last_handshake DATETIME,
+        is_active BOOLEAN DEFAULT 1
+    )
+'''
+
+
+def bench_storage(peers=10000):
+    """peers.db size before/after the in-place migration, and the cost of sealed keys"""
+    print(f"peers.db storage, {peers} peers")
+    with tempfile.TemporaryDirectory() as tmp:
+        api.CONFIG['db_path'] = os.path.join(tmp, 'peers.db')
+        api.db_pool = api.DBPool(api.CONFIG['db_path'])
+        api.private_key_box = api.PrivateKeyBox(os.path.join(tmp, 'node.key'))
+
+        # Before: base64 TEXT keys, private keys in the clear, DATETIME strings
+        conn = sqlite3.connect(api.CONFIG['db_path'])
+        conn.execute(LEGACY_PEERS_TABLE)
+        conn.execute('CREATE INDEX idx_peers_public_key_active ON peers (public_key, is_active)')
+        conn.executemany(
+            "INSERT INTO peers (user_id, device_name, public_key, private_key, assigned_ip, last_handshake)"
+            " VALUES (?, ?, ?, ?, ?, datetime('now'))",
+            [(n, f'dev-{n}', *reversed(api.generate_keypair()), f'10.{n >> 16}.{(n >> 8) & 255}.{n & 255}')
+             for n in range(peers)]
+        )
+        conn.commit()
+        conn.execute('VACUUM')
+        conn.close()
+        before = os.path.getsize(api.CONFIG['db_path'])
+        print(f"  {'TEXT keys (schema 0)':<40} {before / 1024:>10.0f} KiB")
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            with api.db_pool.connection() as conn:
+                api.init_schema(conn)
+                conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            elapsed = time.perf_counter() - start
+        after = os.path.getsize(api.CONFIG['db_path'])
+        print(f"  {'BLOB keys, sealed (schema 1)':<40} {after / 1024:>10.0f} KiB  ({after / before:.0%})")
+        print(f"  {'in-place migration':<40} {elapsed:>10.3f} s")
+
+        private_key, _ = api.generate_keypair()
+        sealed = api.private_key_box.seal_private_key(private_key)
+        report(f"seal private key (scheme {api.private_key_box.scheme})", timed(lambda: api.private_key_box.seal_private_key(private_key), 10000))
+        report("open private key (get-config)", timed(lambda: api.private_key_box.open_private_key(sealed), 10000))
+        api.db_pool.close_all()
+
+
+BENCHMARKS = {
+    'allocator': bench_allocator,
+    'db': bench_db,
+    'keygen': bench_keygen,
+    'bulk': bench_bulk,
+    'qr': bench_qr,
+    'async': bench_async,
+    'workers': bench_workers,
+    'wgcontrol': bench_wg_control,
+    'health': bench_health,
+    'auth': bench_auth,
+    'reconcile': bench_reconcile,
+    'storage': bench_storage,
+}
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"Unknown benchmark: {name} (choose from {', '.join(BENCHMARKS)})")
+            sys.exit(1)
+        BENCHMARKS[name]()
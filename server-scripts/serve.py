@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""
+TrueVault VPN - Production launcher for the peer API
+Deploy next to api.py: /opt/truevault/serve.py
+
+Pre-forks N worker processes that share one listening socket. Each worker
+runs api.app on a threaded HTTP/1.1 WSGI server with keep-alive. IP
+allocation switches to DB leases (api.LeasedIPAllocator) so workers never
+hand out the same address.
+
+Signals (to the master):
+  SIGHUP          - graceful reload: the master re-execs itself (picking up
+                    new api.py/serve.py code) on the same listening socket,
+                    starts fresh workers and drains the old ones. If the new
+                    code fails to import, it only recycles the workers.
+                    The environment (CONFIG) is inherited as is; changing it
+                    needs a restart.
+  SIGTERM/SIGINT  - graceful shutdown
+
+A worker that keeps dying soon after it starts is restarted with an
+exponential backoff (0.5 s doubling up to 30 s) instead of every tick.
+
+RUN:
+  python serve.py --workers 4
+  ExecStart=/opt/truevault/venv/bin/python /opt/truevault/serve.py --workers 4
+  ExecReload=/bin/kill -HUP $MAINPID
+"""
+
+import argparse
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from werkzeug.serving import ThreadedWSGIServer, WSGIRequestHandler
+
+import api
+from api import CONFIG
+
+
+# Handed from a master to its re-exec'd self on SIGHUP
+LISTEN_FD_ENV = 'TRUEVAULT_LISTEN_FD'
+RETIRING_ENV = 'TRUEVAULT_RETIRING'
+
+RESPAWN_BACKOFF_MIN = 0.5
+RESPAWN_BACKOFF_MAX = 30
+HEALTHY_UPTIME = 10     # a worker that ran this long is restarted right away
+
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    """HTTP/1.1 so connections are reused; idle ones close after `timeout` seconds"""
+    protocol_version = 'HTTP/1.1'
+    timeout = 5
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+# ============== WORKER ==============
+
+def run_worker(listener, index, workers, keepalive):
+    """Serve api.app on the inherited listening socket until SIGTERM"""
+    for sig in (signal.SIGHUP, signal.SIGINT):
+        signal.signal(sig, signal.SIG_IGN)
+
+    KeepAliveRequestHandler.timeout = keepalive
+    host, port = listener.getsockname()[:2]
+    server = ThreadedWSGIServer(host, port, api.app, handler=KeepAliveRequestHandler, fd=listener.fileno())
+    # Let in-flight requests finish on shutdown
+    server.daemon_threads = False
+    server.block_on_close = True
+
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever(), so it can't run on this thread
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+
+    # Leases held by other workers/generations may have changed since the fork
+    api.ip_allocator.resync()
+    api.start_services(init=False, write_handshakes=index == 0, workers=workers)
+
+    server.serve_forever()
+    server.server_close()
+
+
+# ============== MASTER ==============
+
+class Master:
+    """Forks and supervises workers; replaces them on SIGHUP"""
+
+    def __init__(self, listener, workers, keepalive, retiring=()):
+        self.listener = listener
+        self.worker_count = workers
+        self.keepalive = keepalive
+        # pid -> index; None for workers of a previous generation being drained
+        self.workers = {pid: None for pid in retiring}
+        self.started = {}       # pid -> spawn time
+        self.backoff = {}       # index -> last respawn delay
+        self.respawn_at = {}    # index -> when to restart it
+        self.reloading = False
+        self.stopping = False
+
+    def spawn(self, index):
+        # Don't carry SQLite connections across fork
+        api.db_pool.close_all()
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                run_worker(self.listener, index, self.worker_count, self.keepalive)
+            except Exception as e:
+                print(f"Worker {index} crashed: {e}")
+                code = 1
+            finally:
+                sys.stdout.flush()
+            # Run atexit handlers (reservoir drain, handshake flush), then exit
+            sys.exit(code)
+        self.workers[pid] = index
+        self.started[pid] = time.monotonic()
+        return pid
+
+    def reap(self):
+        """Collect exited workers and release reservoir leases they left behind"""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            index = self.workers.pop(pid, None)
+            started = self.started.pop(pid, None)
+            with api.db_pool.connection() as conn:
+                api.LeasedIPAllocator.sync_leases(conn, pid)
+            api.db_pool.close_all()
+            if index is not None and not self.stopping and index not in self.workers.values():
+                delay = 0
+                if started is not None and time.monotonic() - started < HEALTHY_UPTIME:
+                    delay = min(max(RESPAWN_BACKOFF_MIN, 2 * self.backoff.get(index, 0)), RESPAWN_BACKOFF_MAX)
+                self.backoff[index] = delay
+                self.respawn_at[index] = time.monotonic() + delay
+                print(f"Worker {pid} exited ({status}), restarting in {delay:.1f}s")
+
+    def respawn(self):
+        """Restart workers whose backoff has passed"""
+        now = time.monotonic()
+        for index, due in list(self.respawn_at.items()):
+            if due <= now:
+                del self.respawn_at[index]
+                self.spawn(index)
+
+    def stop_workers(self, pids):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def reload(self):
+        """
+        Re-exec this master so the next workers run the current code. The
+        listening socket and the running workers (still our
+        children after exec) are handed over; the new master starts a fresh
+        generation and drains these. Falls back to recycle() if the new
+        code doesn't import.
+        """
+        check = subprocess.run([sys.executable, '-c', 'import serve'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                               capture_output=True, text=True)
+        if check.returncode != 0:
+            print(f"Reload: new code fails to import, recycling workers on the loaded code\n{check.stderr.strip()}")
+            api.handle_sighup(signal.SIGHUP, None)
+            self.recycle()
+            return
+        os.environ[LISTEN_FD_ENV] = str(self.listener.fileno())
+        os.environ[RETIRING_ENV] = ','.join(str(pid) for pid in self.workers)
+        api.db_pool.close_all()
+        sys.stdout.flush()
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+    def recycle(self):
+        """Start a new generation of workers from the loaded code, then drain the old one"""
+        old = list(self.workers)
+        for pid in old:
+            # Old workers are being retired; don't respawn them on exit
+            self.workers[pid] = None
+        self.respawn_at.clear()
+        for index in range(self.worker_count):
+            self.spawn(index)
+        self.stop_workers(old)
+
+    def run(self):
+        def on_hup(signum, frame):
+            self.reloading = True
+
+        def on_stop(signum, frame):
+            self.stopping = True
+
+        signal.signal(signal.SIGHUP, on_hup)
+        signal.signal(signal.SIGTERM, on_stop)
+        signal.signal(signal.SIGINT, on_stop)
+
+        retiring = list(self.workers)
+        for index in range(self.worker_count):
+            self.spawn(index)
+        self.stop_workers(retiring)
+
+        while not self.stopping:
+            if self.reloading:
+                self.reloading = False
+                print("SIGHUP received - reloading")
+                self.reload()
+            self.reap()
+            self.respawn()
+            time.sleep(0.2)
+
+        print("Shutting down workers...")
+        self.stop_workers(list(self.workers))
+        deadline = time.time() + 30
+        while self.workers and time.time() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        self.stop_workers_hard()
+
+    def stop_workers_hard(self):
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        self.reap()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='TrueVault peer API production server')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=CONFIG['api_port'])
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('WORKERS', os.cpu_count() or 2)))
+    parser.add_argument('--backlog', type=int, default=int(os.environ.get('BACKLOG', '2048')))
+    parser.add_argument('--keepalive', type=float, default=float(os.environ.get('KEEPALIVE', '5')))
+    args = parser.parse_args()
+
+    # Set when a master re-exec'd itself on SIGHUP
+    listen_fd = os.environ.pop(LISTEN_FD_ENV, None)
+    retiring = [int(pid) for pid in os.environ.pop(RETIRING_ENV, '').split(',') if pid]
+
+    print("=" * 50)
+    print("TrueVault VPN - Key Generation API (pre-fork)")
+    print("=" * 50)
+    print(f"Server Name: {CONFIG['server_name']}")
+    print(f"API Port: {args.port}")
+    print(f"Workers: {args.workers}  Backlog: {args.backlog}  Keep-alive: {args.keepalive}s")
+    print(f"Key Generation: {api.KEYGEN_BACKEND}")
+    print(f"WireGuard Control: {api.wg_control.name}")
+    print("=" * 50)
+
+    # Shared state: IP leases in peers.db; schema/leases set up once, before forking
+    api.use_ip_leases()
+    if listen_fd is None:
+        api.init_db()
+        api.reconcile_on_startup()
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((args.host, args.port))
+        listener.listen(args.backlog)
+    else:
+        # Reload: the retiring workers still hold their leases, and wg0 was already reconciled
+        api.init_db(sync_leases=False)
+        listener = socket.socket(fileno=int(listen_fd))
+        print(f"Reloaded on the inherited socket; draining {len(retiring)} old workers")
+    listener.set_inheritable(True)
+
+    Master(listener, args.workers, args.keepalive, retiring).run()
+
+
+if __name__ == '__main__':
+    main()
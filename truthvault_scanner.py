@@ -31,20 +31,31 @@ import sys
 import os
 import webbrowser
 import struct
+import selectors
+import asyncio
+import queue
 import xml.etree.ElementTree as ET
 from datetime import datetime
 from http.server import HTTPServer, SimpleHTTPRequestHandler
 from urllib.parse import parse_qs, urlparse
 import urllib.request
 import ssl
-from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # ============== CONFIGURATION ==============
 TRUTHVAULT_API = "https://vpn.the-truth-publishing.com/api"
 LOCAL_PORT = 8888
 VERSION = "3.0.0"
-SCAN_TIMEOUT = 0.5
+SCAN_TIMEOUT = 0.5        # port probe timeout until a host's RTT is known
+SCAN_MIN_TIMEOUT = 0.25   # floor for the adaptive timeout (a busy device can be slow to SYN-ACK)
+SCAN_POLL = 0.05          # how often an in-flight probe re-checks its timeout
+SCAN_MAX_IN_FLIGHT = 256  # port probes in flight across all devices
+SCAN_PER_HOST = 6         # port probes in flight to any one device
 MAX_THREADS = 50
+PIPELINE_QUEUE = 64       # devices waiting between analysis stages
+LOOKUP_WORKERS = 16       # vendor + reverse DNS
+PORT_WORKERS = 32         # devices handed to the port scan engine at once
+FINGERPRINT_WORKERS = 16  # HTTP fingerprint + RTSP probe
+ARP_SWEEP = True  # active ARP sweep after the ping sweep (Linux, needs root)
 
 # ============== BRUTE FORCE PORT LIST ==============
 CAMERA_PORTS = {
@@ -333,20 +344,124 @@ def brute_force_scan(ip):
             open_ports.append({"port": port, "service": service})
     return open_ports
 
-def scan_ports_threaded(ip, ports):
-    """Threaded port scanning for speed"""
-    open_ports = []
-    with ThreadPoolExecutor(max_workers=20) as executor:
-        futures = {executor.submit(check_port, ip, port): (port, service) 
-                   for port, service in ports.items()}
-        for future in as_completed(futures):
-            port, service = futures[future]
+class RTTEstimator:
+    """Smoothed RTT and its variance (RFC 6298 style) for connect timeouts"""
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+    
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+    
+    def timeout(self, floor, ceiling):
+        if self.srtt is None: return None
+        return min(ceiling, max(floor, self.srtt + 4 * self.rttvar))
+
+class PortScanner:
+    """
+    asyncio connect() scan of many devices x ports at once.
+    
+    At most max_in_flight probes are outstanding overall and per_host to any
+    one device. Each device has its own workers and the shared semaphore
+    wakes waiters in order, so devices are served round-robin and one that
+    drops SYNs can't starve the rest. Every answer (connect or RST) is an RTT
+    sample: a device's timeout becomes srtt + 4 * rttvar, clamped to
+    [min_timeout, max_timeout]. Until a device has answered, it gets 4x the
+    LAN-wide timeout (capped at initial_timeout), or initial_timeout before
+    anything has answered. Probes already in flight pick up a tighter
+    timeout as samples arrive. A probe that times out is retried once with
+    twice the timeout, so one lost SYN doesn't hide an open port.
+    """
+    def __init__(self, max_in_flight=SCAN_MAX_IN_FLIGHT, per_host=SCAN_PER_HOST,
+                 initial_timeout=SCAN_TIMEOUT, min_timeout=SCAN_MIN_TIMEOUT, max_timeout=2.0):
+        self.max_in_flight = max_in_flight
+        self.per_host = per_host
+        self.initial_timeout = initial_timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.network_rtt = RTTEstimator()
+        self.host_rtt = {}
+        self.probes = 0
+        self._slots = None
+    
+    def timeout_for(self, ip):
+        host = self.host_rtt.get(ip)
+        if host: return host.timeout(self.min_timeout, self.max_timeout)
+        network = self.network_rtt.timeout(self.min_timeout, self.max_timeout)
+        return min(self.initial_timeout, 4 * network) if network else self.initial_timeout
+    
+    def _sample(self, ip, rtt):
+        self.network_rtt.sample(rtt)
+        self.host_rtt.setdefault(ip, RTTEstimator()).sample(rtt)
+    
+    async def probe(self, ip, port):
+        """True if ip:port accepts a TCP connection"""
+        result = await self._connect(ip, port, 1)
+        if result is None:
+            result = await self._connect(ip, port, 2)
+        return bool(result)
+    
+    async def _connect(self, ip, port, backoff):
+        """One connect attempt: True (open), False (refused/error) or None (timed out)"""
+        if self._slots is None: self._slots = asyncio.Semaphore(self.max_in_flight)
+        loop = asyncio.get_running_loop()
+        async with self._slots:
+            self.probes += 1
             try:
-                if future.result():
-                    open_ports.append({"port": port, "service": service})
-            except:
-                pass
-    return open_ports
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            except OSError:
+                return False
+            sock.setblocking(False)
+            start = time.monotonic()
+            connect = asyncio.ensure_future(loop.sock_connect(sock, (ip, port)))
+            try:
+                # Re-checked while waiting: the timeout tightens as RTT samples arrive
+                while not connect.done():
+                    remaining = start + backoff * self.timeout_for(ip) - time.monotonic()
+                    if remaining <= 0: return None
+                    await asyncio.wait({connect}, timeout=min(remaining, SCAN_POLL))
+                connect.result()
+                self._sample(ip, time.monotonic() - start)
+                return True
+            except ConnectionRefusedError:
+                self._sample(ip, time.monotonic() - start)
+                return False
+            except OSError:
+                return False
+            finally:
+                if not connect.done():
+                    connect.cancel()
+                    await asyncio.wait({connect})
+                sock.close()
+    
+    async def scan_host(self, ip, ports):
+        """open_ports for one device, in ports order"""
+        pending = iter(ports.items())
+        found = set()
+        
+        async def worker():
+            for port, _ in pending:
+                if await self.probe(ip, port): found.add(port)
+        
+        await asyncio.gather(*(worker() for _ in range(min(self.per_host, len(ports)))))
+        return [{"port": port, "service": service} for port, service in ports.items() if port in found]
+    
+    async def scan(self, hosts, ports):
+        results = await asyncio.gather(*(self.scan_host(ip, ports) for ip in hosts))
+        return dict(zip(hosts, results))
+
+def scan_ports_async(hosts, ports, **options):
+    """{ip: open_ports} for all devices at once (see PortScanner)"""
+    hosts = list(hosts)
+    return asyncio.run(PortScanner(**options).scan(hosts, ports))
+
+def scan_ports_threaded(ip, ports):
+    """Port scan one device"""
+    return scan_ports_async([ip], ports)[ip]
 
 # ============== ONVIF DISCOVERY ==============
 def discover_onvif(timeout=3):
@@ -655,6 +770,91 @@ def test_http_credentials(ip, port=80, timeout=2):
     return working_creds
 
 # ============== PING SWEEP ==============
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+
+def icmp_checksum(data):
+    if len(data) % 2: data += b'\x00'
+    total = sum(struct.unpack(f'!{len(data) // 2}H', data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+def open_icmp_socket():
+    """Unprivileged ICMP datagram socket, else a raw one (root/admin), else None"""
+    for sock_type in (socket.SOCK_DGRAM, socket.SOCK_RAW):
+        try:
+            sock = socket.socket(socket.AF_INET, sock_type, socket.IPPROTO_ICMP)
+        except OSError:
+            continue
+        try:
+            sock.bind(('0.0.0.0', 0))  # Windows raw sockets can't receive unbound
+            sock.setblocking(False)
+            # A whole /24 of replies can arrive before the first read
+            try: sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+            except OSError: pass
+            return sock
+        except OSError:
+            sock.close()
+    return None
+
+def ping_sweep(ips, timeout=1.0, retries=1):
+    """
+    Ping every IP from one ICMP socket and collect replies with select/epoll
+    until the deadline. Hosts that haven't answered halfway through get one
+    more echo (the first can be lost while the neighbor entry resolves).
+    Returns the IPs that replied, or None if no ICMP socket is allowed.
+    """
+    sock = open_icmp_socket()
+    if sock is None: return None
+    
+    ident = os.getpid() & 0xFFFF
+    raw = sock.type == socket.SOCK_RAW
+    targets = set(ips)
+    alive = set()
+    sel = selectors.DefaultSelector()
+    sel.register(sock, selectors.EVENT_READ)
+    
+    def drain():
+        while True:
+            try: data, (ip, _) = sock.recvfrom(1024)
+            except OSError: return  # drained (or a queued ICMP error)
+            # Raw sockets (and macOS datagram ones) include the IP header
+            if data and data[0] >> 4 == 4: data = data[(data[0] & 0x0F) * 4:]
+            if len(data) < 8 or data[0] != ICMP_ECHO_REPLY or ip not in targets: continue
+            if raw and struct.unpack('!H', data[4:6])[0] != ident: continue
+            alive.add(ip)
+    
+    start = time.monotonic()
+    try:
+        for attempt in range(retries + 1):
+            for seq, ip in enumerate(targets - alive, 1):
+                # Datagram sockets get the identifier (and checksum) rewritten by the kernel
+                packet = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, 0, ident, seq & 0xFFFF) + b'truthvault'
+                packet = packet[:2] + struct.pack('!H', icmp_checksum(packet)) + packet[4:]
+                try: sock.sendto(packet, (ip, 0))
+                except OSError: pass  # unreachable/buffer full: the next round retries
+                if seq % 32 == 0: drain()
+            
+            round_end = start + timeout * (attempt + 1) / (retries + 1)
+            while alive != targets:
+                remaining = round_end - time.monotonic()
+                if remaining <= 0 or not sel.select(remaining): break
+                drain()
+            if alive == targets: break
+    finally:
+        sel.close()
+        sock.close()
+    return list(alive)
+
+def ping_sweep_subprocess(ips, timeout=1):
+    """Fallback: one `ping` process per host"""
+    results = []
+    threads = [threading.Thread(target=ping_host, args=(ip, results, timeout)) for ip in ips]
+    for t in threads: t.start()
+    for t in threads: t.join(timeout=timeout + 2)
+    return results
+
 def ping_host(ip, results, timeout=1):
     param = '-n' if platform.system().lower() == 'windows' else '-c'
     timeout_param = '-w' if platform.system().lower() == 'windows' else '-W'
@@ -666,7 +866,40 @@ def ping_host(ip, results, timeout=1):
             results.append(ip)
     except: pass
 
-def get_arp_table():
+# ============== NEIGHBOR TABLE ==============
+ARP_FLAG_COMPLETE = 0x2
+ETH_P_ARP = 0x0806
+ARP_REQUEST = 1
+ARP_REPLY = 2
+
+def read_proc_arp(path='/proc/net/arp'):
+    """IPv4 neighbor table straight from the kernel (Linux), None if unreadable"""
+    try:
+        with open(path) as f: lines = f.readlines()[1:]
+    except OSError: return None
+    arp = {}
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 4: continue
+        ip, flags, mac = fields[0], int(fields[2], 16), fields[3].upper()
+        if flags & ARP_FLAG_COMPLETE and mac not in ('00:00:00:00:00:00', 'FF:FF:FF:FF:FF:FF'): arp[ip] = mac
+    return arp
+
+def read_ip_neigh():
+    """`ip -j -4 neigh` (iproute2 JSON), None if ip isn't there"""
+    try:
+        result = subprocess.run(['ip', '-j', '-4', 'neigh', 'show'], capture_output=True, text=True, timeout=5)
+        entries = json.loads(result.stdout) if result.returncode == 0 else None
+    except (OSError, ValueError, subprocess.SubprocessError): return None
+    if not isinstance(entries, list): return None
+    arp = {}
+    for entry in entries:
+        mac = (entry.get('lladdr') or '').upper()
+        if mac and mac != 'FF:FF:FF:FF:FF:FF' and 'FAILED' not in entry.get('state', []): arp[entry['dst']] = mac
+    return arp
+
+def read_arp_command():
+    """Parse `arp -a` (Windows, macOS, or Linux without /proc)"""
     arp = {}
     try:
         if platform.system().lower() == 'windows':
@@ -686,6 +919,87 @@ def get_arp_table():
     except: pass
     return arp
 
+def get_arp_table():
+    """{ip: MAC} from the neighbor table, cheapest source first"""
+    for reader in (read_proc_arp, read_ip_neigh):
+        arp = reader()
+        if arp is not None: return arp
+    return read_arp_command()
+
+def get_interface_for(ip):
+    """Name of the interface whose most specific route covers ip (Linux)"""
+    target = struct.unpack('<I', socket.inet_aton(ip))[0]  # /proc/net/route is little-endian hex
+    best, best_len = None, -1
+    try:
+        with open('/proc/net/route') as f: lines = f.readlines()[1:]
+    except OSError: return None
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 8: continue
+        dest, mask = int(fields[1], 16), int(fields[7], 16)
+        prefix_len = bin(mask).count('1')
+        if target & mask == dest and prefix_len > best_len:
+            best, best_len = fields[0], prefix_len
+    return best
+
+def arp_sweep(ips, timeout=1.0, retries=1):
+    """
+    Broadcast an ARP who-has for every IP from one raw AF_PACKET socket and
+    collect the replies until the deadline; finds hosts that drop ICMP.
+    Returns {ip: MAC} like get_arp_table, or None where raw sockets aren't
+    available (not Linux, not root).
+    """
+    if not hasattr(socket, 'AF_PACKET'): return None
+    local_ip = get_local_ip()
+    iface = get_interface_for(local_ip)
+    if not iface or iface == 'lo': return None
+    try:
+        with open(f'/sys/class/net/{iface}/address') as f:
+            own_mac = bytes.fromhex(f.read().strip().replace(':', ''))
+        sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ARP))
+    except (OSError, ValueError): return None
+    
+    own_ip = socket.inet_aton(local_ip)
+    targets = set(ips) - {local_ip}
+    found = {}
+    sel = selectors.DefaultSelector()
+    
+    def drain():
+        while True:
+            try: frame = sock.recv(128)
+            except OSError: return
+            if len(frame) < 42: continue
+            op, sender_mac, sender_ip = struct.unpack('!6xH6s4s', frame[14:32])
+            ip = socket.inet_ntoa(sender_ip)
+            if op == ARP_REPLY and ip in targets: found[ip] = sender_mac.hex(':').upper()
+    
+    start = time.monotonic()
+    try:
+        sock.bind((iface, 0))
+        sock.setblocking(False)
+        sel.register(sock, selectors.EVENT_READ)
+        header = b'\xff' * 6 + own_mac + struct.pack('!H', ETH_P_ARP)
+        for attempt in range(retries + 1):
+            for n, ip in enumerate(targets - found.keys(), 1):
+                request = struct.pack('!HHBBH6s4s6s4s', 1, 0x0800, 6, 4, ARP_REQUEST,
+                                      own_mac, own_ip, b'\x00' * 6, socket.inet_aton(ip))
+                try: sock.send(header + request)
+                except OSError: pass
+                if n % 32 == 0: drain()
+            
+            round_end = start + timeout * (attempt + 1) / (retries + 1)
+            while found.keys() != targets:
+                remaining = round_end - time.monotonic()
+                if remaining <= 0 or not sel.select(remaining): break
+                drain()
+            if found.keys() == targets: break
+    except OSError:
+        return None
+    finally:
+        sel.close()
+        sock.close()
+    return found
+
 def get_hostname(ip):
     try: return socket.gethostbyaddr(ip)[0]
     except: return None
@@ -765,6 +1079,132 @@ def determine_type(hostname, vendor, icon, ports, http_info, rtsp_creds):
     if icon != "❓": return ("device", icon, vendor)
     return ("unknown", "❓", "Unknown Device")
 
+# ============== DEVICE ANALYSIS PIPELINE ==============
+PIPELINE_DONE = object()
+
+def ip_sort_key(ip):
+    return [int(x) for x in ip.split('.')]
+
+def run_stage(name, fn, workers, inbox, outbox=None):
+    """
+    Start workers that apply fn to each device from inbox and pass it on to
+    outbox (a bounded queue, so a fast stage waits for a slow one instead of
+    piling up work). A device whose step fails is passed on as it is.
+    """
+    def work():
+        while True:
+            device = inbox.get()
+            if device is PIPELINE_DONE:
+                inbox.put(PIPELINE_DONE)  # wake the next worker too
+                return
+            try: fn(device)
+            except Exception as e: print(f"{name} failed for {device['ip']}: {e}")
+            if outbox is not None: outbox.put(device)
+    
+    threads = [threading.Thread(target=work, name=f"{name}-{n}", daemon=True) for n in range(workers)]
+    for t in threads: t.start()
+    return threads
+
+def lookup_device(device):
+    device["vendor"], device["vendor_icon"] = get_mac_info(device["mac"])
+    device["hostname"] = get_hostname(device["ip"])
+
+def fingerprint_device(device):
+    ip, ports = device["ip"], device["open_ports"]
+    
+    # HTTP fingerprinting
+    for port_info in ports:
+        if port_info["service"] in ["HTTP", "HTTP-ALT", "HTTP-ALT2", "HTTP-ALT3", "HTTPS", "HTTPS-ALT"]:
+            device["http_fingerprint"] = fingerprint_http(ip, port_info["port"])
+            if device["http_fingerprint"]:
+                break
+    
+    # RTSP credential testing (only if RTSP port found)
+    for port_info in ports:
+        if port_info["service"] in ["RTSP", "RTSP-ALT"]:
+            device["rtsp_credentials"] = test_rtsp_credentials(ip, port_info["port"])
+            if device["rtsp_credentials"]:
+                break
+
+def classify_device(device, onvif_ips, local_ip):
+    """Final device record, as served by /devices"""
+    ip = device["ip"]
+    dev_type, icon, type_name = determine_type(device["hostname"], device["vendor"], device["vendor_icon"],
+                                               device["open_ports"], device["http_fingerprint"], device["rtsp_credentials"])
+    
+    # Check if found via discovery protocols
+    discovery_protocol = None
+    if ip in onvif_ips:
+        discovery_protocol = "onvif"
+        if dev_type != "ip_camera":
+            dev_type, icon, type_name = "ip_camera", "📷", "ONVIF Camera"
+    
+    return {
+        "id": f"auto_{ip.replace('.', '_')}",
+        "ip": ip,
+        "mac": device["mac"],
+        "hostname": device["hostname"],
+        "vendor": device["vendor"],
+        "type": dev_type,
+        "type_name": type_name,
+        "icon": icon,
+        "open_ports": device["open_ports"],
+        "http_fingerprint": device["http_fingerprint"],
+        "rtsp_credentials": device["rtsp_credentials"],
+        "discovery_protocol": discovery_protocol,
+        "is_local": ip == local_ip,
+        "discovered_at": datetime.now().isoformat()
+    }
+
+def analyze_devices(arp, onvif_ips, local_ip):
+    """
+    lookup -> ports -> fingerprint -> classification, each stage with its own
+    workers and bounded queues in between, so a slow device only holds up a
+    worker of the stage it is in. Port scans of all devices share one
+    PortScanner on a background event loop. Finished devices are published
+    to discovered_devices (kept sorted by IP) as they come out.
+    """
+    to_lookup, to_scan, to_fingerprint, to_classify = (queue.Queue(PIPELINE_QUEUE) for _ in range(4))
+    total = len(arp)
+    
+    loop = asyncio.new_event_loop()
+    loop_thread = threading.Thread(target=loop.run_forever, name="port-scan", daemon=True)
+    loop_thread.start()
+    engine = PortScanner()
+    
+    def scan_ports(device):
+        scan = engine.scan_host(device["ip"], CAMERA_PORTS)
+        device["open_ports"] = asyncio.run_coroutine_threadsafe(scan, loop).result()
+    
+    def publish(device):
+        # Swap in a new list so /devices never serializes one being changed
+        global discovered_devices
+        discovered_devices = sorted(discovered_devices + [classify_device(device, onvif_ips, local_ip)],
+                                    key=lambda d: ip_sort_key(d["ip"]))
+        done = len(discovered_devices)
+        scan_status["progress"] = 45 + int((done / max(total, 1)) * 45)
+        scan_status["message"] = f"Analyzed {done}/{total} devices..."
+    
+    stages = [
+        (to_lookup, run_stage("lookup", lookup_device, LOOKUP_WORKERS, to_lookup, to_scan)),
+        (to_scan, run_stage("ports", scan_ports, PORT_WORKERS, to_scan, to_fingerprint)),
+        (to_fingerprint, run_stage("fingerprint", fingerprint_device, FINGERPRINT_WORKERS, to_fingerprint, to_classify)),
+        (to_classify, run_stage("classify", publish, 1, to_classify)),
+    ]
+    try:
+        for ip, mac in arp.items():
+            to_lookup.put({"ip": ip, "mac": mac, "hostname": None, "vendor": "Unknown", "vendor_icon": "❓",
+                           "open_ports": [], "http_fingerprint": None, "rtsp_credentials": []})
+        # Drain stage by stage: a stage is done once its own input ran out
+        for inbox, threads in stages:
+            inbox.put(PIPELINE_DONE)
+            for t in threads: t.join()
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        loop_thread.join()
+        loop.close()
+    return discovered_devices
+
 # ============== MAIN SCAN FUNCTION ==============
 def scan_network():
     global discovered_devices, scan_status
@@ -792,25 +1232,27 @@ def scan_network():
     mdns_devices = discover_mdns(timeout=2)
     print(f"mDNS found: {len(mdns_devices)} devices")
     
-    # Phase 4: Ping sweep (40%)
+    # Phase 4: Ping sweep (40%) - mostly to fill the ARP table
     scan_status["message"] = f"Pinging {network}.0/24..."
     scan_status["progress"] = 15
     
-    ping_results = []
-    threads = []
-    for i in range(1, 255):
-        t = threading.Thread(target=ping_host, args=(f"{network}.{i}", ping_results))
-        t.start()
-        threads.append(t)
-        if i % 50 == 0:
-            scan_status["progress"] = 15 + int((i / 255) * 25)
+    hosts = [f"{network}.{i}" for i in range(1, 255)]
+    ping_results = ping_sweep(hosts)
+    if ping_results is None:
+        ping_results = ping_sweep_subprocess(hosts)
+    print(f"Ping sweep: {len(ping_results)} hosts replied")
     
-    for t in threads: t.join(timeout=3)
+    # Hosts that drop ICMP still have to answer ARP
+    arp_replies = arp_sweep(hosts) if ARP_SWEEP else None
+    if arp_replies is not None:
+        print(f"ARP sweep: {len(arp_replies)} hosts replied")
     
     # Phase 5: Get ARP table (45%)
     scan_status["message"] = "Reading ARP table..."
     scan_status["progress"] = 40
     arp = get_arp_table()
+    for ip, mac in (arp_replies or {}).items():
+        arp.setdefault(ip, mac)
     
     # Add ONVIF/UPnP discovered IPs to ARP if not present
     for dev in onvif_devices + upnp_devices:
@@ -818,66 +1260,10 @@ def scan_network():
         if ip and ip not in arp:
             arp[ip] = "00:00:00:00:00:00"  # Placeholder MAC
     
-    # Phase 6: Analyze each device (90%)
-    total = len(arp)
-    for idx, (ip, mac) in enumerate(arp.items()):
-        progress = 45 + int((idx / max(total, 1)) * 45)
-        scan_status["progress"] = progress
-        scan_status["message"] = f"Analyzing {ip} ({idx+1}/{total})..."
-        
-        vendor, vendor_icon = get_mac_info(mac)
-        hostname = get_hostname(ip)
-        
-        # Brute force port scan
-        ports = scan_ports_threaded(ip, CAMERA_PORTS)
-        
-        # HTTP fingerprinting
-        http_info = None
-        for port_info in ports:
-            if port_info["service"] in ["HTTP", "HTTP-ALT", "HTTP-ALT2", "HTTP-ALT3", "HTTPS", "HTTPS-ALT"]:
-                http_info = fingerprint_http(ip, port_info["port"])
-                if http_info:
-                    break
-        
-        # RTSP credential testing (only if RTSP port found)
-        rtsp_creds = []
-        for port_info in ports:
-            if port_info["service"] in ["RTSP", "RTSP-ALT"]:
-                rtsp_creds = test_rtsp_credentials(ip, port_info["port"])
-                if rtsp_creds:
-                    break
-        
-        # Determine device type
-        dev_type, icon, type_name = determine_type(hostname, vendor, vendor_icon, ports, http_info, rtsp_creds)
-        
-        # Check if found via discovery protocols
-        discovery_protocol = None
-        for dev in onvif_devices:
-            if dev.get("ip") == ip:
-                discovery_protocol = "onvif"
-                if dev_type != "ip_camera":
-                    dev_type, icon, type_name = "ip_camera", "📷", "ONVIF Camera"
-                break
-        
-        discovered_devices.append({
-            "id": f"auto_{ip.replace('.', '_')}",
-            "ip": ip,
-            "mac": mac,
-            "hostname": hostname,
-            "vendor": vendor,
-            "type": dev_type,
-            "type_name": type_name,
-            "icon": icon,
-            "open_ports": ports,
-            "http_fingerprint": http_info,
-            "rtsp_credentials": rtsp_creds,
-            "discovery_protocol": discovery_protocol,
-            "is_local": ip == local_ip,
-            "discovered_at": datetime.now().isoformat()
-        })
-    
-    # Sort by IP
-    discovered_devices.sort(key=lambda d: [int(x) for x in d["ip"].split('.')])
+    # Phase 6: Analyze devices in a pipeline (90%); results show up as they finish
+    scan_status["message"] = f"Analyzing {len(arp)} devices..."
+    scan_status["progress"] = 45
+    analyze_devices(arp, {dev.get("ip") for dev in onvif_devices}, local_ip)
     
     # Count cameras
     camera_count = len([d for d in discovered_devices if d["type"] == "ip_camera"])
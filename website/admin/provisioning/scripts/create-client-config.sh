@@ -62,6 +62,9 @@ else
 fi
 
 # Add peer to server config
+# Note: this peer is not written to the API's peers.db, so the API's startup
+# reconcile treats it as an orphan. It is kept unless the API runs with
+# RECONCILE=remove-orphans; use the API's /api/create-peer on servers that do.
 echo "[3/4] Adding peer to server..."
 wg set wg0 peer $CLIENT_PUBLIC_KEY allowed-ips ${CLIENT_IP}/32
 